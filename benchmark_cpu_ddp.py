@@ -0,0 +1,158 @@
+"""
+Scaling benchmark for data parallel training on CPU cores (gloo backend).
+Runs the same training step with 1, 2, 4, 8 processes sharing the CPU cores
+and reports the training throughput in images per second.
+
+Synthetic images and boxes are used so that the numbers only depend on the
+model and the process/thread split, not on disk or augmentations.
+
+USAGE:
+python benchmark_cpu_ddp.py --model fasterrcnn_mobilenetv3_large_fpn --nprocs 1 2 4 8 --batch 4 --imgsz 320
+"""
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import argparse
+import os
+import time
+
+from models.create_fasterrcnn_model import create_model
+from torch_utils import utils
+from utils.autobatch import synthetic_batch
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-m', '--model',
+        default='fasterrcnn_mobilenetv3_large_fpn',
+        help='name of the model'
+    )
+    parser.add_argument(
+        '--nprocs',
+        default=[1, 2, 4, 8],
+        type=int,
+        nargs='+',
+        help='number of processes to benchmark'
+    )
+    parser.add_argument(
+        '-b', '--batch',
+        default=4,
+        type=int,
+        help='batch size per process'
+    )
+    parser.add_argument(
+        '-ims', '--imgsz',
+        default=320,
+        type=int,
+        help='image size to feed to the network'
+    )
+    parser.add_argument(
+        '-nc', '--num-classes',
+        dest='num_classes',
+        default=21,
+        type=int,
+        help='number of classes including background'
+    )
+    parser.add_argument(
+        '--iters',
+        default=20,
+        type=int,
+        help='number of timed training steps per process'
+    )
+    parser.add_argument(
+        '--warmup',
+        default=3,
+        type=int,
+        help='number of untimed training steps per process'
+    )
+    parser.add_argument(
+        '--port',
+        default=29511,
+        type=int,
+        help='port of the rendezvous on localhost'
+    )
+    args = vars(parser.parse_args())
+    return args
+
+def worker(rank, world_size, args, queue):
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    os.environ['LOCAL_WORLD_SIZE'] = str(world_size)
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args['port'] + world_size)
+    dist_args = {
+        'device': 'cpu',
+        'dist_url': 'env://',
+        'world_size': world_size
+    }
+    # Same initialization path as `train.py`, gloo backend and an equal
+    # split of the intra-op threads.
+    utils.init_distributed_mode(dist_args)
+
+    torch.manual_seed(0)
+    model = create_model[args['model']](
+        num_classes=args['num_classes'], pretrained=False
+    )
+    model.transform.min_size = (args['imgsz'], )
+    model = torch.nn.parallel.DistributedDataParallel(model)
+    model.train()
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=0.001, momentum=0.9, nesterov=True)
+
+    torch.manual_seed(rank)
+    images, targets = synthetic_batch(
+        args['batch'], args['imgsz'], args['num_classes']
+    )
+    for i in range(args['warmup'] + args['iters']):
+        if i == args['warmup']:
+            dist.barrier()
+            start = time.time()
+        loss_dict = model(images, targets)
+        losses = sum(loss for loss in loss_dict.values())
+        optimizer.zero_grad()
+        losses.backward()
+        optimizer.step()
+    dist.barrier()
+    elapsed = time.time() - start
+
+    if rank == 0:
+        queue.put({
+            'nprocs': world_size,
+            'threads': torch.get_num_threads(),
+            'step_time': elapsed / args['iters'],
+            'images_per_sec': world_size * args['batch'] * args['iters'] / elapsed
+        })
+    dist.destroy_process_group()
+
+def main(args):
+    ctx = mp.get_context('spawn')
+    results = []
+    for nprocs in args['nprocs']:
+        queue = ctx.SimpleQueue()
+        mp.start_processes(
+            worker,
+            args=(nprocs, args, queue),
+            nprocs=nprocs,
+            start_method='spawn'
+        )
+        result = queue.get()
+        results.append(result)
+        print(
+            f"{result['nprocs']} processes: "
+            f"{result['images_per_sec']:.2f} images/sec"
+        )
+
+    base = results[0]['images_per_sec']
+    print(f"\n{'processes':>10} {'threads/proc':>13} {'step time (s)':>14} {'images/sec':>11} {'speedup':>8}")
+    for result in results:
+        print(
+            f"{result['nprocs']:>10} {result['threads']:>13} "
+            f"{result['step_time']:>14.3f} {result['images_per_sec']:>11.2f} "
+            f"{result['images_per_sec'] / base:>8.2f}"
+        )
+
+if __name__ == '__main__':
+    args = parse_opt()
+    main(args)
@@ -0,0 +1,191 @@
+"""
+Peak memory and training step time with and without activation
+checkpointing (`--grad-checkpoint` in `train.py`) for the supported models.
+
+Every model and setting runs in a fresh subprocess so that the peak memory
+of one run does not leak into the next. On CUDA the peak is
+`torch.cuda.max_memory_allocated()`, on CPU the peak resident set size of
+the process.
+
+USAGE:
+python benchmark_grad_checkpoint.py --device cuda --batch 8 --imgsz 640
+python benchmark_grad_checkpoint.py --models fasterrcnn_resnet101 fasterrcnn_vitdet --device cuda
+"""
+
+import torch
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from models.create_fasterrcnn_model import create_model
+from models.checkpointing import apply_activation_checkpointing
+from utils.autobatch import synthetic_batch
+
+SUPPORTED_MODELS = [
+    'fasterrcnn_resnet18',
+    'fasterrcnn_resnet50_fpn',
+    'fasterrcnn_resnet50_fpn_v2',
+    'fasterrcnn_resnet101',
+    'fasterrcnn_resnet152',
+    'fasterrcnn_convnext_tiny',
+    'fasterrcnn_convnext_small',
+    'fasterrcnn_vitdet',
+    'fasterrcnn_vitdet_tiny'
+]
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--models',
+        default=SUPPORTED_MODELS,
+        nargs='+',
+        help='names of the models to benchmark'
+    )
+    parser.add_argument(
+        '-d', '--device',
+        default='cuda',
+        help='computation device, cuda or cpu'
+    )
+    parser.add_argument(
+        '-b', '--batch',
+        default=4,
+        type=int,
+        help='batch size'
+    )
+    parser.add_argument(
+        '-ims', '--imgsz',
+        default=640,
+        type=int,
+        help='image size to feed to the network'
+    )
+    parser.add_argument(
+        '--iters',
+        default=10,
+        type=int,
+        help='number of timed training steps'
+    )
+    parser.add_argument(
+        '--warmup',
+        default=2,
+        type=int,
+        help='number of untimed training steps'
+    )
+    parser.add_argument(
+        '--worker',
+        action='store_true',
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        '--model',
+        default=None,
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        '--grad-checkpoint',
+        dest='grad_checkpoint',
+        action='store_true',
+        help=argparse.SUPPRESS
+    )
+    args = vars(parser.parse_args())
+    return args
+
+def run_worker(args):
+    """
+    Train `args['model']` for a few steps on synthetic data and print the
+    result as JSON on the last line of stdout.
+    """
+    device = torch.device(args['device'])
+    num_classes = 21
+    torch.manual_seed(0)
+    model = create_model[args['model']](num_classes=num_classes, pretrained=False)
+    num_blocks = 0
+    if args['grad_checkpoint']:
+        num_blocks = apply_activation_checkpointing(model)
+    model.transform.min_size = (args['imgsz'], )
+    model = model.to(device).train()
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=0.001, momentum=0.9, nesterov=True)
+
+    images, targets = synthetic_batch(args['batch'], args['imgsz'], num_classes)
+    images = [image.to(device) for image in images]
+    targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    for i in range(args['warmup'] + args['iters']):
+        if i == args['warmup']:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+        loss_dict = model(images, targets)
+        losses = sum(loss for loss in loss_dict.values())
+        optimizer.zero_grad()
+        losses.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / (1024 ** 2)
+    else:
+        # `ru_maxrss` is in KB on Linux.
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    step_time = (time.time() - start) / args['iters']
+    print(json.dumps({
+        'blocks': num_blocks, 'peak_mb': peak_mb, 'step_time': step_time
+    }))
+
+def benchmark(args, model_name, grad_checkpoint):
+    command = [
+        sys.executable, __file__, '--worker',
+        '--model', model_name,
+        '--device', args['device'],
+        '--batch', str(args['batch']),
+        '--imgsz', str(args['imgsz']),
+        '--iters', str(args['iters']),
+        '--warmup', str(args['warmup'])
+    ]
+    if grad_checkpoint:
+        command.append('--grad-checkpoint')
+    process = subprocess.run(command, capture_output=True, text=True)
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()
+        print(f"{model_name} failed: {error[-1] if error else process.returncode}")
+        return None
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def main(args):
+    rows = []
+    for model_name in args['models']:
+        print(f"Benchmarking {model_name}...")
+        baseline = benchmark(args, model_name, False)
+        checkpointed = benchmark(args, model_name, True)
+        if baseline is None or checkpointed is None:
+            continue
+        rows.append((model_name, baseline, checkpointed))
+
+    memory = 'GPU' if args['device'].startswith('cuda') else 'RSS'
+    print(
+        f"\nbatch {args['batch']}, image size {args['imgsz']}, "
+        f"peak memory is {memory} in MB"
+    )
+    print(
+        f"{'model':<28} {'blocks':>6} {'peak':>9} {'peak ckpt':>10} "
+        f"{'saved':>7} {'step (s)':>9} {'step ckpt':>10} {'slowdown':>9}"
+    )
+    for model_name, baseline, checkpointed in rows:
+        saved = 1 - checkpointed['peak_mb'] / baseline['peak_mb']
+        slowdown = checkpointed['step_time'] / baseline['step_time']
+        print(
+            f"{model_name:<28} {checkpointed['blocks']:>6} "
+            f"{baseline['peak_mb']:>9.0f} {checkpointed['peak_mb']:>10.0f} "
+            f"{saved:>7.1%} {baseline['step_time']:>9.3f} "
+            f"{checkpointed['step_time']:>10.3f} {slowdown:>8.2f}x"
+        )
+
+if __name__ == '__main__':
+    args = parse_opt()
+    if args['worker']:
+        run_worker(args)
+    else:
+        main(args)
@@ -4,9 +4,12 @@ import numpy as np
 import os
 import glob as glob
 import random
+import itertools
 
 from xml.etree import ElementTree as et
-from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader, Subset, Sampler, RandomSampler
+from utils.data_cache import DataCache
 from utils.transforms import (
     get_train_transform, 
     get_valid_transform,
@@ -15,6 +18,8 @@ from utils.transforms import (
 )
 from tqdm.auto import tqdm
 
+# EXIF tag of the image orientation.
+EXIF_ORIENTATION = 0x0112
 
 # the dataset class
 class CustomDataset(Dataset):
@@ -28,8 +33,15 @@ class CustomDataset(Dataset):
         use_train_aug=False,
         train=False, 
         mosaic=1.0,
-        square_training=False
+        square_training=False,
+        cache_dir=None
     ):
+        """
+        :param cache_dir: Optional directory of a `utils.data_cache.DataCache`
+            shared between runs. The decoded images and the parsed
+            annotations are read from it instead of the image and XML
+            files, it is built on first use.
+        """
         self.transforms = transforms
         self.use_train_aug = use_train_aug
         self.images_path = images_path
@@ -45,6 +57,15 @@ class CustomDataset(Dataset):
         self.mosaic = mosaic
         self.log_annot_issue_y = True
         
+        self.data_cache = None
+        if cache_dir is not None:
+            data_cache = DataCache(cache_dir, images_path, labels_path)
+            if data_cache.is_valid():
+                # Already indexed and cleaned.
+                self.data_cache = data_cache
+                self.all_images = data_cache.image_names
+                return
+
         # get all the image paths in sorted order
         for file_type in self.image_file_types:
             self.all_image_paths.extend(glob.glob(os.path.join(self.images_path, file_type)))
@@ -53,6 +74,11 @@ class CustomDataset(Dataset):
         self.all_images = sorted(self.all_images)
         # Remove all annotations and images when no object is present.
         self.read_and_clean()
+        if cache_dir is not None:
+            data_cache.build(
+                self.all_images, self.read_image, self.read_annotations
+            )
+            self.data_cache = data_cache
 
     def read_and_clean(self):
         print('Checking Labels and images...')
@@ -74,46 +100,88 @@ class CustomDataset(Dataset):
                 im = cv2.resize(im, (int(w0 * r), int(h0 * r)))
         return im
 
+    def read_image(self, image_name):
+        """
+        RGB uint8 image, from the data cache if there is one.
+        """
+        if self.data_cache is not None:
+            return self.data_cache.image(image_name)
+        image = cv2.imread(os.path.join(self.images_path, image_name))
+        # Convert BGR to RGB color format.
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def read_annotations(self, image_name):
+        """
+        List of (class name, xmin, ymin, xmax, ymax) of the objects in the
+        XML file of `image_name`, from the data cache if there is one.
+        """
+        if self.data_cache is not None:
+            return self.data_cache.annotations(image_name)
+        # Capture the corresponding XML file for getting the annotations.
+        annot_filename = os.path.splitext(image_name)[0] + '.xml'
+        annot_file_path = os.path.join(self.labels_path, annot_filename)
+        tree = et.parse(annot_file_path)
+        root = tree.getroot()
+        objects = []
+        for member in root.findall('object'):
+            bndbox = member.find('bndbox')
+            objects.append((
+                member.find('name').text,
+                # xmin = left corner x-coordinates
+                float(bndbox.find('xmin').text),
+                # ymin = left corner y-coordinates
+                float(bndbox.find('ymin').text),
+                # xmax = right corner x-coordinates
+                float(bndbox.find('xmax').text),
+                # ymax = right corner y-coordinates
+                float(bndbox.find('ymax').text)
+            ))
+        return objects
+
     def load_image_and_labels(self, index):
         image_name = self.all_images[index]
-        image_path = os.path.join(self.images_path, image_name)
 
         # Read the image.
-        image = cv2.imread(image_path)
-        # Convert BGR to RGB color format.
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32)
+        image = self.read_image(image_name).astype(np.float32)
         image_resized = self.resize(image, square=self.square_training)
         image_resized /= 255.0
-        
-        # Capture the corresponding XML file for getting the annotations.
-        annot_filename = os.path.splitext(image_name)[0] + '.xml'
-        annot_file_path = os.path.join(self.labels_path, annot_filename)
 
-        boxes = []
-        orig_boxes = []
-        labels = []
-        
         # Get the height and width of the image.
         image_width = image.shape[1]
         image_height = image.shape[0]
-                
+
+        orig_boxes, boxes, labels, area, iscrowd = self.load_labels(
+            image_name, 
+            image_width, 
+            image_height, 
+            image_resized.shape[1], 
+            image_resized.shape[0]
+        )
+        return image, image_resized, orig_boxes, \
+            boxes, labels, area, iscrowd, (image_width, image_height)
+
+    def load_labels(
+        self, 
+        image_name, 
+        image_width, 
+        image_height, 
+        resized_width, 
+        resized_height
+    ):
+        """
+        Boxes in the original and in the resized image, labels, areas and
+        crowd flags of the objects of `image_name`.
+        """
+        boxes = []
+        orig_boxes = []
+        labels = []
+
         # Box coordinates for xml files are extracted and corrected for image size given.
         # try:
-        tree = et.parse(annot_file_path)
-        root = tree.getroot()
-        for member in root.findall('object'):
+        for name, xmin, ymin, xmax, ymax in self.read_annotations(image_name):
             # Map the current object name to `classes` list to get
             # the label index and append to `labels` list.
-            labels.append(self.classes.index(member.find('name').text))
-            
-            # xmin = left corner x-coordinates
-            xmin = float(member.find('bndbox').find('xmin').text)
-            # xmax = right corner x-coordinates
-            xmax = float(member.find('bndbox').find('xmax').text)
-            # ymin = left corner y-coordinates
-            ymin = float(member.find('bndbox').find('ymin').text)
-            # ymax = right corner y-coordinates
-            ymax = float(member.find('bndbox').find('ymax').text)
+            labels.append(self.classes.index(name))
 
             xmin, ymin, xmax, ymax = self.check_image_and_annotation(
                 xmin, 
@@ -129,18 +197,18 @@ class CustomDataset(Dataset):
             
             # Resize the bounding boxes according to the
             # desired `width`, `height`.
-            xmin_final = (xmin/image_width)*image_resized.shape[1]
-            xmax_final = (xmax/image_width)*image_resized.shape[1]
-            ymin_final = (ymin/image_height)*image_resized.shape[0]
-            ymax_final = (ymax/image_height)*image_resized.shape[0]
+            xmin_final = (xmin/image_width)*resized_width
+            xmax_final = (xmax/image_width)*resized_width
+            ymin_final = (ymin/image_height)*resized_height
+            ymax_final = (ymax/image_height)*resized_height
 
             xmin_final, ymin_final, xmax_final, ymax_final = self.check_image_and_annotation(
                 xmin_final, 
                 ymin_final, 
                 xmax_final, 
                 ymax_final, 
-                image_resized.shape[1], 
-                image_resized.shape[0],
+                resized_width, 
+                resized_height,
                 orig_data=False
             )
             
@@ -156,8 +224,68 @@ class CustomDataset(Dataset):
         iscrowd = torch.zeros((boxes.shape[0],), dtype=torch.int64) if boxes_length > 0 else torch.as_tensor(boxes, dtype=torch.float32)
         # Labels to tensor.
         labels = torch.as_tensor(labels, dtype=torch.int64)
-        return image, image_resized, orig_boxes, \
-            boxes, labels, area, iscrowd, (image_width, image_height)
+        return orig_boxes, boxes, labels, area, iscrowd
+
+    def image_size(self, image_name):
+        """
+        (height, width) of the image as `read_image` returns it, from the
+        file header (or the data cache) without decoding the image.
+        """
+        if self.data_cache is not None:
+            return tuple(self.data_cache.index['items'][image_name][1][:2])
+        with Image.open(os.path.join(self.images_path, image_name)) as image:
+            width, height = image.size
+            # `cv2.imread` applies the EXIF orientation, the transposing
+            # ones swap the sides.
+            if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+                width, height = height, width
+        return height, width
+
+    def resized_size(self, height, width):
+        """
+        (height, width) of an image of the given size after `resize`.
+        """
+        if self.square_training:
+            return self.img_size, self.img_size
+        r = self.img_size / max(height, width)
+        if r != 1:
+            return int(height * r), int(width * r)
+        return height, width
+
+    def get_annotations(self, idx):
+        """
+        The target of `self[idx]` and the (height, width) of its image
+        tensor, without decoding the image. For building the COCO ground
+        truth of the evaluation datasets (`train=False`).
+        """
+        assert not self.train and not self.use_train_aug, \
+            'get_annotations needs a dataset without random augmentations'
+        image_name = self.all_images[idx]
+        image_height, image_width = self.image_size(image_name)
+        resized_height, resized_width = self.resized_size(
+            image_height, image_width
+        )
+        _, boxes, labels, area, iscrowd = self.load_labels(
+            image_name, image_width, image_height, resized_width, resized_height
+        )
+        target = {}
+        target["boxes"] = boxes
+        target["labels"] = labels
+        target["area"] = area
+        target["iscrowd"] = iscrowd
+        target["image_id"] = torch.tensor([idx])
+        # The same box transform as `__getitem__`, on a placeholder image
+        # of the right shape that takes no memory.
+        placeholder = np.lib.stride_tricks.as_strided(
+            np.zeros(1, dtype=np.float32), 
+            shape=(resized_height, resized_width, 3), 
+            strides=(0, 0, 0)
+        )
+        sample = self.transforms(image=placeholder, bboxes=boxes, labels=labels)
+        target['boxes'] = torch.Tensor(sample['bboxes']).to(torch.int64)
+        if np.isnan((target['boxes']).numpy()).any() or target['boxes'].shape == torch.Size([0]):
+            target['boxes'] = torch.zeros((0, 4), dtype=torch.int64)
+        return target, (resized_height, resized_width)
 
     def check_image_and_annotation(
         self, 
@@ -333,6 +461,151 @@ def collate_fn(batch):
     """
     return tuple(zip(*batch))
 
+# Dtypes of the target fields that the torchvision detection models expect.
+TARGET_DTYPES = {
+    'boxes': torch.float32,
+    'labels': torch.int64,
+    'area': torch.float32,
+    'iscrowd': torch.int64,
+    'image_id': torch.int64
+}
+# Target fields with one entry per object, concatenated over the batch.
+OBJECT_FIELDS = ('boxes', 'labels', 'area', 'iscrowd')
+
+class PackedBatch:
+    """
+    A batch in one contiguous byte buffer: the zero padded images
+    (float32, B x 3 x H x W) followed by the target fields of all the images
+    concatenated along the object dimension. Each field starts at an
+    8 byte aligned offset and is read back as a typed view of the buffer.
+
+    The per image sizes and object counts are kept as Python lists so that
+    unpacking on the GPU does not need to read anything back from it.
+    The buffer is moved with a single (pinned) copy.
+    """
+    def __init__(self, buffer, layout, image_sizes, counts):
+        """
+        :param buffer: uint8 tensor holding all the fields.
+        :param layout: Dict of field name to (byte offset, dtype, shape).
+        :param image_sizes: List of (height, width) of the unpadded images.
+        :param counts: Dict of field name in `OBJECT_FIELDS` to the list
+            of per image object counts.
+        """
+        self.buffer = buffer
+        self.layout = layout
+        self.image_sizes = image_sizes
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.image_sizes)
+
+    def __getitem__(self, name):
+        offset, dtype, shape = self.layout[name]
+        nbytes = int(np.prod(shape)) * torch.empty((), dtype=dtype).element_size()
+        return self.buffer[offset:offset+nbytes].view(dtype).view(shape)
+
+    def pin_memory(self):
+        # Called by the `DataLoader` when `pin_memory=True`.
+        return PackedBatch(
+            self.buffer.pin_memory(), self.layout, self.image_sizes, self.counts
+        )
+
+    def to(self, device, non_blocking=False):
+        return PackedBatch(
+            self.buffer.to(device, non_blocking=non_blocking),
+            self.layout,
+            self.image_sizes,
+            self.counts
+        )
+
+    def unpack(self):
+        """
+        Views of the buffer in the format of `collate_fn`, a list of
+        unpadded image tensors and a list of target dictionaries, as the
+        torchvision detection models expect them.
+        """
+        images = self['images']
+        images = [
+            images[i, :, :h, :w] for i, (h, w) in enumerate(self.image_sizes)
+        ]
+        fields = {name: self[name] for name in OBJECT_FIELDS}
+        image_ids = self['image_id']
+        starts = dict.fromkeys(OBJECT_FIELDS, 0)
+        targets = []
+        for i in range(len(self)):
+            target = {}
+            for name in OBJECT_FIELDS:
+                count = self.counts[name][i]
+                target[name] = fields[name][starts[name]:starts[name]+count]
+                starts[name] += count
+            target['image_id'] = image_ids[i:i+1]
+            targets.append(target)
+        return images, targets
+
+def packed_collate_fn(batch):
+    """
+    `collate_fn` returning a `PackedBatch`. Use `batch_to_device` to get
+    the images and targets on the computation device.
+    """
+    images, targets = zip(*batch)
+    image_sizes = [tuple(image.shape[-2:]) for image in images]
+    height = max(h for h, _ in image_sizes)
+    width = max(w for _, w in image_sizes)
+    counts = {
+        name: [len(target[name]) for target in targets] for name in OBJECT_FIELDS
+    }
+    shapes = {
+        'images': (len(images), 3, height, width),
+        'boxes': (sum(counts['boxes']), 4),
+        'labels': (sum(counts['labels']), ),
+        'area': (sum(counts['area']), ),
+        'iscrowd': (sum(counts['iscrowd']), ),
+        'image_id': (len(images), )
+    }
+    layout = {}
+    nbytes = 0
+    for name, shape in shapes.items():
+        dtype = images[0].dtype if name == 'images' else TARGET_DTYPES[name]
+        nbytes = (nbytes + 7) // 8 * 8
+        layout[name] = (nbytes, dtype, shape)
+        nbytes += int(np.prod(shape)) * torch.empty((), dtype=dtype).element_size()
+
+    packed = PackedBatch(
+        torch.empty(nbytes, dtype=torch.uint8), layout, image_sizes, counts
+    )
+    packed_images = packed['images']
+    if any(size != (height, width) for size in image_sizes):
+        packed_images.zero_()
+    for i, image in enumerate(images):
+        packed_images[i, :, :image.shape[1], :image.shape[2]].copy_(image)
+    for name in OBJECT_FIELDS:
+        # Images without objects come with float `area` and `iscrowd`.
+        values = [
+            target[name].reshape((-1, ) + shapes[name][1:]).to(TARGET_DTYPES[name])
+            for target in targets
+        ]
+        if shapes[name][0] > 0:
+            torch.cat(values, out=packed[name])
+    packed['image_id'].copy_(
+        torch.cat([target['image_id'].reshape(-1) for target in targets])
+    )
+    return packed
+
+def batch_to_device(batch, device):
+    """
+    Images and targets of a batch from `collate_fn` or `packed_collate_fn`
+    on `device`, with the target dtypes in `TARGET_DTYPES`.
+    """
+    if isinstance(batch, PackedBatch):
+        return batch.to(device, non_blocking=True).unpack()
+    images, targets = batch
+    images = [image.to(device) for image in images]
+    targets = [
+        {k: v.to(device, TARGET_DTYPES.get(k, v.dtype)) for k, v in t.items()}
+        for t in targets
+    ]
+    return images, targets
+
 # Prepare the final datasets and data loaders.
 def create_train_dataset(
     train_dir_images, 
@@ -341,7 +614,8 @@ def create_train_dataset(
     classes,
     use_train_aug=False,
     mosaic=1.0,
-    square_training=False
+    square_training=False,
+    cache_dir=None
 ):
     train_dataset = CustomDataset(
         train_dir_images, 
@@ -352,7 +626,8 @@ def create_train_dataset(
         use_train_aug=use_train_aug,
         train=True, 
         mosaic=mosaic,
-        square_training=square_training
+        square_training=square_training,
+        cache_dir=cache_dir
     )
     return train_dataset
 def create_valid_dataset(
@@ -360,7 +635,8 @@ def create_valid_dataset(
     valid_dir_labels, 
     img_size, 
     classes,
-    square_training=False
+    square_training=False,
+    cache_dir=None
 ):
     valid_dataset = CustomDataset(
         valid_dir_images, 
@@ -369,32 +645,124 @@ def create_valid_dataset(
         classes, 
         get_valid_transform(),
         train=False, 
-        square_training=square_training
+        square_training=square_training,
+        cache_dir=cache_dir
     )
     return valid_dataset
 
+def create_train_eval_dataset(
+    train_dir_images, 
+    train_dir_labels, 
+    img_size, 
+    classes,
+    num_samples,
+    seed=0,
+    square_training=False,
+    cache_dir=None
+):
+    """
+    Fixed random sample of the training images without any augmentation
+    (same data path as the validation set), for estimating train mAP
+    without running inference over the whole training set every epoch.
+
+    :param num_samples: Number of training images in the sample.
+    :param seed: Seed for choosing the sample, the same images are used
+        in every epoch.
+    """
+    dataset = create_valid_dataset(
+        train_dir_images, 
+        train_dir_labels, 
+        img_size, 
+        classes,
+        square_training=square_training,
+        cache_dir=cache_dir
+    )
+    num_samples = min(num_samples, len(dataset))
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_samples]
+    return Subset(dataset, sorted(indices.tolist()))
+
+class InfiniteSampler(Sampler):
+    """
+    Endless index stream over `sampler` for step based training
+    (`--max-steps`). The data loader is iterated once, so its workers keep
+    prefetching across the epoch boundaries, and the last partial batch of
+    an epoch is filled with the first samples of the next one.
+
+    Every pass calls `sampler.set_epoch(epoch)` (`DistributedSampler`) or
+    seeds a `RandomSampler` with `seed + epoch`, so the order of every
+    epoch is reproducible and a resumed run continues the same stream.
+
+    :param sampler: Per epoch sampler (of this process' shard).
+    :param start_index: Number of samples already consumed, e.g.
+        `step * batch_size` when resuming.
+    :param seed: Base seed of the shuffling.
+    """
+    def __init__(self, sampler, start_index=0, seed=0):
+        self.sampler = sampler
+        self.start_index = start_index
+        self.seed = seed
+
+    def __iter__(self):
+        epoch, skip = divmod(self.start_index, len(self.sampler))
+        while True:
+            if hasattr(self.sampler, 'set_epoch'):
+                self.sampler.set_epoch(epoch)
+            elif isinstance(self.sampler, RandomSampler):
+                self.sampler.generator = torch.Generator().manual_seed(
+                    self.seed + epoch
+                )
+            yield from itertools.islice(iter(self.sampler), skip, None)
+            skip = 0
+            epoch += 1
+
+class StepWindow:
+    """
+    The next `num_steps` batches of an endless batch iterator, with a
+    length for the progress logging of `train_one_epoch`.
+    """
+    def __init__(self, iterator, num_steps):
+        self.iterator = iterator
+        self.num_steps = num_steps
+
+    def __len__(self):
+        return self.num_steps
+
+    def __iter__(self):
+        return itertools.islice(self.iterator, self.num_steps)
+
 def create_train_loader(
-    train_dataset, batch_size, num_workers=0, batch_sampler=None
+    train_dataset, batch_size, num_workers=0, batch_sampler=None, packed=False
 ):
+    """
+    :param packed: Collate into `PackedBatch`es in pinned memory, moved to
+        the GPU with one copy per batch.
+    """
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
         # shuffle=True,
         num_workers=num_workers,
-        collate_fn=collate_fn,
-        sampler=batch_sampler
+        collate_fn=packed_collate_fn if packed else collate_fn,
+        sampler=batch_sampler,
+        pin_memory=packed and torch.cuda.is_available()
     )
     return train_loader
 
 def create_valid_loader(
-    valid_dataset, batch_size, num_workers=0, batch_sampler=None
+    valid_dataset, batch_size, num_workers=0, batch_sampler=None, packed=False
 ):
+    """
+    :param packed: Collate into `PackedBatch`es in pinned memory, moved to
+        the GPU with one copy per batch.
+    """
     valid_loader = DataLoader(
         valid_dataset,
         batch_size=batch_size,
         shuffle=False,
         num_workers=num_workers,
-        collate_fn=collate_fn,
-        sampler=batch_sampler
+        collate_fn=packed_collate_fn if packed else collate_fn,
+        sampler=batch_sampler,
+        pin_memory=packed and torch.cuda.is_available()
     )
     return valid_loader
\ No newline at end of file
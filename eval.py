@@ -3,17 +3,40 @@ Run evaluation on a trained model to get mAP and class wise AP.
 
 USAGE:
 python eval.py --data data_configs/voc.yaml --weights outputs/training/fasterrcnn_convnext_small_voc_15e_noaug/best_model.pth --model fasterrcnn_convnext_small
+
+# Exact COCO mAP with the vectorized evaluator, or the streaming evaluator keeping the matches
+# as per class score histograms (flat memory, approximate AP within about 1e-3 of pycocotools):
+python eval.py --data data_configs/voc.yaml --weights outputs/training/fasterrcnn_convnext_small_voc_15e_noaug/best_model.pth --model fasterrcnn_convnext_small --evaluator fast
+python eval.py --data data_configs/voc.yaml --weights outputs/training/fasterrcnn_convnext_small_voc_15e_noaug/best_model.pth --model fasterrcnn_convnext_small --evaluator streaming
+
+# Save the raw detections, then compute the metrics again from them without running the model:
+python eval.py --data data_configs/voc.yaml --weights outputs/training/fasterrcnn_convnext_small_voc_15e_noaug/best_model.pth --model fasterrcnn_convnext_small --save-preds outputs/preds/voc_val.npz
+python eval.py --data data_configs/voc.yaml --from-preds outputs/preds/voc_val.npz --score-thres 0.05 --eval-classes cat dog --iou-thres 0.5 0.75 --evaluator torchmetrics -v
+
+# mAP and latency at several image sizes, the images are decoded once at the largest size:
+python eval.py --data data_configs/voc.yaml --weights outputs/training/fasterrcnn_convnext_small_voc_15e_noaug/best_model.pth --model fasterrcnn_convnext_small --img-sizes 320 480 640 800
+
+# Compare checkpoints on the same validation batches, decoded once and swapped into one model:
+python eval.py --data data_configs/voc.yaml --weights outputs/training/res_1/last_model.pth outputs/training/res_1/best_model.pth outputs/training/res_2/best_model.pth --model fasterrcnn_convnext_small
 """
 from datasets import (
     create_valid_dataset, create_valid_loader
 )
 from models.create_fasterrcnn_model import create_model
+from utils.quantization import assert_float_checkpoint
 from torch_utils import utils
 from torchmetrics.detection.mean_ap import MeanAveragePrecision
+from torch_utils.fast_coco_eval import (
+    FastMeanAveragePrecision, StreamingMeanAveragePrecision
+)
+from utils.prediction_store import (
+    save_predictions, load_predictions, filter_predictions
+)
 from pprint import pprint
 from tqdm import tqdm
 
 import torch
+import torch.nn.functional as F
 import argparse
 import yaml
 import torchvision
@@ -37,8 +60,11 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '-mw', '--weights', 
+        nargs='+',
         default=None,
-        help='path to trained checkpoint weights if providing custom YAML file'
+        help='path to trained checkpoint weights if providing custom YAML file, \
+              with more than one path the checkpoints are evaluated one \
+              after the other on the same cached batches and compared'
     )
     parser.add_argument(
         '-ims', '--imgsz', 
@@ -75,7 +101,80 @@ if __name__ == '__main__':
               single images to square shape first then puts them on a \
               square canvas.'
     )
+    parser.add_argument(
+        '--evaluator',
+        default='torchmetrics',
+        choices=['torchmetrics', 'fast', 'streaming'],
+        help='mAP engine, torchmetrics, the exact vectorized COCO evaluator \
+              of torch_utils/fast_coco_eval.py or streaming (per batch \
+              matching into per class score histograms, flat memory, \
+              approximate AP)'
+    )
+    parser.add_argument(
+        '--save-preds',
+        dest='save_preds',
+        default=None,
+        help='save the raw detections and ground truth to this .npz file'
+    )
+    parser.add_argument(
+        '--from-preds',
+        dest='from_preds',
+        default=None,
+        help='compute the metrics from a --save-preds file instead of \
+              running the model'
+    )
+    parser.add_argument(
+        '--score-thres',
+        dest='score_thres',
+        default=0.0,
+        type=float,
+        help='drop detections scoring below this before computing the metrics'
+    )
+    parser.add_argument(
+        '--eval-classes',
+        dest='eval_classes',
+        nargs='+',
+        default=None,
+        help='class names to compute the metrics for, the detections and \
+              ground truth of the other classes are dropped'
+    )
+    parser.add_argument(
+        '--iou-thres',
+        dest='iou_thres',
+        nargs='+',
+        type=float,
+        default=None,
+        help='IoU thresholds of the mAP, (default, 0.5:0.05:0.95), \
+              torchmetrics evaluator only'
+    )
+    parser.add_argument(
+        '--img-sizes',
+        dest='img_sizes',
+        nargs='+',
+        type=int,
+        default=None,
+        help='evaluate at each of these image sizes in one run and print \
+              the mAP and latency per size, replaces --imgsz'
+    )
+    parser.add_argument(
+        '--batch-cache-gb',
+        dest='batch_cache_gb',
+        default=4.0,
+        type=float,
+        help='memory budget for keeping the decoded validation batches \
+              when evaluating several --weights, larger validation sets \
+              are decoded again for every checkpoint'
+    )
     args = vars(parser.parse_args())
+    assert args['iou_thres'] is None or args['evaluator'] == 'torchmetrics', \
+        '--iou-thres is only supported by --evaluator torchmetrics'
+    assert args['img_sizes'] is None or (
+        args['from_preds'] is None and args['save_preds'] is None
+    ), '--img-sizes runs the model, it can not be combined with --from-preds or --save-preds'
+    assert args['weights'] is None or len(args['weights']) == 1 or (
+        args['img_sizes'] is None and args['save_preds'] is None
+        and args['from_preds'] is None
+    ), 'more than one --weights can not be combined with --img-sizes, --save-preds or --from-preds'
 
     # Load the data configurations
     with open(args['data']) as file:
@@ -96,50 +195,67 @@ if __name__ == '__main__':
 
     # Model configurations
     IMAGE_SIZE = args['imgsz']
+    if args['img_sizes'] is not None:
+        # Decoded once at the largest size and scaled down for the others.
+        IMAGE_SIZE = max(args['img_sizes'])
+
+    if args['from_preds'] is None:
+        # Load the pretrained model
+        create_model = create_model[args['model']]
+        if args['weights'] is None:
+            try:
+                model, coco_model = create_model(num_classes=NUM_CLASSES, coco_model=True)
+            except:
+                model = create_model(num_classes=NUM_CLASSES, coco_model=True)
+            if coco_model:
+                COCO_91_CLASSES = data_configs['COCO_91_CLASSES']
+                valid_dataset = create_valid_dataset(
+                    VALID_DIR_IMAGES, 
+                    VALID_DIR_LABELS, 
+                    IMAGE_SIZE, 
+                    COCO_91_CLASSES, 
+                    square_training=args['square_training']
+                )
 
-    # Load the pretrained model
-    create_model = create_model[args['model']]
-    if args['weights'] is None:
-        try:
-            model, coco_model = create_model(num_classes=NUM_CLASSES, coco_model=True)
-        except:
-            model = create_model(num_classes=NUM_CLASSES, coco_model=True)
-        if coco_model:
-            COCO_91_CLASSES = data_configs['COCO_91_CLASSES']
+        # Load weights.
+        if args['weights'] is not None:
+            model = create_model(num_classes=NUM_CLASSES, coco_model=False)
+            if len(args['weights']) == 1:
+                # Several checkpoints are loaded one by one when evaluated.
+                checkpoint = torch.load(args['weights'][0], map_location=DEVICE)
+                assert_float_checkpoint(checkpoint)
+                model.load_state_dict(checkpoint['model_state_dict'])
             valid_dataset = create_valid_dataset(
                 VALID_DIR_IMAGES, 
                 VALID_DIR_LABELS, 
                 IMAGE_SIZE, 
-                COCO_91_CLASSES, 
+                CLASSES,
                 square_training=args['square_training']
             )
-
-    # Load weights.
-    if args['weights'] is not None:
-        model = create_model(num_classes=NUM_CLASSES, coco_model=False)
-        checkpoint = torch.load(args['weights'], map_location=DEVICE)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        valid_dataset = create_valid_dataset(
-            VALID_DIR_IMAGES, 
-            VALID_DIR_LABELS, 
-            IMAGE_SIZE, 
-            CLASSES,
-            square_training=args['square_training']
-        )
-    model.to(DEVICE).eval()
+        model.to(DEVICE).eval()
     
-    valid_loader = create_valid_loader(valid_dataset, BATCH_SIZE, NUM_WORKERS)
+        valid_loader = create_valid_loader(valid_dataset, BATCH_SIZE, NUM_WORKERS)
 
     @torch.inference_mode()
     def evaluate(
         model, 
         data_loader, 
         device, 
+        metric,
+        keep_preds=False,
+        labels=None,
         out_dir=None,
         classes=None,
         colors=None
     ):
-        metric = MeanAveragePrecision(class_metrics=args['verbose'])
+        """
+        Run the model and update `metric` batch by batch.
+
+        :param keep_preds: Also return all the predictions and targets
+            (for `--save-preds`), otherwise empty lists are returned and
+            only the metric state is kept.
+        :param labels: Class indices of `--eval-classes`.
+        """
         n_threads = torch.get_num_threads()
         # FIXME remove this and make paste_masks_in_image run on the GPU
         torch.set_num_threads(1)
@@ -162,6 +278,8 @@ if __name__ == '__main__':
                 outputs = model(images)
 
             #####################################
+            batch_target = []
+            batch_preds = []
             for i in range(len(images)):
                 true_dict = dict()
                 preds_dict = dict()
@@ -170,49 +288,232 @@ if __name__ == '__main__':
                 preds_dict['boxes'] = outputs[i]['boxes'].detach().cpu()
                 preds_dict['scores'] = outputs[i]['scores'].detach().cpu()
                 preds_dict['labels'] = outputs[i]['labels'].detach().cpu()
-                preds.append(preds_dict)
-                target.append(true_dict)
+                batch_preds.append(preds_dict)
+                batch_target.append(true_dict)
+            if keep_preds:
+                preds.extend(batch_preds)
+                target.extend(batch_target)
+            metric.update(*filter_predictions(
+                batch_preds, batch_target, args['score_thres'], labels
+            ))
             #####################################
             outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
 
         # gather the stats from all processes
         metric_logger.synchronize_between_processes()
         torch.set_num_threads(n_threads)
-        metric.update(preds, target)
-        metric_summary = metric.compute()
-        return metric_summary
+        return preds, target
 
-    stats = evaluate(
-        model, 
-        valid_loader, 
-        device=DEVICE,
-        classes=CLASSES,
-    )
+    @torch.inference_mode()
+    def evaluate_sizes(
+        model,
+        data_loader,
+        device,
+        metrics,
+        labels=None
+    ):
+        """
+        Run the model at every image size of `metrics` on the same decoded
+        batches. The images (and target boxes) are scaled down from
+        `IMAGE_SIZE` as the dataset resizes them, and the model transform
+        `min_size` is set to the size like `train.py --imgsz`.
+
+        :param metrics: Dictionary of image size to the metric it updates.
+        :param labels: Class indices of `--eval-classes`.
+
+        Returns the mean model latency per image in ms for each size.
+        """
+        n_threads = torch.get_num_threads()
+        # Same as `evaluate`, to compare with the single size runs.
+        torch.set_num_threads(1)
+        model.eval()
+        min_size = model.transform.min_size
+        model_times = {size: 0.0 for size in metrics}
+        num_images = 0
+        for images, targets in tqdm(data_loader, total=len(data_loader)):
+            images = list(img.to(device) for img in images)
+            num_images += len(images)
+            for size, metric in metrics.items():
+                batch_images = []
+                batch_target = []
+                for image, target in zip(images, targets):
+                    height, width = image.shape[1:]
+                    r = size / max(height, width)
+                    new_height, new_width = int(height * r), int(width * r)
+                    if (new_height, new_width) != (height, width):
+                        image = F.interpolate(
+                            image[None],
+                            size=(new_height, new_width),
+                            mode='bilinear',
+                            align_corners=False
+                        )[0]
+                    scale = torch.tensor(
+                        [new_width / width, new_height / height] * 2
+                    )
+                    batch_images.append(image)
+                    batch_target.append({
+                        'boxes': target['boxes'].detach().cpu().float() * scale,
+                        'labels': target['labels'].detach().cpu()
+                    })
+                model.transform.min_size = (size, )
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                model_time = time.time()
+                outputs = model(batch_images)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                model_times[size] += time.time() - model_time
+                batch_preds = [
+                    {k: output[k].detach().cpu() for k in ('boxes', 'scores', 'labels')}
+                    for output in outputs
+                ]
+                metric.update(*filter_predictions(
+                    batch_preds, batch_target, args['score_thres'], labels
+                ))
+        model.transform.min_size = min_size
+        torch.set_num_threads(n_threads)
+        return {
+            size: 1000 * model_time / max(num_images, 1)
+            for size, model_time in model_times.items()
+        }
+
+    if args['from_preds'] is not None:
+        preds, target, stored_classes = load_predictions(args['from_preds'])
+        if stored_classes is not None:
+            CLASSES = stored_classes
 
-    print('\n')
-    pprint(stats)
-    if args['verbose']:
+    eval_labels = None
+    if args['eval_classes'] is not None:
+        eval_labels = [CLASSES.index(name) for name in args['eval_classes']]
+
+    def create_metric():
+        if args['evaluator'] == 'streaming':
+            return StreamingMeanAveragePrecision(class_metrics=args['verbose'])
+        if args['evaluator'] == 'fast':
+            return FastMeanAveragePrecision(class_metrics=args['verbose'])
+        return MeanAveragePrecision(
+            iou_thresholds=args['iou_thres'], class_metrics=args['verbose']
+        )
+
+    if args['evaluator'] == 'streaming':
+        print(
+            'The streaming evaluator reports approximate AP (per class score '
+            'histograms), use --evaluator fast for the exact COCO mAP'
+        )
+
+    if args['img_sizes'] is not None:
+        size_metrics = {size: create_metric() for size in args['img_sizes']}
+        latencies = evaluate_sizes(
+            model,
+            valid_loader,
+            device=DEVICE,
+            metrics=size_metrics,
+            labels=eval_labels
+        )
         print('\n')
-        pprint(f"Classes: {CLASSES}")
+        num_hyphens = 63
+        empty_string = ''
+        print('-'*num_hyphens)
+        print(f"|Size{empty_string:<4} | mAP{empty_string:<8}| mAP@0.5{empty_string:<4}| mAR@100{empty_string:<4}| Latency (ms)|")
+        print('-'*num_hyphens)
+        for size, size_metric in size_metrics.items():
+            size_stats = size_metric.compute()
+            print(f"|{size:<8} | {float(size_stats['map']):.3f}{empty_string:<6}| {float(size_stats['map_50']):.3f}{empty_string:<6}| {float(size_stats['mar_100']):.3f}{empty_string:<6}| {latencies[size]:<12.1f}|")
+        print('-'*num_hyphens)
+    elif args['weights'] is not None and len(args['weights']) > 1:
+        # Decoded once, every checkpoint sees the same tensors, if the
+        # float32 images (at most `IMAGE_SIZE` on the long side) fit in
+        # the budget. Otherwise the loader runs again per checkpoint.
+        cache_bytes = len(valid_dataset) * 3 * IMAGE_SIZE ** 2 * 4
+        if cache_bytes <= args['batch_cache_gb'] * 1024 ** 3:
+            cached_batches = list(valid_loader)
+            print(f"Cached {len(cached_batches)} validation batches")
+        else:
+            cached_batches = valid_loader
+            print(
+                f"The validation images need up to {cache_bytes / 1024 ** 3:.1f} GB, "
+                f"more than --batch-cache-gb {args['batch_cache_gb']}, "
+                f"decoding them again for every checkpoint"
+            )
+        weights_stats = []
+        for weights in args['weights']:
+            checkpoint = torch.load(weights, map_location=DEVICE)
+            assert_float_checkpoint(checkpoint)
+            model.load_state_dict(checkpoint['model_state_dict'])
+            metric = create_metric()
+            evaluate(
+                model,
+                cached_batches,
+                device=DEVICE,
+                metric=metric,
+                labels=eval_labels,
+                classes=CLASSES,
+            )
+            weights_stats.append((weights, checkpoint.get('epoch'), metric.compute()))
+            del checkpoint
         print('\n')
-        print('AP / AR per class')
+        width = max(len('Weights'), *(len(weights) for weights in args['weights']))
+        num_hyphens = width + 51
         empty_string = ''
-        if len(CLASSES) > 2: 
-            num_hyphens = 73
-            print('-'*num_hyphens)
-            print(f"|    | Class{empty_string:<16}| AP{empty_string:<18}| AR{empty_string:<18}|")
-            print('-'*num_hyphens)
-            class_counter = 0
-            for i in range(0, len(CLASSES)-1, 1):
-                class_counter += 1
-                print(f"|{class_counter:<3} | {CLASSES[i+1]:<20} | {np.array(stats['map_per_class'][i]):.3f}{empty_string:<15}| {np.array(stats['mar_100_per_class'][i]):.3f}{empty_string:<15}|")
-            print('-'*num_hyphens)
-            print(f"|Avg{empty_string:<23} | {np.array(stats['map']):.3f}{empty_string:<15}| {np.array(stats['mar_100']):.3f}{empty_string:<15}|")
+        print('-'*num_hyphens)
+        print(f"|{'Weights':<{width}} | Epoch{empty_string:<2}| mAP{empty_string:<8}| mAP@0.5{empty_string:<4}| mAR@100{empty_string:<4}|")
+        print('-'*num_hyphens)
+        for weights, epoch, weights_stat in weights_stats:
+            epoch = '-' if epoch is None else epoch
+            print(f"|{weights:<{width}} | {epoch:<6} | {float(weights_stat['map']):.3f}{empty_string:<6}| {float(weights_stat['map_50']):.3f}{empty_string:<6}| {float(weights_stat['mar_100']):.3f}{empty_string:<6}|")
+        print('-'*num_hyphens)
+    else:
+        metric = create_metric()
+
+        if args['from_preds'] is not None:
+            metric.update(*filter_predictions(
+                preds, target, args['score_thres'], eval_labels
+            ))
         else:
-            num_hyphens = 62
-            print('-'*num_hyphens)
-            print(f"|Class{empty_string:<10} | AP{empty_string:<18}| AR{empty_string:<18}|")
-            print('-'*num_hyphens)
-            print(f"|{CLASSES[1]:<15} | {np.array(stats['map']):.3f}{empty_string:<15}| {np.array(stats['mar_100']):.3f}{empty_string:<15}|")
-            print('-'*num_hyphens)
-            print(f"|Avg{empty_string:<12} | {np.array(stats['map']):.3f}{empty_string:<15}| {np.array(stats['mar_100']):.3f}{empty_string:<15}|")
\ No newline at end of file
+            preds, target = evaluate(
+                model, 
+                valid_loader, 
+                device=DEVICE,
+                metric=metric,
+                keep_preds=args['save_preds'] is not None,
+                labels=eval_labels,
+                classes=CLASSES,
+            )
+            if args['save_preds'] is not None:
+                save_predictions(
+                    args['save_preds'], preds, target, valid_dataset.classes
+                )
+        stats = metric.compute()
+
+        print('\n')
+        pprint(stats)
+        if args['verbose']:
+            print('\n')
+            pprint(f"Classes: {CLASSES}")
+            print('\n')
+            print('AP / AR per class')
+            empty_string = ''
+            if len(CLASSES) > 2: 
+                num_hyphens = 73
+                print('-'*num_hyphens)
+                print(f"|    | Class{empty_string:<16}| AP{empty_string:<18}| AR{empty_string:<18}|")
+                print('-'*num_hyphens)
+                class_counter = 0
+                # The metrics only cover the classes in the predictions or
+                # ground truth (and `--eval-classes`).
+                class_indices = np.atleast_1d(stats['classes'].numpy())
+                map_per_class = np.atleast_1d(stats['map_per_class'].numpy())
+                mar_per_class = np.atleast_1d(stats['mar_100_per_class'].numpy())
+                for i, class_index in enumerate(class_indices):
+                    class_counter += 1
+                    print(f"|{class_counter:<3} | {CLASSES[class_index]:<20} | {map_per_class[i]:.3f}{empty_string:<15}| {mar_per_class[i]:.3f}{empty_string:<15}|")
+                print('-'*num_hyphens)
+                print(f"|Avg{empty_string:<23} | {np.array(stats['map']):.3f}{empty_string:<15}| {np.array(stats['mar_100']):.3f}{empty_string:<15}|")
+            else:
+                num_hyphens = 62
+                print('-'*num_hyphens)
+                print(f"|Class{empty_string:<10} | AP{empty_string:<18}| AR{empty_string:<18}|")
+                print('-'*num_hyphens)
+                print(f"|{CLASSES[1]:<15} | {np.array(stats['map']):.3f}{empty_string:<15}| {np.array(stats['mar_100']):.3f}{empty_string:<15}|")
+                print('-'*num_hyphens)
+                print(f"|Avg{empty_string:<12} | {np.array(stats['map']):.3f}{empty_string:<15}| {np.array(stats['mar_100']):.3f}{empty_string:<15}|")
\ No newline at end of file
@@ -14,6 +14,7 @@ import yaml
 import os
 
 from models.create_fasterrcnn_model import create_model
+from utils.quantization import assert_float_checkpoint
 
 def parse_opt():
     parser = argparse.ArgumentParser()
@@ -67,6 +68,7 @@ def main(args):
     DEVICE = args['device']
     # Load weights if path provided.
     checkpoint = torch.load(args['weights'], map_location=DEVICE)
+    assert_float_checkpoint(checkpoint)
     # If config file is not given, load from model dictionary.    
     if data_configs is None:
         data_configs = True
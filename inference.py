@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 import pandas
 
 from models.create_fasterrcnn_model import create_model
+from utils.quantization import assert_float_checkpoint
 from utils.annotations import (
     inference_annotations, convert_detections
 )
@@ -167,6 +168,7 @@ def main(args):
     # Load weights if path provided.
     if args['weights'] is not None:
         checkpoint = torch.load(args['weights'], map_location=DEVICE)
+        assert_float_checkpoint(checkpoint)
         # If config file is not given, load from model dictionary.
         if data_configs is None:
             data_configs = True
@@ -0,0 +1,68 @@
+"""
+Activation checkpointing for the residual blocks of the ResNet, ConvNeXt
+and ViT backbones using `torch.utils.checkpoint`.
+
+The blocks are not wrapped in another module. Their class is swapped for a
+subclass that runs the same forward under `checkpoint` while training, so
+the `state_dict` keys stay the same and checkpoints load either way.
+"""
+
+import torch
+
+from torch.utils.checkpoint import checkpoint
+from torchvision.models.resnet import BasicBlock, Bottleneck
+from torchvision.models.convnext import CNBlock
+from models.layers import Block
+
+class _CheckpointMixin:
+    """
+    Do not keep the block's intermediate activations for the backward pass,
+    recompute them from the block input instead.
+    """
+    def forward(self, x):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super().forward, x, use_reentrant=False)
+        return super().forward(x)
+
+class CheckpointBasicBlock(_CheckpointMixin, BasicBlock):
+    pass
+
+class CheckpointBottleneck(_CheckpointMixin, Bottleneck):
+    pass
+
+class CheckpointCNBlock(_CheckpointMixin, CNBlock):
+    pass
+
+class CheckpointBlock(_CheckpointMixin, Block):
+    pass
+
+CHECKPOINT_BLOCKS = {
+    BasicBlock: CheckpointBasicBlock,
+    Bottleneck: CheckpointBottleneck,
+    CNBlock: CheckpointCNBlock,
+    Block: CheckpointBlock
+}
+
+def apply_activation_checkpointing(model):
+    """
+    Turn on activation checkpointing for every supported block in `model`
+    (ResNet `BasicBlock`/`Bottleneck`, ConvNeXt `CNBlock` and the ViT
+    `Block`). Can be called on the block itself.
+
+    Note that the block forward runs twice, so the running statistics of
+    non frozen batch norm layers inside a block are updated twice per step.
+
+    :param model: Model or module to modify in place.
+
+    Returns the number of checkpointed blocks, 0 if the model has none of
+    the supported blocks.
+    """
+    num_blocks = 0
+    for module in model.modules():
+        checkpoint_class = CHECKPOINT_BLOCKS.get(type(module))
+        if checkpoint_class is not None:
+            module.__class__ = checkpoint_class
+            num_blocks += 1
+        elif type(module) in CHECKPOINT_BLOCKS.values():
+            num_blocks += 1
+    return num_blocks
@@ -21,6 +21,7 @@ from models.layers import (
     LastLevelMaxPool
 )
 from models.utils import _assert_strides_are_log2_contiguous
+from models.checkpointing import apply_activation_checkpointing
 
 class ViT(Backbone):
     """
@@ -115,10 +116,7 @@ class ViT(Backbone):
                 input_size=(img_size // patch_size, img_size // patch_size),
             )
             if use_act_checkpoint:
-                # TODO: use torch.utils.checkpoint
-                from fairscale.nn.checkpoint import checkpoint_wrapper
-
-                block = checkpoint_wrapper(block)
+                apply_activation_checkpointing(block)
             self.blocks.append(block)
 
         self._out_feature_channels = {out_feature: embed_dim}
@@ -0,0 +1,359 @@
+"""
+Hyperparameter sweep over `train.py`.
+
+Trials come from a grid or a random search space (YAML file), run as
+`train.py` subprocesses across a pool of `--parallel` slots with a fixed
+number of intra-op threads each, and share one pre-built image and
+annotation cache (`--data-cache`), so the dataset is indexed and decoded
+once for the whole sweep.
+
+Poor trials are stopped early with asynchronous successive halving (ASHA):
+at the rungs `grace_period * reduction_factor**k` epochs, a trial whose
+mAP@0.5:0.95 (read from its `results.csv`) is below the top
+`1 / reduction_factor` of the trials that reached the same rung before it
+is terminated.
+
+Search space file, the keys are `train.py` arguments:
+    model: [fasterrcnn_nano, fasterrcnn_mini_darknet]   # choice
+    imgsz: [416, 512, 640]                              # choice
+    lr: {log_uniform: [0.0001, 0.01]}                   # random search only
+    mosaic: {uniform: [0.0, 1.0]}                       # random search only
+
+USAGE:
+python sweep.py --data data_configs/voc.yaml --space sweep_space.yaml --search random --trials 16 --parallel 4 --epochs 20
+python sweep.py --data data_configs/voc.yaml --space sweep_space.yaml --search grid --parallel 2 --devices cuda:0 cuda:1 --epochs 20 -- --batch 8 --workers 2
+"""
+
+import argparse
+import itertools
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import yaml
+
+from datasets import create_valid_dataset
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data',
+        required=True,
+        help='path to the data config file'
+    )
+    parser.add_argument(
+        '--space',
+        required=True,
+        help='path to the search space YAML file'
+    )
+    parser.add_argument(
+        '--search',
+        default='grid',
+        choices=['grid', 'random'],
+        help='grid over all choices or random samples of the space'
+    )
+    parser.add_argument(
+        '--trials',
+        default=10,
+        type=int,
+        help='number of trials for random search'
+    )
+    parser.add_argument(
+        '-e', '--epochs',
+        default=10,
+        type=int,
+        help='maximum number of epochs per trial'
+    )
+    parser.add_argument(
+        '--parallel',
+        default=1,
+        type=int,
+        help='number of trials running at the same time'
+    )
+    parser.add_argument(
+        '--threads',
+        default=None,
+        type=int,
+        help='intra-op threads per trial, \
+              (default, CPU cores split evenly between the parallel trials)'
+    )
+    parser.add_argument(
+        '--devices',
+        default=['cpu'],
+        nargs='+',
+        help='computation devices, assigned to the parallel slots in turn'
+    )
+    parser.add_argument(
+        '--grace-period',
+        dest='grace_period',
+        default=1,
+        type=int,
+        help='epochs before a trial can be stopped'
+    )
+    parser.add_argument(
+        '--reduction-factor',
+        dest='reduction_factor',
+        default=3,
+        type=int,
+        help='ASHA reduction factor, only the top 1/factor of the trials \
+              at a rung continue, 0 disables early stopping'
+    )
+    parser.add_argument(
+        '--out-dir',
+        dest='out_dir',
+        default='outputs/sweep',
+        help='directory for the trial outputs and the results table'
+    )
+    parser.add_argument(
+        '--data-cache',
+        dest='data_cache',
+        default=None,
+        help='shared data cache directory, (default data_cache in --out-dir)'
+    )
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='seed for sampling the random search space'
+    )
+    parser.add_argument(
+        'train_args',
+        nargs=argparse.REMAINDER,
+        help='extra train.py arguments for every trial, after --'
+    )
+    args = vars(parser.parse_args())
+    if args['train_args'][:1] == ['--']:
+        args['train_args'] = args['train_args'][1:]
+    return args
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if isinstance(spec, dict) and len(spec) == 1:
+        (kind, (low, high)), = spec.items()
+        if kind == 'uniform':
+            return rng.uniform(low, high)
+        if kind == 'log_uniform':
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        if kind == 'int_uniform':
+            return rng.randint(low, high)
+    raise ValueError(f"Unsupported search space entry {spec}")
+
+def create_trials(space, search, num_trials, seed):
+    """
+    List of parameter dictionaries, one per trial.
+    """
+    if search == 'grid':
+        for name, spec in space.items():
+            assert isinstance(spec, list), \
+                f"Grid search needs a list of values for {name}"
+        names = list(space.keys())
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(*(space[name] for name in names))
+        ]
+    rng = random.Random(seed)
+    return [
+        {name: sample_value(spec, rng) for name, spec in space.items()}
+        for _ in range(num_trials)
+    ]
+
+class ASHA:
+    """
+    Asynchronous successive halving, stopping rule version.
+
+    :param max_epochs: Epochs of a full trial.
+    :param grace_period: First rung.
+    :param reduction_factor: Keep the top `1 / reduction_factor` at a rung.
+    """
+    def __init__(self, max_epochs, grace_period=1, reduction_factor=3):
+        self.reduction_factor = reduction_factor
+        self.rungs = {}
+        if reduction_factor > 1:
+            rung = grace_period
+            while rung < max_epochs:
+                self.rungs[rung] = []
+                rung *= reduction_factor
+
+    def should_stop(self, epoch, metric):
+        """
+        Record `metric` of a trial at `epoch`. Returns True if the trial is
+        below the cutoff of the trials that reached this rung before it.
+        """
+        if epoch not in self.rungs:
+            return False
+        recorded = self.rungs[epoch]
+        stop = False
+        if recorded:
+            cutoff = np.nanpercentile(
+                recorded, (1 - 1 / self.reduction_factor) * 100
+            )
+            stop = metric < cutoff
+        recorded.append(metric)
+        return stop
+
+class Trial:
+    def __init__(self, trial_id, params, out_dir):
+        self.trial_id = trial_id
+        self.params = params
+        self.out_dir = os.path.join(out_dir, f"trial_{trial_id:03d}")
+        self.process = None
+        self.log_file = None
+        self.status = 'pending'
+        self.epochs = 0
+        # mAP@0.5:0.95 and mAP@0.5 per finished epoch.
+        self.map = []
+        self.map_05 = []
+
+    def command(self, args, device, data_cache):
+        command = [
+            sys.executable, 'train.py',
+            '--data', args['data'],
+            '--epochs', str(args['epochs']),
+            '--device', device,
+            '--project-dir', self.out_dir,
+            '--data-cache', data_cache,
+            '--disable-wandb'
+        ]
+        for name, value in self.params.items():
+            command += [f"--{name.replace('_', '-')}", str(value)]
+        return command + args['train_args']
+
+    def start(self, args, device, data_cache, threads):
+        os.makedirs(self.out_dir, exist_ok=True)
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(threads)
+        env['MKL_NUM_THREADS'] = str(threads)
+        self.log_file = open(os.path.join(self.out_dir, 'stdout.log'), 'w')
+        self.process = subprocess.Popen(
+            self.command(args, device, data_cache),
+            stdout=self.log_file,
+            stderr=subprocess.STDOUT,
+            env=env
+        )
+        self.status = 'running'
+
+    def new_results(self):
+        """
+        mAP@0.5:0.95 of the epochs finished since the last call, as
+        (epoch, mAP) pairs.
+        """
+        results_path = os.path.join(self.out_dir, 'results.csv')
+        if not os.path.exists(results_path):
+            return []
+        try:
+            results = pd.read_csv(results_path)
+        except (pd.errors.EmptyDataError, pd.errors.ParserError):
+            # Being written.
+            return []
+        new = []
+        for _, row in results.iloc[self.epochs:].iterrows():
+            self.epochs = int(row['epoch'])
+            self.map.append(float(row['map']))
+            self.map_05.append(float(row['map_05']))
+            new.append((self.epochs, self.map[-1]))
+        return new
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.finish('stopped')
+
+    def finish(self, status):
+        self.status = status
+        self.log_file.close()
+
+def build_data_cache(data_configs, cache_dir):
+    """
+    Index and decode the training and validation images once for all
+    trials.
+    """
+    for split in ('TRAIN', 'VALID'):
+        create_valid_dataset(
+            data_configs[f"{split}_DIR_IMAGES"],
+            data_configs[f"{split}_DIR_LABELS"],
+            640,
+            data_configs['CLASSES'],
+            cache_dir=cache_dir
+        )
+
+def write_results(trials, out_dir):
+    rows = []
+    for trial in trials:
+        best = int(np.argmax(trial.map)) if trial.map else None
+        rows.append({
+            'trial': trial.trial_id,
+            **trial.params,
+            'status': trial.status,
+            'epochs': trial.epochs,
+            'best_map': trial.map[best] if best is not None else float('nan'),
+            'best_map_05': trial.map_05[best] if best is not None else float('nan'),
+            'best_epoch': best + 1 if best is not None else None
+        })
+    results = pd.DataFrame(rows).sort_values('best_map', ascending=False)
+    results.to_csv(os.path.join(out_dir, 'results.csv'), index=False)
+    return results
+
+def main(args):
+    with open(args['data']) as file:
+        data_configs = yaml.safe_load(file)
+    with open(args['space']) as file:
+        space = yaml.safe_load(file)
+    os.makedirs(args['out_dir'], exist_ok=True)
+    data_cache = args['data_cache'] or os.path.join(args['out_dir'], 'data_cache')
+    build_data_cache(data_configs, data_cache)
+
+    threads = args['threads'] or max(os.cpu_count() // args['parallel'], 1)
+    trials = [
+        Trial(i, params, args['out_dir'])
+        for i, params in enumerate(
+            create_trials(space, args['search'], args['trials'], args['seed'])
+        )
+    ]
+    asha = ASHA(args['epochs'], args['grace_period'], args['reduction_factor'])
+    print(
+        f"{len(trials)} trials, {args['parallel']} at a time with "
+        f"{threads} threads each, ASHA rungs at epochs {list(asha.rungs)}"
+    )
+
+    pending = list(trials)
+    running = {}
+    while pending or running:
+        for slot in range(args['parallel']):
+            if slot not in running and pending:
+                trial = pending.pop(0)
+                device = args['devices'][slot % len(args['devices'])]
+                trial.start(args, device, data_cache, threads)
+                running[slot] = trial
+                print(f"Trial {trial.trial_id} started on {device}: {trial.params}")
+        time.sleep(5)
+        for slot, trial in list(running.items()):
+            for epoch, metric in trial.new_results():
+                if asha.should_stop(epoch, metric):
+                    trial.stop()
+                    print(
+                        f"Trial {trial.trial_id} stopped at epoch {epoch}, "
+                        f"mAP {metric:.3f}"
+                    )
+                    break
+            if trial.status == 'running' and trial.process.poll() is not None:
+                trial.new_results()
+                trial.finish(
+                    'completed' if trial.process.returncode == 0 else 'failed'
+                )
+                print(f"Trial {trial.trial_id} {trial.status}")
+            if trial.status != 'running':
+                del running[slot]
+                write_results(trials, args['out_dir'])
+
+    results = write_results(trials, args['out_dir'])
+    print(results.to_string(index=False))
+    print(f"Results saved to {os.path.join(args['out_dir'], 'results.csv')}")
+
+if __name__ == '__main__':
+    args = parse_opt()
+    main(args)
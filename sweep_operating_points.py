@@ -0,0 +1,381 @@
+"""
+Operating point sweep over the detection score threshold and the NMS IoU
+of a trained model.
+
+The model runs once over the validation set with a very low score
+threshold and without NMS (`box_nms_thresh` 1.0), the raw detections can
+be kept with `--save-preds`. For every NMS IoU of the grid the class wise
+NMS and the `--detections-per-img` limit of the model are applied again
+to the raw detections (`torchvision.ops.batched_nms`, same as the model's
+own post processing), the detections are matched to the ground truth
+once, and the precision, recall and F1 (at IoU 0.5) and the
+mAP@0.5:0.95 of all the score thresholds come from cumulative sums over
+the score sorted matches.
+
+Writes the whole grid to `operating_points.csv` and the NMS IoU with the
+best mean F1 and its best per class score thresholds to
+`best_thresholds.yaml`.
+
+USAGE:
+python sweep_operating_points.py --data data_configs/voc.yaml --weights outputs/training/res_1/best_model.pth --model fasterrcnn_resnet50_fpn_v2 --save-preds outputs/preds/voc_val_raw.npz
+python sweep_operating_points.py --data data_configs/voc.yaml --from-preds outputs/preds/voc_val_raw.npz --nms-ious 0.4 0.5 0.6 --thresholds 0.1 0.9 0.05
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+from torchvision.ops import batched_nms
+from tqdm import tqdm
+
+from datasets import create_valid_dataset, create_valid_loader
+from models.create_fasterrcnn_model import create_model
+from utils.quantization import assert_float_checkpoint
+from torch_utils.fast_coco_eval import (
+    evaluate_image, interpolated_precision, xyxy_to_xywh
+)
+from utils.prediction_store import save_predictions, load_predictions
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data',
+        default='data_configs/voc.yaml',
+        help='path to the data config file'
+    )
+    parser.add_argument(
+        '-m', '--model',
+        default='fasterrcnn_resnet50_fpn',
+        help='name of the model'
+    )
+    parser.add_argument(
+        '-mw', '--weights',
+        default=None,
+        help='path to the trained checkpoint'
+    )
+    parser.add_argument(
+        '-ims', '--imgsz',
+        default=640,
+        type=int,
+        help='image size to feed to the network'
+    )
+    parser.add_argument(
+        '-w', '--workers', default=4, type=int,
+        help='number of workers for data processing/transforms/augmentations'
+    )
+    parser.add_argument(
+        '-b', '--batch',
+        default=8,
+        type=int,
+        help='batch size to load the data'
+    )
+    parser.add_argument(
+        '-d', '--device',
+        default=torch.device('cuda:0' if torch.cuda.is_available() else 'cpu'),
+        help='computation device, default is GPU if GPU present'
+    )
+    parser.add_argument(
+        '-st', '--square-training',
+        dest='square_training',
+        action='store_true',
+        help='resize images to square shape instead of aspect ratio resizing'
+    )
+    parser.add_argument(
+        '--raw-score-thres',
+        dest='raw_score_thres',
+        default=0.001,
+        type=float,
+        help='score threshold of the single model run'
+    )
+    parser.add_argument(
+        '--max-raw-dets',
+        dest='max_raw_dets',
+        default=1000,
+        type=int,
+        help='highest scoring raw detections kept per image before the NMS'
+    )
+    parser.add_argument(
+        '--detections-per-img',
+        dest='detections_per_img',
+        default=100,
+        type=int,
+        help='detections per image after the NMS, the model setting'
+    )
+    parser.add_argument(
+        '--nms-ious',
+        dest='nms_ious',
+        nargs='+',
+        default=[0.3, 0.4, 0.5, 0.6, 0.7],
+        type=float,
+        help='NMS IoU thresholds of the grid'
+    )
+    parser.add_argument(
+        '--thresholds',
+        nargs=3,
+        default=[0.05, 0.95, 0.05],
+        type=float,
+        metavar=('START', 'STOP', 'STEP'),
+        help='score thresholds of the grid, STOP included'
+    )
+    parser.add_argument(
+        '--save-preds',
+        dest='save_preds',
+        default=None,
+        help='save the raw detections and ground truth to this .npz file'
+    )
+    parser.add_argument(
+        '--from-preds',
+        dest='from_preds',
+        default=None,
+        help='sweep the raw detections of a --save-preds file instead of \
+              running the model'
+    )
+    parser.add_argument(
+        '--out-dir',
+        dest='out_dir',
+        default='outputs/operating_points',
+        help='directory of operating_points.csv and best_thresholds.yaml'
+    )
+    args = vars(parser.parse_args())
+    return args
+
+@torch.inference_mode()
+def run_model(model, data_loader, device):
+    """
+    Returns the per image raw detections and targets on the CPU.
+    """
+    preds, targets = [], []
+    for images, batch_targets in tqdm(data_loader, total=len(data_loader)):
+        images = [image.to(device) for image in images]
+        outputs = model(images)
+        for output, target in zip(outputs, batch_targets):
+            preds.append({
+                'boxes': output['boxes'].cpu(),
+                'scores': output['scores'].cpu(),
+                'labels': output['labels'].cpu()
+            })
+            targets.append({
+                'boxes': target['boxes'].cpu(),
+                'labels': target['labels'].cpu()
+            })
+    return preds, targets
+
+def apply_nms(preds, iou_thres, detections_per_img):
+    """
+    The class wise NMS and detection limit of the model's post processing.
+    """
+    results = []
+    for pred in preds:
+        keep = batched_nms(pred['boxes'], pred['scores'], pred['labels'], iou_thres)
+        keep = keep[:detections_per_img]
+        results.append({k: v[keep] for k, v in pred.items()})
+    return results
+
+def match(preds, targets, labels):
+    """
+    COCO matching of all the images, per class.
+
+    Returns a dictionary of class index to `(scores, tp_sum, fp_sum,
+    num_positive)`, the scores sorted from high to low and the (T, D + 1)
+    cumulative true / false positives along them (starting with 0) for
+    the IoU thresholds 0.5:0.95.
+    """
+    records = {label: [] for label in labels}
+    num_positive = {label: 0 for label in labels}
+    for pred, target in zip(preds, targets):
+        gt_boxes = xyxy_to_xywh(target['boxes'])
+        gt_labels = target['labels'].numpy()
+        dt_boxes = xyxy_to_xywh(pred['boxes'])
+        dt_scores = pred['scores'].numpy().astype(np.float64)
+        dt_labels = pred['labels'].numpy()
+        for label in labels:
+            g = gt_labels == label
+            d = dt_labels == label
+            if not g.any() and not d.any():
+                continue
+            scores, matched, ignored, positive = evaluate_image(
+                gt_boxes[g],
+                gt_boxes[g, 2] * gt_boxes[g, 3],
+                np.zeros(g.sum(), dtype=bool),
+                dt_boxes[d],
+                dt_scores[d]
+            )
+            # Area range 'all'.
+            records[label].append((scores, matched[0], ignored[0]))
+            num_positive[label] += positive[0]
+
+    results = {}
+    for label in labels:
+        if records[label]:
+            scores = np.concatenate([r[0] for r in records[label]])
+            matched = np.concatenate([r[1] for r in records[label]], axis=1)
+            ignored = np.concatenate([r[2] for r in records[label]], axis=1)
+        else:
+            scores = np.zeros(0)
+            matched = ignored = np.zeros((10, 0), dtype=bool)
+        order = np.argsort(-scores, kind='mergesort')
+        matched, ignored = matched[:, order], ignored[:, order]
+        zeros = np.zeros((matched.shape[0], 1), dtype=np.int64)
+        tp_sum = np.concatenate([zeros, np.cumsum(matched & ~ignored, axis=1)], axis=1)
+        fp_sum = np.concatenate([zeros, np.cumsum(~matched & ~ignored, axis=1)], axis=1)
+        results[label] = (scores[order], tp_sum, fp_sum, num_positive[label])
+    return results
+
+def sweep(matches, thresholds):
+    """
+    Precision, recall, F1 (IoU 0.5) and AP (IoU 0.5:0.95) of every class
+    at every score threshold.
+
+    Returns a dictionary of class index to a dictionary of (S, ) arrays,
+    the AP is -1 for classes without ground truth.
+    """
+    results = {}
+    for label, (scores, tp_sum, fp_sum, num_positive) in matches.items():
+        # Number of detections scoring at least the threshold.
+        counts = np.searchsorted(-scores, -thresholds, side='right')
+        tp, fp = tp_sum[0, counts], fp_sum[0, counts]
+        precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 0.0)
+        recall = tp / num_positive if num_positive > 0 else np.zeros(len(counts))
+        f1 = np.where(
+            precision + recall > 0,
+            2 * precision * recall / np.maximum(precision + recall, 1e-12),
+            0.0
+        )
+        ap = -np.ones(len(counts))
+        if num_positive > 0:
+            for s, count in enumerate(counts):
+                q, _ = interpolated_precision(
+                    tp_sum[:, 1:count + 1], fp_sum[:, 1:count + 1], num_positive
+                )
+                ap[s] = q.mean()
+        results[label] = {
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'ap': ap,
+            'num_positive': num_positive
+        }
+    return results
+
+def main(args):
+    with open(args['data']) as file:
+        data_configs = yaml.safe_load(file)
+    CLASSES = data_configs['CLASSES']
+    DEVICE = args['device']
+
+    if args['from_preds'] is not None:
+        preds, targets, stored_classes = load_predictions(args['from_preds'])
+        if stored_classes is not None:
+            CLASSES = stored_classes
+    else:
+        assert args['weights'] is not None, '--weights or --from-preds is required'
+        try: # Use test images if present.
+            VALID_DIR_IMAGES = data_configs['TEST_DIR_IMAGES']
+            VALID_DIR_LABELS = data_configs['TEST_DIR_LABELS']
+        except: # Else use the validation images.
+            VALID_DIR_IMAGES = data_configs['VALID_DIR_IMAGES']
+            VALID_DIR_LABELS = data_configs['VALID_DIR_LABELS']
+        model = create_model[args['model']](
+            num_classes=data_configs['NC'], coco_model=False
+        )
+        checkpoint = torch.load(args['weights'], map_location=DEVICE)
+        assert_float_checkpoint(checkpoint)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        # Raw detections, the NMS of the grid is applied afterwards.
+        model.roi_heads.score_thresh = args['raw_score_thres']
+        model.roi_heads.nms_thresh = 1.0
+        model.roi_heads.detections_per_img = args['max_raw_dets']
+        model.to(DEVICE).eval()
+        valid_dataset = create_valid_dataset(
+            VALID_DIR_IMAGES,
+            VALID_DIR_LABELS,
+            args['imgsz'],
+            CLASSES,
+            square_training=args['square_training']
+        )
+        valid_loader = create_valid_loader(
+            valid_dataset, args['batch'], args['workers']
+        )
+        preds, targets = run_model(model, valid_loader, DEVICE)
+        if args['save_preds'] is not None:
+            save_predictions(args['save_preds'], preds, targets, CLASSES)
+
+    start, stop, step = args['thresholds']
+    thresholds = np.round(np.arange(start, stop + step / 2, step), 6)
+    labels = list(range(1, len(CLASSES)))
+    rows = []
+    best = None
+    for nms_iou in args['nms_ious']:
+        results = sweep(
+            match(
+                apply_nms(preds, nms_iou, args['detections_per_img']),
+                targets,
+                labels
+            ),
+            thresholds
+        )
+        evaluated = [l for l in labels if results[l]['num_positive'] > 0]
+        for s, threshold in enumerate(thresholds):
+            for label in labels:
+                r = results[label]
+                rows.append({
+                    'nms_iou': nms_iou,
+                    'threshold': threshold,
+                    'class': CLASSES[label],
+                    'precision': r['precision'][s],
+                    'recall': r['recall'][s],
+                    'f1': r['f1'][s],
+                    'ap': r['ap'][s]
+                })
+            rows.append({
+                'nms_iou': nms_iou,
+                'threshold': threshold,
+                'class': 'all',
+                'precision': np.mean([results[l]['precision'][s] for l in evaluated]),
+                'recall': np.mean([results[l]['recall'][s] for l in evaluated]),
+                'f1': np.mean([results[l]['f1'][s] for l in evaluated]),
+                'ap': np.mean([results[l]['ap'][s] for l in evaluated])
+            })
+        # Every class at its own best threshold.
+        best_f1 = {l: int(np.argmax(results[l]['f1'])) for l in evaluated}
+        mean_f1 = np.mean([results[l]['f1'][best_f1[l]] for l in evaluated])
+        mean_ap = np.mean([results[l]['ap'][0] for l in evaluated])
+        print(
+            f"NMS IoU {nms_iou:.2f}: mAP@0.5:0.95 {mean_ap:.4f} (threshold "
+            f"{thresholds[0]:g}), mean F1 {mean_f1:.4f} at the per class "
+            f"best thresholds"
+        )
+        if best is None or mean_f1 > best[1]:
+            best = (nms_iou, mean_f1, results, best_f1)
+
+    os.makedirs(args['out_dir'], exist_ok=True)
+    csv_path = os.path.join(args['out_dir'], 'operating_points.csv')
+    pd.DataFrame(rows).to_csv(csv_path, index=False, float_format='%.6f')
+
+    nms_iou, mean_f1, results, best_f1 = best
+    print(f"\nBest NMS IoU {nms_iou:.2f}, mean F1 {mean_f1:.4f}")
+    print(f"{'class':<20} {'threshold':>9} {'precision':>9} {'recall':>9} {'f1':>9}")
+    thresholds_out = {}
+    for label, s in best_f1.items():
+        r = results[label]
+        thresholds_out[CLASSES[label]] = float(thresholds[s])
+        print(
+            f"{CLASSES[label]:<20} {thresholds[s]:>9.3f} {r['precision'][s]:>9.3f} "
+            f"{r['recall'][s]:>9.3f} {r['f1'][s]:>9.3f}"
+        )
+    yaml_path = os.path.join(args['out_dir'], 'best_thresholds.yaml')
+    with open(yaml_path, 'w') as file:
+        yaml.safe_dump({
+            'nms_iou': float(nms_iou),
+            'mean_f1': float(mean_f1),
+            'thresholds': thresholds_out
+        }, file, sort_keys=False)
+    print(f"\nGrid saved to {csv_path}, best thresholds to {yaml_path}")
+
+if __name__ == '__main__':
+    args = parse_opt()
+    main(args)
@@ -0,0 +1,184 @@
+"""
+Evaluation of the training weights in a background process for
+`train.py --async-eval`. The evaluator process has its own validation
+loader, threads and model copy. At every evaluation the main process only
+copies the weights to the CPU and continues training, the COCO stats come
+back tagged with the round they belong to.
+
+USAGE:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --async-eval --async-eval-threads 8
+"""
+
+import multiprocessing
+import queue
+import traceback
+
+import torch
+
+from datasets import create_valid_dataset, create_valid_loader
+from torch_utils.coco_utils import get_coco_api_from_dataset
+from torch_utils.engine import evaluate
+
+
+def _eval_worker(
+    model,
+    dataset_kwargs,
+    batch_size,
+    num_workers,
+    num_threads,
+    device,
+    eval_kwargs,
+    tasks,
+    results
+):
+    torch.set_num_threads(num_threads)
+    device = torch.device(device)
+    model = model.to(device).eval()
+    dataset = create_valid_dataset(**dataset_kwargs)
+    data_loader = create_valid_loader(dataset, batch_size, num_workers)
+    # Converted once for all the evaluations.
+    coco_gt = get_coco_api_from_dataset(dataset)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, state_dict = task
+        try:
+            model.load_state_dict(state_dict)
+            del state_dict
+            stats, val_saved_image = evaluate(
+                model, data_loader, device, coco_gt=coco_gt, **eval_kwargs
+            )
+        except Exception:
+            results.put((task_id, None, None, traceback.format_exc()))
+            break
+        results.put((task_id, stats, val_saved_image, None))
+
+
+class AsyncEvaluator:
+    """
+    Runs `torch_utils.engine.evaluate` in a spawned process.
+
+    :param model: Model with the structure of the trained one (not wrapped
+        in DDP), sent to the process once. Pass a CPU copy, the weights
+        are sent with every `submit`.
+    :param dataset_kwargs: Keyword arguments of `create_valid_dataset`,
+        the process builds its own validation set and loader.
+    :param batch_size: Validation batch size.
+    :param num_workers: Data loader workers of the evaluator process.
+    :param num_threads: Intra-op threads of the evaluator process,
+        (default, half of the threads of this process).
+    :param device: Device the evaluator process runs the model on.
+    :param max_pending: `submit` waits for the oldest evaluation to finish
+        when this many are queued or running, so that a slow evaluator
+        does not pile up copies of the weights.
+    :param eval_kwargs: Passed on to `evaluate` (`evaluator`,
+        `save_valid_preds`, `out_dir`, ...).
+    """
+    def __init__(
+        self,
+        model,
+        dataset_kwargs,
+        batch_size,
+        num_workers=0,
+        num_threads=None,
+        device='cpu',
+        max_pending=2,
+        **eval_kwargs
+    ):
+        if num_threads is None:
+            num_threads = max(torch.get_num_threads() // 2, 1)
+        # Spawned, the training process may hold CUDA state.
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        # Not a daemon, the evaluator may start data loader workers.
+        self.process = context.Process(
+            target=_eval_worker,
+            args=(
+                model,
+                dataset_kwargs,
+                batch_size,
+                num_workers,
+                num_threads,
+                str(device),
+                eval_kwargs,
+                self.tasks,
+                self.results
+            ),
+            name='async_eval'
+        )
+        self.process.start()
+        self.max_pending = max_pending
+        # Task id to `(tag, state_dict)` of the evaluations not returned yet.
+        self.pending = {}
+        self.finished = []
+        self.next_id = 0
+        print(
+            f"Evaluating asynchronously on {device} with {num_threads} threads"
+        )
+
+    def submit(self, tag, model):
+        """
+        Queue an evaluation of the current weights of `model`.
+
+        :param tag: Returned with the results, e.g. the epoch.
+        :param model: The trained model, not wrapped in DDP.
+        """
+        while len(self.pending) >= self.max_pending:
+            self._receive(block=True)
+        state_dict = {
+            k: v.detach().to('cpu', copy=True)
+            for k, v in model.state_dict().items()
+        }
+        self.pending[self.next_id] = (tag, state_dict)
+        self.tasks.put((self.next_id, state_dict))
+        self.next_id += 1
+
+    def _receive(self, block):
+        """
+        Move one finished evaluation to `self.finished`. Returns False if
+        there is none and `block` is not set.
+        """
+        while True:
+            try:
+                if block:
+                    task_id, stats, image, error = self.results.get(timeout=1.0)
+                else:
+                    task_id, stats, image, error = self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return False
+                if not self.process.is_alive():
+                    raise RuntimeError(
+                        f"Async evaluation process exited with code "
+                        f"{self.process.exitcode}"
+                    )
+                continue
+            if error is not None:
+                raise RuntimeError(f"Async evaluation failed:\n{error}")
+            tag, state_dict = self.pending.pop(task_id)
+            self.finished.append((tag, stats, image, state_dict))
+            return True
+
+    def poll(self):
+        """
+        Returns the evaluations finished since the last call, in submission
+        order, as `(tag, stats, val_saved_image, state_dict)` tuples where
+        `state_dict` holds the evaluated weights.
+        """
+        while self._receive(block=False):
+            pass
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        """
+        Wait for the queued evaluations, stop the evaluator process and
+        return the evaluations not returned by `poll` yet.
+        """
+        while self.pending:
+            self._receive(block=True)
+        self.tasks.put(None)
+        self.process.join()
+        return self.poll()
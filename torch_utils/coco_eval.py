@@ -1,5 +1,8 @@
 import copy
 import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import redirect_stdout
 
 import numpy as np
@@ -13,7 +16,9 @@ from pycocotools.cocoeval import COCOeval
 class CocoEvaluator:
     def __init__(self, coco_gt, iou_types):
         assert isinstance(iou_types, (list, tuple))
-        coco_gt = copy.deepcopy(coco_gt)
+        # Not copied, `COCOeval` only adds the derived `ignore` flags (and
+        # RLE masks for segm) to the ground truth annotations, the same
+        # values every time, so the cached ground truth can be shared.
         self.coco_gt = coco_gt
 
         self.iou_types = iou_types
@@ -154,20 +159,69 @@ def convert_to_xywh(boxes):
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
 
 
-def merge(img_ids, eval_imgs):
-    all_img_ids = utils.all_gather(img_ids)
-    all_eval_imgs = utils.all_gather(eval_imgs)
-
-    merged_img_ids = []
-    for p in all_img_ids:
-        merged_img_ids.extend(p)
-
-    merged_eval_imgs = []
-    for p in all_eval_imgs:
-        merged_eval_imgs.append(p)
-
-    merged_img_ids = np.array(merged_img_ids)
-    merged_eval_imgs = np.concatenate(merged_eval_imgs, 2)
+def pack_eval_imgs(eval_imgs, num_thrs):
+    """
+    Pack a (K, A, I) array of `COCOeval.evaluateImg` results into tensors:
+    (K * A * I, 3) int64 counts (result present, detections, ground
+    truths not ignored), the (D, ) float64 scores and the (D, 2 * T) uint8
+    matched and ignored flags of all the detections. Only the fields
+    `COCOeval.accumulate` reads are kept.
+    """
+    entries = eval_imgs.reshape(-1)
+    counts = np.zeros((len(entries), 3), dtype=np.int64)
+    scores = [np.zeros(0)]
+    flags = [np.zeros((0, 2 * num_thrs), dtype=np.uint8)]
+    for i, e in enumerate(entries):
+        if e is None:
+            continue
+        counts[i] = 1, len(e['dtScores']), np.count_nonzero(e['gtIgnore'] == 0)
+        scores.append(np.asarray(e['dtScores'], dtype=np.float64))
+        flags.append(np.concatenate((e['dtMatches'] > 0, e['dtIgnore']), axis=0).T)
+    return (
+        torch.from_numpy(counts),
+        torch.from_numpy(np.concatenate(scores)),
+        torch.from_numpy(np.concatenate(flags).astype(np.uint8))
+    )
+
+
+def unpack_eval_imgs(counts, scores, flags, shape):
+    """
+    Inverse of `pack_eval_imgs`, returns the array of `shape` with the
+    results as dictionaries (None where there was none).
+    """
+    num_thrs = flags.shape[1] // 2
+    counts, scores, flags = counts.numpy(), scores.numpy(), flags.numpy().astype(bool)
+    offsets = np.concatenate(([0], np.cumsum(counts[:, 1])))
+    entries = np.empty(len(counts), dtype=object)
+    for i, (present, num_dt, num_positive) in enumerate(counts):
+        if not present:
+            continue
+        start, end = offsets[i], offsets[i + 1]
+        entries[i] = {
+            'dtScores': scores[start:end],
+            'dtMatches': flags[start:end, :num_thrs].T,
+            'dtIgnore': flags[start:end, num_thrs:].T,
+            # Only the number of ground truths that are not ignored is used.
+            'gtIgnore': np.zeros(num_positive),
+        }
+    return entries.reshape(shape)
+
+
+def merge(img_ids, eval_imgs, num_thrs):
+    if utils.get_world_size() == 1:
+        merged_img_ids = np.array(img_ids)
+        merged_eval_imgs = eval_imgs
+    else:
+        # Gathered as padded tensors rather than pickled dictionaries.
+        img_ids = torch.as_tensor(np.asarray(img_ids, dtype=np.int64))
+        packed = pack_eval_imgs(eval_imgs, num_thrs)
+        all_img_ids = utils.all_gather_tensor(img_ids)
+        all_packed = zip(*[utils.all_gather_tensor(t) for t in packed])
+        merged_img_ids = torch.cat(all_img_ids).numpy()
+        merged_eval_imgs = np.concatenate([
+            unpack_eval_imgs(*p, shape=(*eval_imgs.shape[:2], len(ids)))
+            for ids, p in zip(all_img_ids, all_packed)
+        ], 2)
 
     # keep only unique (and in sorted order) images
     merged_img_ids, idx = np.unique(merged_img_ids, return_index=True)
@@ -177,7 +231,7 @@ def merge(img_ids, eval_imgs):
 
 
 def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
-    img_ids, eval_imgs = merge(img_ids, eval_imgs)
+    img_ids, eval_imgs = merge(img_ids, eval_imgs, len(coco_eval.params.iouThrs))
     img_ids = list(img_ids)
     eval_imgs = list(eval_imgs.flatten())
 
@@ -189,4 +243,111 @@ def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
 def evaluate(imgs):
     with redirect_stdout(io.StringIO()):
         imgs.evaluate()
-    return imgs.params.imgIds, np.asarray(imgs.evalImgs).reshape(-1, len(imgs.params.areaRng), len(imgs.params.imgIds))
\ No newline at end of file
+    return imgs.params.imgIds, np.asarray(imgs.evalImgs).reshape(-1, len(imgs.params.areaRng), len(imgs.params.imgIds))
+
+# Per worker process state of `ParallelCocoEvaluator`, set by
+# `_init_worker`: the ground truth and one `COCOeval` per IoU type.
+_WORKER_COCO_GT = None
+_WORKER_COCO_EVAL = {}
+
+# The pool is kept between evaluations of the same ground truth, starting
+# the worker processes takes longer than evaluating a validation set.
+_POOL = None
+_POOL_KEY = None
+
+
+def _init_worker(dataset):
+    global _WORKER_COCO_GT
+    # The workers only run pycocotools, keep them from competing with
+    # the training process for cores.
+    torch.set_num_threads(1)
+    with redirect_stdout(io.StringIO()):
+        _WORKER_COCO_GT = COCO()
+        _WORKER_COCO_GT.dataset = dataset
+        _WORKER_COCO_GT.createIndex()
+    _WORKER_COCO_EVAL.clear()
+
+
+def _evaluate_chunk(iou_type, img_ids, results):
+    coco_eval = _WORKER_COCO_EVAL.get(iou_type)
+    if coco_eval is None:
+        coco_eval = COCOeval(_WORKER_COCO_GT, iouType=iou_type)
+        _WORKER_COCO_EVAL[iou_type] = coco_eval
+    with redirect_stdout(io.StringIO()):
+        coco_dt = COCO.loadRes(_WORKER_COCO_GT, results) if results else COCO()
+    coco_eval.cocoDt = coco_dt
+    coco_eval.params.imgIds = list(img_ids)
+    return evaluate(coco_eval)
+
+
+def _get_pool(coco_gt, num_workers):
+    global _POOL, _POOL_KEY
+    key = (id(coco_gt), num_workers)
+    if _POOL is None or _POOL_KEY != key:
+        if _POOL is not None:
+            _POOL.shutdown()
+        # Spawned rather than forked, the parent may hold CUDA and
+        # OpenMP state that does not survive a fork.
+        _POOL = ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(coco_gt.dataset,)
+        )
+        _POOL_KEY = key
+    return _POOL
+
+
+class ParallelCocoEvaluator(CocoEvaluator):
+    """
+    `CocoEvaluator` that runs the pycocotools per image matching
+    (`evaluateImg`) in a pool of worker processes. `update` only converts
+    the predictions to COCO results and queues them, so the matching of
+    earlier batches overlaps with the inference of the following ones.
+    The `evalImgs` of the chunks are merged in
+    `synchronize_between_processes` and `accumulate` / `summarize` run
+    as usual.
+
+    :param coco_gt: Ground truth `COCO` object.
+    :param iou_types: List of IoU types, same as `CocoEvaluator`.
+    :param num_workers: Number of worker processes, (default, half of the
+        CPU cores divided between the distributed processes, at most 8).
+    :param chunk_size: Number of images per task sent to the workers.
+    """
+    def __init__(self, coco_gt, iou_types, num_workers=None, chunk_size=32):
+        super().__init__(coco_gt, iou_types)
+        if num_workers is None:
+            num_workers = (os.cpu_count() or 2) // 2 // utils.get_world_size()
+            num_workers = min(max(num_workers, 1), 8)
+        self.pool = _get_pool(coco_gt, num_workers)
+        self.chunk_size = chunk_size
+        self.futures = {k: [] for k in iou_types}
+        self.pending = {}
+
+    def update(self, predictions):
+        self.pending.update(predictions)
+        if len(self.pending) >= self.chunk_size:
+            self._submit()
+
+    def _submit(self):
+        if not self.pending:
+            return
+        img_ids = list(np.unique(list(self.pending.keys())))
+        for iou_type in self.iou_types:
+            results = self.prepare(self.pending, iou_type)
+            self.futures[iou_type].append(
+                self.pool.submit(_evaluate_chunk, iou_type, img_ids, results)
+            )
+        self.pending = {}
+
+    def synchronize_between_processes(self):
+        self._submit()
+        for iou_type in self.iou_types:
+            img_ids = []
+            for future in self.futures[iou_type]:
+                chunk_img_ids, eval_imgs = future.result()
+                img_ids.extend(chunk_img_ids)
+                self.eval_imgs[iou_type].append(eval_imgs)
+            self.futures[iou_type] = []
+            self.img_ids = img_ids
+        super().synchronize_between_processes()
@@ -1,5 +1,6 @@
 import copy
 import os
+import weakref
 
 import torch
 import torch.utils.data
@@ -140,6 +141,20 @@ def _coco_remove_images_without_annotations(dataset, cat_list=None):
     return dataset
 
 
+def get_annotations(ds, idx):
+    """
+    Target of `ds[idx]` and the (height, width) of its image. Uses the
+    dataset's `get_annotations` when it has one (through `Subset`s), which
+    does not decode the image.
+    """
+    if isinstance(ds, torch.utils.data.Subset):
+        return get_annotations(ds.dataset, ds.indices[idx])
+    if hasattr(ds, 'get_annotations'):
+        return ds.get_annotations(idx)
+    img, targets = ds[idx]
+    return targets, tuple(img.shape[-2:])
+
+
 def convert_to_coco_api(ds):
     coco_ds = COCO()
     # annotation IDs need to start at 1, not 0, see torchvision issue #1530
@@ -147,14 +162,12 @@ def convert_to_coco_api(ds):
     dataset = {"images": [], "categories": [], "annotations": []}
     categories = set()
     for img_idx in range(len(ds)):
-        # find better way to get target
-        # targets = ds.get_annotations(img_idx)
-        img, targets = ds[img_idx]
+        targets, (height, width) = get_annotations(ds, img_idx)
         image_id = targets["image_id"].item()
         img_dict = {}
         img_dict["id"] = image_id
-        img_dict["height"] = img.shape[-2]
-        img_dict["width"] = img.shape[-1]
+        img_dict["height"] = height
+        img_dict["width"] = width
         dataset["images"].append(img_dict)
         bboxes = targets["boxes"]
         if len(bboxes) > 0:
@@ -193,15 +206,30 @@ def convert_to_coco_api(ds):
     return coco_ds
 
 
+# Converted ground truth per dataset object, built once per run.
+_COCO_CACHE = weakref.WeakKeyDictionary()
+
+
 def get_coco_api_from_dataset(dataset):
+    """
+    COCO ground truth of `dataset`. Converted datasets are cached for as
+    long as the dataset object lives, so that `evaluate` converts the
+    validation set only once. The returned object is shared, do not
+    modify it.
+    """
+    base_dataset = dataset
     for _ in range(10):
-        if isinstance(dataset, torchvision.datasets.CocoDetection):
+        if isinstance(base_dataset, torchvision.datasets.CocoDetection):
             break
-        if isinstance(dataset, torch.utils.data.Subset):
-            dataset = dataset.dataset
-    if isinstance(dataset, torchvision.datasets.CocoDetection):
-        return dataset.coco
-    return convert_to_coco_api(dataset)
+        if isinstance(base_dataset, torch.utils.data.Subset):
+            base_dataset = base_dataset.dataset
+    if isinstance(base_dataset, torchvision.datasets.CocoDetection):
+        return base_dataset.coco
+    if dataset not in _COCO_CACHE:
+        # Convert only the images in `dataset`, not the whole dataset
+        # behind a `Subset`.
+        _COCO_CACHE[dataset] = convert_to_coco_api(dataset)
+    return _COCO_CACHE[dataset]
 
 class CocoDetection(torchvision.datasets.CocoDetection):
     def __init__(self, img_folder, ann_file, transforms):
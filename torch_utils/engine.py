@@ -5,10 +5,32 @@ import time
 import torch
 import torchvision.models.detection.mask_rcnn
 from torch_utils import utils
-from torch_utils.coco_eval import CocoEvaluator
+from torch_utils.coco_eval import CocoEvaluator, ParallelCocoEvaluator
+from torch_utils.fast_coco_eval import FastCocoEvaluator
 from torch_utils.coco_utils import get_coco_api_from_dataset
 from utils.general import save_validation_results
+from utils.feature_cache import cached_batch_to_device
+from utils.eval_utils import eval_forward
+from torch_utils.profiling import RecordIter
+from datasets import batch_to_device
+from torch.profiler import record_function
 import numpy as np
+def reduce_losses(loss_dict, reduce, nonfinite):
+    """
+    Losses to log for one step. On `reduce` steps they are averaged over
+    the processes in one `all_reduce`, together with `nonfinite`: whether
+    a local loss since the last reduction was not finite. The other steps
+    return the local losses without any communication.
+
+    Returns the losses and whether a process had a non finite loss since
+    the last reduction (always False on the other steps).
+    """
+    if not reduce:
+        return {k: v.detach() for k, v in loss_dict.items()}, False
+    flag = next(iter(loss_dict.values())).detach().new_tensor(float(nonfinite))
+    loss_dict_reduced = utils.reduce_dict({**loss_dict, 'nonfinite': flag})
+    return loss_dict_reduced, loss_dict_reduced.pop('nonfinite').item() > 0
+
 def train_one_epoch(
     model, 
     optimizer, 
@@ -18,8 +40,27 @@ def train_one_epoch(
     train_loss_hist,
     print_freq, 
     scaler=None,
-    scheduler=None
+    scheduler=None,
+    profiler=None,
+    loss_fn=None,
+    step_scheduler=None,
+    reduce_every=1
 ):
+    """
+    :param profiler: Optional profiler from `torch_utils.profiling.create_profiler`,
+        stepped once per iteration.
+    :param loss_fn: Optional `loss_fn(model, images, targets)` returning the
+        loss dictionary in place of `model(images, targets)`, e.g.
+        `utils.distillation.DistillationLoss`.
+    :param step_scheduler: Optional per iteration learning rate scheduler,
+        stepped without arguments after every optimizer step, e.g.
+        `utils.optimizer.warmup_cosine_scheduler`. It replaces the first
+        epoch warmup. `data_loader` can then be a `datasets.StepWindow`.
+    :param reduce_every: Average the logged losses over the processes
+        every this many steps (and at the last one), the other steps log
+        the losses of this process without any communication. A non
+        finite loss stops all the processes at the next reduction.
+    """
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter("lr", utils.SmoothedValue(window_size=1, fmt="{value:.6f}"))
@@ -32,8 +73,8 @@ def train_one_epoch(
     batch_loss_objectness_list = []
     batch_loss_rpn_list = []
 
-    lr_scheduler = None
-    if epoch == 0:
+    lr_scheduler = step_scheduler
+    if epoch == 0 and step_scheduler is None:
         warmup_factor = 1.0 / 1000
         warmup_iters = min(1000, len(data_loader) - 1)
 
@@ -41,26 +82,157 @@ def train_one_epoch(
             optimizer, start_factor=warmup_factor, total_iters=warmup_iters
         )
 
+    if profiler is not None:
+        data_loader = RecordIter(data_loader, 'data_wait')
+        profiler.start()
+
     step_counter = 0
-    for images, targets in metric_logger.log_every(data_loader, print_freq, header):
+    nonfinite = False
+    for batch in metric_logger.log_every(data_loader, print_freq, header):
         step_counter += 1
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device).to(torch.int64) for k, v in t.items()} for t in targets]
+        with record_function('h2d_copy'):
+            images, targets = batch_to_device(batch, device)
 
 
         with torch.cuda.amp.autocast(enabled=scaler is not None):
-            loss_dict = model(images, targets)
+            if loss_fn is not None:
+                loss_dict = loss_fn(model, images, targets)
+            else:
+                loss_dict = model(images, targets)
 #            print(loss_dict)
 #            exit()
-            losses = sum(loss for loss in loss_dict.values())
+            with record_function('loss'):
+                losses = sum(loss for loss in loss_dict.values())
 
         # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
+        with record_function('loss'):
+            reduce = step_counter % reduce_every == 0 or step_counter == len(data_loader)
+            loss_dict_reduced, nonfinite_before = reduce_losses(
+                loss_dict, reduce, nonfinite
+            )
+            losses_reduced = sum(loss for loss in loss_dict_reduced.values())
+
+            loss_value = losses_reduced.item()
+
+        # A process alone must not exit, the others would wait for it in the
+        # gradient `all_reduce`. All of them stop at the next reduction, the
+        # reduced loss is not finite if one of the local ones is not.
+        nonfinite = nonfinite or not math.isfinite(loss_value)
+        if reduce and (nonfinite or nonfinite_before):
+            print(f"Loss is {loss_value}, stopping training")
+            print(loss_dict_reduced)
+            sys.exit(1)
+
+        optimizer.zero_grad()
+        if scaler is not None:
+            with record_function('backward'):
+                scaler.scale(losses).backward()
+            with record_function('optimizer_step'):
+                scaler.step(optimizer)
+                scaler.update()
+        else:
+            with record_function('backward'):
+                losses.backward()
+            with record_function('optimizer_step'):
+                optimizer.step()
+
+        if lr_scheduler is not None:
+            lr_scheduler.step()
+
+        metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
+        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+
+        batch_loss_list.append(loss_value)
+        batch_loss_cls_list.append(loss_dict_reduced['loss_classifier'].detach().cpu())
+        batch_loss_box_reg_list.append(loss_dict_reduced['loss_box_reg'].detach().cpu())
+        batch_loss_objectness_list.append(loss_dict_reduced['loss_objectness'].detach().cpu())
+        batch_loss_rpn_list.append(loss_dict_reduced['loss_rpn_box_reg'].detach().cpu())
+        train_loss_hist.send(loss_value)
+
+        if scheduler is not None:
+            scheduler.step(epoch + (step_counter/len(data_loader)))
+
+        if profiler is not None:
+            profiler.step()
+
+    if profiler is not None:
+        profiler.stop()
+
+    return (
+        metric_logger, 
+        batch_loss_list, 
+        batch_loss_cls_list, 
+        batch_loss_box_reg_list, 
+        batch_loss_objectness_list, 
+        batch_loss_rpn_list
+    )
+
+
+def train_one_epoch_cached(
+    model,
+    optimizer,
+    data_loader,
+    device,
+    epoch,
+    train_loss_hist,
+    print_freq,
+    scaler=None,
+    scheduler=None,
+    reduce_every=1
+):
+    """
+    Same as `train_one_epoch` but trains only `model.rpn` and
+    `model.roi_heads` from backbone features cached by
+    `utils.feature_cache.FeatureCache`. The backbone is never run.
+    """
+    model.rpn.train()
+    model.roi_heads.train()
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger.add_meter("lr", utils.SmoothedValue(window_size=1, fmt="{value:.6f}"))
+    header = f"Epoch: [{epoch}]"
+
+    # List to store batch losses.
+    batch_loss_list = []
+    batch_loss_cls_list = []
+    batch_loss_box_reg_list = []
+    batch_loss_objectness_list = []
+    batch_loss_rpn_list = []
+
+    lr_scheduler = None
+    if epoch == 0:
+        warmup_factor = 1.0 / 1000
+        warmup_iters = min(1000, len(data_loader) - 1)
+
+        lr_scheduler = torch.optim.lr_scheduler.LinearLR(
+            optimizer, start_factor=warmup_factor, total_iters=warmup_iters
+        )
+
+    step_counter = 0
+    nonfinite = False
+    for batch in metric_logger.log_every(data_loader, print_freq, header):
+        step_counter += 1
+        images, features, targets = cached_batch_to_device(batch, device)
+
+        with torch.cuda.amp.autocast(enabled=scaler is not None):
+            proposals, proposal_losses = model.rpn(images, features, targets)
+            _, detector_losses = model.roi_heads(
+                features, proposals, images.image_sizes, targets
+            )
+            loss_dict = {}
+            loss_dict.update(detector_losses)
+            loss_dict.update(proposal_losses)
+            losses = sum(loss for loss in loss_dict.values())
+
+        reduce = step_counter % reduce_every == 0 or step_counter == len(data_loader)
+        loss_dict_reduced, nonfinite_before = reduce_losses(
+            loss_dict, reduce, nonfinite
+        )
         losses_reduced = sum(loss for loss in loss_dict_reduced.values())
 
         loss_value = losses_reduced.item()
 
-        if not math.isfinite(loss_value):
+        nonfinite = nonfinite or not math.isfinite(loss_value)
+        if reduce and (nonfinite or nonfinite_before):
             print(f"Loss is {loss_value}, stopping training")
             print(loss_dict_reduced)
             sys.exit(1)
@@ -91,11 +263,11 @@ def train_one_epoch(
             scheduler.step(epoch + (step_counter/len(data_loader)))
 
     return (
-        metric_logger, 
-        batch_loss_list, 
-        batch_loss_cls_list, 
-        batch_loss_box_reg_list, 
-        batch_loss_objectness_list, 
+        metric_logger,
+        batch_loss_list,
+        batch_loss_cls_list,
+        batch_loss_box_reg_list,
+        batch_loss_objectness_list,
         batch_loss_rpn_list
     )
 
@@ -112,6 +284,25 @@ def _get_iou_types(model):
     return iou_types
 
 
+# `--evaluator` choices, all take `(coco_gt, iou_types)`.
+EVALUATORS = {
+    'coco': CocoEvaluator,
+    'fast': FastCocoEvaluator,
+    'parallel': ParallelCocoEvaluator
+}
+
+
+def create_evaluator(name, coco_gt, iou_types, num_workers=None):
+    """
+    :param name: Key of `EVALUATORS`.
+    :param num_workers: Worker processes of the 'parallel' evaluator,
+        ignored by the others.
+    """
+    if name == 'parallel':
+        return ParallelCocoEvaluator(coco_gt, iou_types, num_workers=num_workers)
+    return EVALUATORS[name](coco_gt, iou_types)
+
+
 @torch.inference_mode()
 def evaluate(
     model, 
@@ -120,24 +311,46 @@ def evaluate(
     save_valid_preds=False,
     out_dir=None,
     classes=None,
-    colors=None
+    colors=None,
+    coco_gt=None,
+    profiler=None,
+    evaluator='coco',
+    eval_workers=None
 ):
+    """
+    :param evaluator: 'coco' (pycocotools), 'fast' (vectorized bbox
+        only evaluator of `torch_utils.fast_coco_eval`) or 'parallel'
+        (pycocotools matching in worker processes, overlapping with the
+        inference).
+    :param eval_workers: Number of worker processes of the 'parallel'
+        evaluator, (default, chosen from the CPU count).
+    """
     n_threads = torch.get_num_threads()
-    # FIXME remove this and make paste_masks_in_image run on the GPU
-    torch.set_num_threads(1)
+    iou_types = _get_iou_types(model)
+    if 'segm' in iou_types:
+        # FIXME remove this and make paste_masks_in_image run on the GPU
+        torch.set_num_threads(1)
     cpu_device = torch.device("cpu")
     model.eval()
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = "Test:"
 
-    coco = get_coco_api_from_dataset(data_loader.dataset)
-    iou_types = _get_iou_types(model)
-    coco_evaluator = CocoEvaluator(coco, iou_types)
+    # `coco_gt` can be passed in to avoid converting the ground truth
+    # of the same dataset again every epoch.
+    coco = coco_gt
+    if coco is None:
+        coco = get_coco_api_from_dataset(data_loader.dataset)
+    coco_evaluator = create_evaluator(evaluator, coco, iou_types, eval_workers)
+
+    if profiler is not None:
+        data_loader = RecordIter(data_loader, 'data_wait')
+        profiler.start()
 
     counter = 0
-    for images, targets in metric_logger.log_every(data_loader, 100, header):
+    for batch in metric_logger.log_every(data_loader, 100, header):
         counter += 1
-        images = list(img.to(device) for img in images)
+        with record_function('h2d_copy'):
+            images, targets = batch_to_device(batch, device)
 
         if torch.cuda.is_available():
             torch.cuda.synchronize()
@@ -149,7 +362,8 @@ def evaluate(
 
         res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
         evaluator_time = time.time()
-        coco_evaluator.update(res)
+        with record_function('coco_eval'):
+            coco_evaluator.update(res)
         evaluator_time = time.time() - evaluator_time
         metric_logger.update(model_time=model_time, evaluator_time=evaluator_time)
 
@@ -162,7 +376,12 @@ def evaluate(
             )
         elif save_valid_preds == False and counter == 1:
             val_saved_image = np.ones((1, 64, 64, 3))
-            
+
+        if profiler is not None:
+            profiler.step()
+
+    if profiler is not None:
+        profiler.stop()
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -174,3 +393,116 @@ def evaluate(
     stats = coco_evaluator.summarize()
     torch.set_num_threads(n_threads)
     return stats, val_saved_image
+
+
+@torch.inference_mode()
+def validate(
+    model,
+    data_loader,
+    device,
+    val_loss_hist=None,
+    save_valid_preds=False,
+    out_dir=None,
+    classes=None,
+    colors=None,
+    print_freq=100,
+    coco_gt=None,
+    evaluator='coco',
+    eval_workers=None
+):
+    """
+    Single pass validation. Runs one backbone forward per batch through
+    `utils.eval_utils.eval_forward` and returns both the COCO stats and the
+    per component validation losses.
+
+    Returns the same `stats, val_saved_image` as `evaluate` followed by the
+    same five batch loss lists as `train_one_epoch`.
+
+    :param evaluator: 'coco', 'fast' or 'parallel', see `evaluate`.
+    :param eval_workers: Worker processes of the 'parallel' evaluator.
+    """
+    n_threads = torch.get_num_threads()
+    iou_types = _get_iou_types(model)
+    if 'segm' in iou_types:
+        # FIXME remove this and make paste_masks_in_image run on the GPU
+        torch.set_num_threads(1)
+    cpu_device = torch.device("cpu")
+    model_without_ddp = model
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        model_without_ddp = model.module
+    model_without_ddp.eval()
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = "Validation:"
+
+    coco = coco_gt
+    if coco is None:
+        coco = get_coco_api_from_dataset(data_loader.dataset)
+    coco_evaluator = create_evaluator(evaluator, coco, iou_types, eval_workers)
+
+    # List to store batch losses.
+    batch_loss_list = []
+    batch_loss_cls_list = []
+    batch_loss_box_reg_list = []
+    batch_loss_objectness_list = []
+    batch_loss_rpn_list = []
+
+    counter = 0
+    for batch in metric_logger.log_every(data_loader, print_freq, header):
+        counter += 1
+        images, targets = batch_to_device(batch, device)
+        loss_targets = [
+            {'boxes': t['boxes'], 'labels': t['labels']} for t in targets
+        ]
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        model_time = time.time()
+        loss_dict, outputs = eval_forward(model_without_ddp, images, loss_targets)
+
+        outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
+        model_time = time.time() - model_time
+
+        loss_dict_reduced = utils.reduce_dict(loss_dict)
+        losses_reduced = sum(loss for loss in loss_dict_reduced.values())
+        loss_value = losses_reduced.item()
+
+        res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
+        evaluator_time = time.time()
+        coco_evaluator.update(res)
+        evaluator_time = time.time() - evaluator_time
+        metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
+        metric_logger.update(model_time=model_time, evaluator_time=evaluator_time)
+
+        batch_loss_list.append(loss_value)
+        batch_loss_cls_list.append(loss_dict_reduced['loss_classifier'].detach().cpu())
+        batch_loss_box_reg_list.append(loss_dict_reduced['loss_box_reg'].detach().cpu())
+        batch_loss_objectness_list.append(loss_dict_reduced['loss_objectness'].detach().cpu())
+        batch_loss_rpn_list.append(loss_dict_reduced['loss_rpn_box_reg'].detach().cpu())
+        if val_loss_hist is not None:
+            val_loss_hist.send(loss_value)
+
+        if save_valid_preds and counter == 1:
+            val_saved_image = save_validation_results(
+                images, outputs, counter, out_dir, classes, colors
+            )
+        elif save_valid_preds == False and counter == 1:
+            val_saved_image = np.ones((1, 64, 64, 3))
+
+    # gather the stats from all processes
+    metric_logger.synchronize_between_processes()
+    print("Averaged stats:", metric_logger)
+    coco_evaluator.synchronize_between_processes()
+
+    # accumulate predictions from all images
+    coco_evaluator.accumulate()
+    stats = coco_evaluator.summarize()
+    torch.set_num_threads(n_threads)
+    return (
+        stats,
+        val_saved_image,
+        batch_loss_list,
+        batch_loss_cls_list,
+        batch_loss_box_reg_list,
+        batch_loss_objectness_list,
+        batch_loss_rpn_list
+    )
@@ -0,0 +1,521 @@
+"""
+Vectorized COCO bounding box evaluation in NumPy, a drop in for
+`pycocotools.cocoeval.COCOeval` on `iouType='bbox'` that gives the same
+12 summary metrics.
+
+The matching is done per image as predictions arrive (no `COCO.loadRes`
+and no per detection Python loops over thresholds and ground truths):
+one IoU matrix per image and class, and the greedy COCO matching runs
+once per detection for all IoU thresholds and area ranges at the same
+time. The precision / recall curves are built with cumulative sums over
+the score sorted matches of all images.
+
+- `FastCocoEvaluator`: same interface as `torch_utils.coco_eval.CocoEvaluator`,
+  `evaluate(..., evaluator='fast')` in the engine.
+- `FastMeanAveragePrecision`: same interface and output keys as
+  `torchmetrics.detection.mean_ap.MeanAveragePrecision`, for `eval.py`.
+- `StreamingMeanAveragePrecision`: same as `FastMeanAveragePrecision` with
+  memory that does not grow with the number of images, the matches are
+  kept as per class score histograms.
+
+USAGE:
+python eval.py --data data_configs/voc.yaml --weights outputs/training/res_1/best_model.pth --model fasterrcnn_resnet50_fpn_v2 --evaluator fast
+"""
+
+import numpy as np
+import torch
+
+from torch_utils import utils
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_THRESHOLDS = np.linspace(0.0, 1.0, 101)
+MAX_DETS = (1, 10, 100)
+# all, small, medium, large.
+AREA_RANGES = np.array([
+    [0 ** 2, 1e5 ** 2],
+    [0 ** 2, 32 ** 2],
+    [32 ** 2, 96 ** 2],
+    [96 ** 2, 1e5 ** 2]
+])
+
+def box_iou_xywh(dt, gt, gt_crowd):
+    """
+    IoU matrix (D, G) of xywh boxes, as `pycocotools.mask.iou`. For crowd
+    ground truths the intersection is divided by the detection area.
+    """
+    dx, dy, dw, dh = (dt[:, i, None] for i in range(4))
+    gx, gy, gw, gh = (gt[None, :, i] for i in range(4))
+    w = np.minimum(dw + dx, gw + gx) - np.maximum(dx, gx)
+    h = np.minimum(dh + dy, gh + gy) - np.maximum(dy, gy)
+    inter = np.where((w > 0) & (h > 0), w * h, 0.0)
+    da = dw * dh
+    union = np.where(gt_crowd[None], da, da + gw * gh - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(inter > 0, inter / union, 0.0)
+
+def evaluate_image(gt_boxes, gt_area, gt_crowd, dt_boxes, dt_scores):
+    """
+    COCO matching of the detections of one class in one image, for all
+    IoU thresholds and area ranges (`COCOeval.evaluateImg`).
+
+    :param gt_boxes: (G, 4) xywh float64.
+    :param gt_area: (G, ) ground truth areas.
+    :param gt_crowd: (G, ) bool crowd flags.
+    :param dt_boxes: (D, 4) xywh float64, in output order.
+    :param dt_scores: (D, ) float64.
+
+    Returns the detection scores (sorted, at most `MAX_DETS[-1]`), the
+    (A, T, D) matched and ignored flags of the detections and the (A, )
+    number of ground truths that are not ignored.
+    """
+    num_areas, num_thrs = len(AREA_RANGES), len(IOU_THRESHOLDS)
+    order = np.argsort(-dt_scores, kind='mergesort')[:MAX_DETS[-1]]
+    dt_boxes, dt_scores = dt_boxes[order], dt_scores[order]
+    num_dt, num_gt = len(dt_scores), len(gt_area)
+    low, high = AREA_RANGES[:, 0, None], AREA_RANGES[:, 1, None]
+
+    gt_ignore = gt_crowd[None] | (gt_area[None] < low) | (gt_area[None] > high)
+    dt_area = dt_boxes[:, 2] * dt_boxes[:, 3]
+    dt_outside = (dt_area[None] < low) | (dt_area[None] > high)
+    matched = np.zeros((num_areas, num_thrs, num_dt), dtype=bool)
+    matched_ignored = np.zeros((num_areas, num_thrs, num_dt), dtype=bool)
+
+    if num_dt > 0 and num_gt > 0:
+        ious = box_iou_xywh(dt_boxes, gt_boxes, gt_crowd)
+        thresholds = np.minimum(IOU_THRESHOLDS, 1 - 1e-10)[None, :, None]
+        gt_taken = np.zeros((num_areas, num_thrs, num_gt), dtype=bool)
+        ignore = gt_ignore[:, None, :]
+        area_idx, thr_idx = np.indices((num_areas, num_thrs))
+        for d in range(num_dt):
+            iou = ious[d]
+            # Crowd ground truths can match any number of detections.
+            candidates = (iou >= thresholds) & (~gt_taken | gt_crowd)
+            # Ground truths that are not ignored come first, the highest
+            # IoU wins with ties going to the last one (`evaluateImg`).
+            best = []
+            for group in (candidates & ~ignore, candidates & ignore):
+                values = np.where(group, iou, -np.inf)[..., ::-1]
+                best.append((num_gt - 1 - values.argmax(-1), group.any(-1)))
+            (m_main, has_main), (m_ignored, has_ignored) = best
+            m = np.where(has_main, m_main, m_ignored)
+            has = has_main | has_ignored
+            matched[..., d] = has
+            matched_ignored[..., d] = has & ~has_main
+            gt_taken[area_idx[has], thr_idx[has], m[has]] = True
+    dt_ignored = matched_ignored | (~matched & dt_outside[:, None, :])
+    return dt_scores, matched, dt_ignored, (~gt_ignore).sum(1)
+
+def interpolated_precision(tp_sum, fp_sum, num_positive):
+    """
+    COCO precision at `RECALL_THRESHOLDS` from cumulative true / false
+    positive counts along the score sorted detections.
+
+    :param tp_sum: (T, D) cumulative true positives.
+    :param fp_sum: (T, D) cumulative false positives.
+    :param num_positive: Number of ground truths that are not ignored.
+
+    Returns the (T, R) precision and the (T, ) final recall.
+    """
+    num_thrs, num_dt = tp_sum.shape
+    q = np.zeros((num_thrs, len(RECALL_THRESHOLDS)))
+    if num_dt == 0:
+        return q, np.zeros(num_thrs)
+    tp_sum, fp_sum = tp_sum.astype(float), fp_sum.astype(float)
+    rc = tp_sum / num_positive
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    # Precision envelope, non increasing with recall.
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+    for t in range(num_thrs):
+        inds = np.searchsorted(rc[t], RECALL_THRESHOLDS, side='left')
+        valid = inds < num_dt
+        q[t, valid] = pr[t, inds[valid]]
+    return q, rc[:, -1]
+
+class FastCOCOeval:
+    """
+    Incremental COCO bbox evaluation over per image arrays.
+
+    :param cat_ids: Evaluated category ids, detections of other
+        categories are ignored.
+    """
+    def __init__(self, cat_ids):
+        self.cat_ids = list(cat_ids)
+        # image id -> {category id: `evaluate_image` output}
+        self.eval_imgs = {}
+        self.precision = None
+        self.recall = None
+        self.stats = None
+
+    def add_image(
+        self,
+        image_id,
+        gt_boxes,
+        gt_labels,
+        gt_area,
+        gt_crowd,
+        dt_boxes,
+        dt_scores,
+        dt_labels
+    ):
+        """
+        Match the detections of one image. Boxes are xywh float64.
+        """
+        evals = {}
+        for cat_id in np.union1d(gt_labels, dt_labels):
+            cat_id = int(cat_id)
+            if cat_id not in self.cat_ids:
+                continue
+            g = gt_labels == cat_id
+            d = dt_labels == cat_id
+            evals[cat_id] = evaluate_image(
+                gt_boxes[g], gt_area[g], gt_crowd[g], dt_boxes[d], dt_scores[d]
+            )
+        self.eval_imgs[image_id] = evals
+
+    def synchronize_between_processes(self):
+        """
+        Merge the matches of all processes, an image evaluated on more
+        than one process (sampler padding) is counted once.
+        """
+        if utils.get_world_size() == 1:
+            return
+        merged = {}
+        packed = zip(*[utils.all_gather_tensor(t) for t in self._pack()])
+        for keys, scores, flags in packed:
+            offsets = np.concatenate(([0], np.cumsum(keys[:, 2].numpy())))
+            flags = flags.numpy().astype(bool).reshape(
+                len(scores), 2, len(AREA_RANGES), len(IOU_THRESHOLDS)
+            )
+            for i, key in enumerate(keys.numpy()):
+                image_id, cat_id = int(key[0]), int(key[1])
+                if cat_id in merged.setdefault(image_id, {}):
+                    continue
+                d = slice(offsets[i], offsets[i + 1])
+                merged[image_id][cat_id] = (
+                    scores[d].numpy(),
+                    flags[d, 0].transpose(1, 2, 0),
+                    flags[d, 1].transpose(1, 2, 0),
+                    key[3:]
+                )
+        self.eval_imgs = merged
+
+    def _pack(self):
+        """
+        The matches as tensors: (N, 3 + A) int64 image id, category id,
+        number of detections and ground truths that are not ignored of
+        the N image and category pairs, the (D, ) float64 scores and the
+        (D, 2 * A * T) uint8 matched and ignored flags of the detections.
+        """
+        num_flags = 2 * len(AREA_RANGES) * len(IOU_THRESHOLDS)
+        keys = [np.zeros((0, 3 + len(AREA_RANGES)), dtype=np.int64)]
+        scores = [np.zeros(0)]
+        flags = [np.zeros((0, num_flags), dtype=np.uint8)]
+        for image_id, evals in self.eval_imgs.items():
+            for cat_id, (dt_scores, matched, ignored, num_positive) in evals.items():
+                keys.append(np.array(
+                    [[image_id, cat_id, len(dt_scores), *num_positive]],
+                    dtype=np.int64
+                ))
+                scores.append(dt_scores)
+                flags.append(
+                    np.stack((matched, ignored)).transpose(3, 0, 1, 2)
+                    .reshape(len(dt_scores), num_flags)
+                )
+        return (
+            torch.from_numpy(np.concatenate(keys)),
+            torch.from_numpy(np.concatenate(scores).astype(np.float64)),
+            torch.from_numpy(np.concatenate(flags).astype(np.uint8))
+        )
+
+    def accumulate(self):
+        """
+        Precision (T, R, K, A, M) and recall (T, K, A, M) arrays, -1 where
+        undefined, as `COCOeval.accumulate`.
+        """
+        num_thrs, num_recall = len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS)
+        num_areas, num_max_dets = len(AREA_RANGES), len(MAX_DETS)
+        precision = -np.ones(
+            (num_thrs, num_recall, len(self.cat_ids), num_areas, num_max_dets)
+        )
+        recall = -np.ones((num_thrs, len(self.cat_ids), num_areas, num_max_dets))
+        # Concatenated in image id order, like the `COCOeval` image list,
+        # so that score ties are broken the same way.
+        image_ids = sorted(self.eval_imgs)
+        for k, cat_id in enumerate(self.cat_ids):
+            records = [
+                self.eval_imgs[image_id][cat_id] for image_id in image_ids
+                if cat_id in self.eval_imgs[image_id]
+            ]
+            if not records:
+                continue
+            num_positive = np.sum([r[3] for r in records], axis=0)
+            for m, max_det in enumerate(MAX_DETS):
+                scores = np.concatenate([r[0][:max_det] for r in records])
+                order = np.argsort(-scores, kind='mergesort')
+                matched = np.concatenate(
+                    [r[1][..., :max_det] for r in records], axis=-1
+                )[..., order]
+                ignored = np.concatenate(
+                    [r[2][..., :max_det] for r in records], axis=-1
+                )[..., order]
+                for a in range(num_areas):
+                    if num_positive[a] == 0:
+                        continue
+                    tps = matched[a] & ~ignored[a]
+                    fps = ~matched[a] & ~ignored[a]
+                    q, rc = interpolated_precision(
+                        np.cumsum(tps, axis=1), np.cumsum(fps, axis=1),
+                        num_positive[a]
+                    )
+                    precision[:, :, k, a, m] = q
+                    recall[:, k, a, m] = rc
+        self.precision = precision
+        self.recall = recall
+
+    def _summarize(self, ap=True, iou_thr=None, area=0, max_det=2, cat=None):
+        s = self.precision if ap else self.recall
+        if iou_thr is not None:
+            s = s[np.where(np.isclose(IOU_THRESHOLDS, iou_thr))[0]]
+        # Category axis 2 for the precision, 1 for the recall.
+        s = s[..., area, max_det]
+        if cat is not None:
+            s = s[:, :, cat] if ap else s[:, cat]
+        s = s[s > -1]
+        return -1.0 if len(s) == 0 else float(np.mean(s))
+
+    def summarize(self, verbose=True):
+        """
+        The 12 COCO metrics, printed like `COCOeval.summarize`.
+        """
+        metrics = [
+            (True, None, 0, 2), (True, 0.5, 0, 2), (True, 0.75, 0, 2),
+            (True, None, 1, 2), (True, None, 2, 2), (True, None, 3, 2),
+            (False, None, 0, 0), (False, None, 0, 1), (False, None, 0, 2),
+            (False, None, 1, 2), (False, None, 2, 2), (False, None, 3, 2)
+        ]
+        area_names = ('all', 'small', 'medium', 'large')
+        stats = np.zeros(len(metrics))
+        for i, (ap, iou_thr, area, max_det) in enumerate(metrics):
+            stats[i] = self._summarize(ap, iou_thr, area, max_det)
+            if verbose:
+                title = 'Average Precision' if ap else 'Average Recall'
+                kind = '(AP)' if ap else '(AR)'
+                iou = '0.50:0.95' if iou_thr is None else f"{iou_thr:0.2f}"
+                print(
+                    f" {title:<18} {kind} @[ IoU={iou:<9} | "
+                    f"area={area_names[area]:>6s} | maxDets={MAX_DETS[max_det]:>3d} ] "
+                    f"= {stats[i]:0.3f}"
+                )
+        self.stats = stats
+        return stats
+
+def xyxy_to_xywh(boxes):
+    # In float32 like `CocoEvaluator`, the widths and heights are then
+    # exactly the values pycocotools reads back.
+    boxes = boxes.float()
+    boxes = torch.cat([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], dim=1)
+    return boxes.numpy().astype(np.float64)
+
+class FastCocoEvaluator:
+    """
+    Drop in for `torch_utils.coco_eval.CocoEvaluator`, bbox only.
+
+    :param coco_gt: Ground truth `COCO` object, not modified.
+    :param iou_types: ['bbox'].
+    """
+    def __init__(self, coco_gt, iou_types):
+        assert list(iou_types) == ['bbox'], \
+            f"The fast evaluator only supports bbox evaluation, got {iou_types}"
+        self.coco_gt = coco_gt
+        self.iou_types = iou_types
+        self.coco_eval = FastCOCOeval(sorted(coco_gt.getCatIds()))
+        self.img_ids = []
+
+    def _ground_truth(self, image_id):
+        anns = self.coco_gt.imgToAnns.get(image_id, [])
+        boxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+        labels = np.array([ann['category_id'] for ann in anns], dtype=np.int64)
+        area = np.array([ann['area'] for ann in anns], dtype=np.float64)
+        crowd = np.array([bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool)
+        return boxes, labels, area, crowd
+
+    def update(self, predictions):
+        for image_id, prediction in predictions.items():
+            self.img_ids.append(image_id)
+            self.coco_eval.add_image(
+                image_id,
+                *self._ground_truth(image_id),
+                xyxy_to_xywh(prediction['boxes']),
+                prediction['scores'].numpy().astype(np.float64),
+                prediction['labels'].numpy()
+            )
+
+    def synchronize_between_processes(self):
+        self.coco_eval.synchronize_between_processes()
+
+    def accumulate(self):
+        self.coco_eval.accumulate()
+
+    def summarize(self):
+        print('IoU metric: bbox')
+        return self.coco_eval.summarize()
+
+class FastMeanAveragePrecision:
+    """
+    Drop in for `torchmetrics.detection.mean_ap.MeanAveragePrecision`
+    (xyxy boxes, bbox) returning the same keys from `compute`. The classes
+    are the labels of the targets and the predictions, the ground truth
+    areas are the box areas.
+
+    :param class_metrics: Also compute `map_per_class` and
+        `mar_100_per_class`.
+    """
+    def __init__(self, class_metrics=False):
+        self.class_metrics = class_metrics
+        self.preds = []
+        self.target = []
+
+    def update(self, preds, target):
+        # Matched in `compute`, when all the classes are known.
+        self.preds.extend(preds)
+        self.target.extend(target)
+
+    def compute(self):
+        labels = [t['labels'] for t in self.target] + [p['labels'] for p in self.preds]
+        classes = torch.cat(labels).unique().tolist() if labels else []
+        coco_eval = FastCOCOeval(classes)
+        for image_id, (pred, target) in enumerate(zip(self.preds, self.target)):
+            gt_boxes = xyxy_to_xywh(target['boxes'])
+            crowd = target.get('iscrowd', torch.zeros(len(gt_boxes)))
+            coco_eval.add_image(
+                image_id,
+                gt_boxes,
+                target['labels'].numpy(),
+                gt_boxes[:, 2] * gt_boxes[:, 3],
+                crowd.numpy().astype(bool),
+                xyxy_to_xywh(pred['boxes']),
+                pred['scores'].numpy().astype(np.float64),
+                pred['labels'].numpy()
+            )
+        coco_eval.accumulate()
+        return _metric_results(coco_eval, classes, self.class_metrics)
+
+def _metric_results(coco_eval, classes, class_metrics):
+    """
+    `MeanAveragePrecision.compute` style dictionary of an accumulated
+    `FastCOCOeval`.
+    """
+    stats = coco_eval.summarize(verbose=False)
+    keys = [
+        'map', 'map_50', 'map_75', 'map_small', 'map_medium', 'map_large',
+        'mar_1', 'mar_10', 'mar_100', 'mar_small', 'mar_medium', 'mar_large'
+    ]
+    results = {
+        key: torch.tensor(value, dtype=torch.float32)
+        for key, value in zip(keys, stats)
+    }
+    map_per_class = torch.tensor([-1.0])
+    mar_100_per_class = torch.tensor([-1.0])
+    if class_metrics:
+        map_per_class = torch.tensor([
+            coco_eval._summarize(True, cat=k) for k in range(len(classes))
+        ], dtype=torch.float32)
+        mar_100_per_class = torch.tensor([
+            coco_eval._summarize(False, cat=k) for k in range(len(classes))
+        ], dtype=torch.float32)
+    results['map_per_class'] = map_per_class
+    results['mar_100_per_class'] = mar_100_per_class
+    results['classes'] = torch.tensor(classes, dtype=torch.int32)
+    return results
+
+class StreamingMeanAveragePrecision:
+    """
+    `FastMeanAveragePrecision` with flat memory. Every `update` matches
+    its images right away and per class only keeps the true and false
+    positive counts of the detections in `num_bins` score bins (for the
+    AP), the true positive counts of the top `MAX_DETS` detections per
+    image (for the AR) and the ground truth counts, per area range and
+    IoU threshold.
+
+    Detections in the same score bin count as tied, so the AP can differ
+    from pycocotools by up to about 1e-3 with 1000 bins (more when many
+    scores are exactly tied, pycocotools then breaks the ties by image
+    order). The recalls are exact.
+
+    :param class_metrics: Also compute `map_per_class` and
+        `mar_100_per_class`.
+    :param num_bins: Number of score bins over [0, 1].
+    """
+    def __init__(self, class_metrics=False, num_bins=1000):
+        self.class_metrics = class_metrics
+        self.num_bins = num_bins
+        # label -> (tp histogram (A, T, bins), fp histogram (A, T, bins),
+        # tp counts (A, T, len(MAX_DETS)), ground truth counts (A, )).
+        self.counts = {}
+
+    def _class_counts(self, label):
+        if label not in self.counts:
+            num_areas, num_thrs = len(AREA_RANGES), len(IOU_THRESHOLDS)
+            self.counts[label] = (
+                np.zeros((num_areas, num_thrs, self.num_bins), dtype=np.int64),
+                np.zeros((num_areas, num_thrs, self.num_bins), dtype=np.int64),
+                np.zeros((num_areas, num_thrs, len(MAX_DETS)), dtype=np.int64),
+                np.zeros(num_areas, dtype=np.int64)
+            )
+        return self.counts[label]
+
+    def update(self, preds, target):
+        for pred, gt in zip(preds, target):
+            gt_boxes = xyxy_to_xywh(gt['boxes'])
+            gt_labels = gt['labels'].numpy()
+            gt_area = gt_boxes[:, 2] * gt_boxes[:, 3]
+            gt_crowd = gt.get('iscrowd', torch.zeros(len(gt_boxes)))
+            gt_crowd = gt_crowd.numpy().astype(bool)
+            dt_boxes = xyxy_to_xywh(pred['boxes'])
+            dt_scores = pred['scores'].numpy().astype(np.float64)
+            dt_labels = pred['labels'].numpy()
+            for label in np.union1d(gt_labels, dt_labels).tolist():
+                g = gt_labels == label
+                d = dt_labels == label
+                scores, matched, ignored, num_positive = evaluate_image(
+                    gt_boxes[g], gt_area[g], gt_crowd[g], dt_boxes[d], dt_scores[d]
+                )
+                tp_hist, fp_hist, tp_counts, gt_counts = self._class_counts(label)
+                gt_counts += num_positive
+                tps = matched & ~ignored
+                fps = ~matched & ~ignored
+                bins = np.clip(
+                    (scores * self.num_bins).astype(np.int64), 0, self.num_bins - 1
+                )
+                np.add.at(tp_hist, (slice(None), slice(None), bins), tps)
+                np.add.at(fp_hist, (slice(None), slice(None), bins), fps)
+                for m, max_det in enumerate(MAX_DETS):
+                    tp_counts[..., m] += tps[..., :max_det].sum(-1)
+
+    def compute(self):
+        classes = sorted(self.counts)
+        num_thrs, num_recall = len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS)
+        num_areas, num_max_dets = len(AREA_RANGES), len(MAX_DETS)
+        # Only the AP at the largest `MAX_DETS` is reported, the other
+        # precision entries stay undefined.
+        precision = -np.ones(
+            (num_thrs, num_recall, len(classes), num_areas, num_max_dets)
+        )
+        recall = -np.ones((num_thrs, len(classes), num_areas, num_max_dets))
+        for k, label in enumerate(classes):
+            tp_hist, fp_hist, tp_counts, gt_counts = self.counts[label]
+            for a in range(num_areas):
+                if gt_counts[a] == 0:
+                    continue
+                # Highest score bin first.
+                q, _ = interpolated_precision(
+                    np.cumsum(tp_hist[a, :, ::-1], axis=1),
+                    np.cumsum(fp_hist[a, :, ::-1], axis=1),
+                    gt_counts[a]
+                )
+                precision[:, :, k, a, -1] = q
+                recall[:, k, a] = tp_counts[a] / gt_counts[a]
+        coco_eval = FastCOCOeval(classes)
+        coco_eval.precision = precision
+        coco_eval.recall = recall
+        return _metric_results(coco_eval, classes, self.class_metrics)
@@ -0,0 +1,97 @@
+"""
+torch.profiler helpers for `train_one_epoch` and `evaluate`.
+
+The training and evaluation loops mark their phases with
+`record_function` ranges (data_wait, h2d_copy, loss, backward,
+optimizer_step). `add_module_ranges` adds the backbone, rpn and
+roi_heads ranges around the model forward passes. The profiler exports
+a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev) and a
+table of the top operators to the output directory.
+"""
+
+import os
+import torch
+
+from torch.profiler import profile, schedule, ProfilerActivity, record_function
+
+MODULE_RANGES = ('backbone', 'rpn', 'roi_heads')
+
+def create_profiler(out_dir, name, wait=5, warmup=2, active=5, row_limit=30):
+    """
+    Profiler recording one window of `active` steps after skipping `wait`
+    steps and `warmup` steps. Call `start()` before the loop, `step()` at
+    the end of every iteration and `stop()` after the loop. An epoch
+    shorter than the window exports what was recorded.
+
+    :param out_dir: Directory for `<name>_trace.json` and `<name>_top_ops.txt`.
+    :param name: Prefix of the exported files, e.g. 'train' or 'eval'.
+    :param row_limit: Number of operators in the summary table.
+    """
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    def trace_handler(prof):
+        trace_path = os.path.join(out_dir, f"{name}_trace.json")
+        prof.export_chrome_trace(trace_path)
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() \
+            else 'self_cpu_time_total'
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=row_limit)
+        table_path = os.path.join(out_dir, f"{name}_top_ops.txt")
+        with open(table_path, 'w') as f:
+            f.write(table)
+        print(f"Profiler trace saved to {trace_path}")
+        print(f"Profiler summary saved to {table_path}")
+
+    return profile(
+        activities=activities,
+        schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=trace_handler
+    )
+
+def add_module_ranges(model, names=MODULE_RANGES):
+    """
+    Wrap the forward pass of each submodule in `names` (if the model has it)
+    in a `record_function` range of the same name.
+
+    Returns the hook handles, call `remove()` on them to take the ranges out.
+    """
+    handles = []
+    for name in names:
+        module = getattr(model, name, None)
+        if module is None:
+            continue
+        ranges = []
+
+        def pre_hook(module, inputs, name=name, ranges=ranges):
+            ranges.append(record_function(name))
+            ranges[-1].__enter__()
+
+        def post_hook(module, inputs, outputs, ranges=ranges):
+            ranges.pop().__exit__(None, None, None)
+
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(post_hook))
+    return handles
+
+class RecordIter:
+    """
+    Iterable over `iterable` that records the time spent waiting for each
+    item in a range named `name`.
+    """
+    def __init__(self, iterable, name='data_wait'):
+        self.iterable = iterable
+        self.name = name
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            with record_function(self.name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
@@ -34,7 +34,9 @@ class SmoothedValue:
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        # gloo (CPU) process groups can only reduce CPU tensors.
+        device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -85,6 +87,35 @@ def all_gather(data):
     return data_list
 
 
+def all_gather_tensor(tensor):
+    """
+    Run all_gather on tensors whose first dimension differs between
+    processes, without pickling. The sizes are gathered first, every
+    tensor is padded to the largest one and the padding is cut off again.
+    Args:
+        tensor: tensor of the same dtype and trailing dimensions on all ranks
+    Returns:
+        list[Tensor]: list of the tensors of each rank, on the device of `tensor`
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [tensor]
+    # gloo (CPU) process groups can only gather CPU tensors.
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    local = tensor.to(device)
+    size = torch.tensor([local.shape[0]], dtype=torch.int64, device=device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+    max_size = max(sizes)
+    if local.shape[0] < max_size:
+        padding = local.new_zeros((max_size - local.shape[0], *local.shape[1:]))
+        local = torch.cat((local, padding), dim=0)
+    tensor_list = [torch.empty_like(local) for _ in range(world_size)]
+    dist.all_gather(tensor_list, local)
+    return [t[:s].to(tensor.device) for t, s in zip(tensor_list, sizes)]
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -259,6 +290,18 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def broadcast_object(obj, src=0):
+    """
+    Send a picklable object from rank `src` to all the processes. Returns
+    `obj` unchanged when not running distributed.
+    """
+    if not is_dist_avail_and_initialized():
+        return obj
+    object_list = [obj]
+    dist.broadcast_object_list(object_list, src=src)
+    return object_list[0]
+
+
 def init_distributed_mode(args):
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
         args['rank'] = int(os.environ["RANK"])
@@ -266,7 +309,7 @@ def init_distributed_mode(args):
         args['gpu'] = int(os.environ["LOCAL_RANK"])
     elif "SLURM_PROCID" in os.environ:
         args['rank'] = int(os.environ["SLURM_PROCID"])
-        args['gpu'] = args['rank'] % torch.cuda.device_count()
+        args['gpu'] = args['rank'] % max(torch.cuda.device_count(), 1)
     else:
         print("Not using distributed mode")
         args['distributed'] = False
@@ -274,8 +317,18 @@ def init_distributed_mode(args):
 
     args['distributed'] = True
 
-    torch.cuda.set_device(args['gpu'])
-    args['dist_backend'] = "nccl"
+    if str(args.get('device', 'cuda')).startswith('cpu'):
+        # CPU data parallel training. Every process gets an equal share of
+        # the cores for its intra-op thread pool instead of all processes
+        # oversubscribing every core.
+        args['dist_backend'] = "gloo"
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", args['world_size']))
+        num_threads = args.get('cpu_threads') or max(1, (os.cpu_count() or 1) // local_world_size)
+        torch.set_num_threads(num_threads)
+        print(f"| rank {args['rank']}: {num_threads} intra-op threads", flush=True)
+    else:
+        torch.cuda.set_device(args['gpu'])
+        args['dist_backend'] = "nccl"
     print(f"| distributed init (rank {args['rank']}): {args['dist_url']}", flush=True)
     torch.distributed.init_process_group(
         backend=args['dist_backend'], init_method=args['dist_url'], world_size=args['world_size'], rank=args['rank']
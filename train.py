@@ -10,28 +10,91 @@ python train.py --model fasterrcnn_resnet50_fpn --epochs 2 --data data_configs/v
 # Training on ResNet50 FPN with custom project folder name with mosaic augmentation (ON by default) and added training augmentations:
 python train.py --model fasterrcnn_resnet50_fpn --epochs 2 --use-train-aug --data data_configs/voc.yaml --name resnet50fpn_voc --batch 4
 
+# Fine-tuning only the RPN and RoI heads from cached backbone features:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --weights outputs/training/res_1/last_model.pth --cache-features --data data_configs/voc.yaml --batch 8
+
+# Distilling a trained large model into a small one:
+python train.py --model fasterrcnn_nano --data data_configs/voc.yaml --teacher-model fasterrcnn_resnet50_fpn_v2 --teacher-weights outputs/training/res_1/best_model.pth --distill-alpha 1.0 --distill-temp 2.0
+
+# Quantization aware fine-tuning of a trained model for int8 CPU inference:
+python train.py --model fasterrcnn_mini_darknet --weights outputs/training/res_1/best_model.pth --data data_configs/voc.yaml --qat --epochs 5 --lr 0.0001
+
+# Backbone frozen for 3 epochs, then one stage unfrozen every 2 epochs:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --freeze-backbone-epochs 3 --unfreeze-every 2
+
+# AdamW with no weight decay on norm layers and biases and a lower backbone learning rate:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --optimizer adamw --optimizer-impl fused --lr 0.0001 --weight-decay 0.05 --backbone-lr-mult 0.1
+
+# Decode the images once into a cache shared by later runs (e.g. the trials of sweep.py):
+python train.py --model fasterrcnn_nano --data data_configs/voc.yaml --data-cache data_cache
+
+# Iteration based training, evaluation every 5000 and checkpoints every 1000 steps:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/coco.yaml --max-steps 90000 --eval-every 5000 --ckpt-every 1000 --warmup-steps 1000
+
+# Vectorized in-process COCO mAP evaluation instead of pycocotools:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --evaluator fast
+
+# COCO matching in 4 worker processes, overlapping with the inference:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --evaluator parallel --eval-workers 4
+
+# Evaluate in a background process while training continues:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --async-eval --async-eval-threads 8
+
+# Profile a window of training and evaluation steps (traces in the training result dir):
+python train.py --model fasterrcnn_resnet50_fpn --epochs 1 --data data_configs/voc.yaml --batch 4 --profile --profile-steps 5 2 5
+
+# Largest batch size that fits in memory:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --epochs 2 --data data_configs/voc.yaml --imgsz 640 --batch auto
+
+# Activation checkpointing for larger batches with deep backbones:
+python train.py --model fasterrcnn_resnet101 --epochs 2 --data data_configs/voc.yaml --batch 16 --grad-checkpoint
+
 # Distributed training:
 export CUDA_VISIBLE_DEVICES=0,1
 python -m torch.distributed.launch --nproc_per_node=2 --use_env train.py --data data_configs/smoke.yaml --epochs 100 --model fasterrcnn_resnet50_fpn --name smoke_training --batch 16
+
+# Distributed training on CPU cores (gloo backend), 4 processes sharing the cores:
+torchrun --nproc_per_node=4 train.py --device cpu --data data_configs/smoke.yaml --epochs 100 --model fasterrcnn_mobilenetv3_large_fpn --name smoke_training --batch 4
+
+# Average the logged losses over the processes every 50 steps instead of every step:
+torchrun --nproc_per_node=4 train.py --device cpu --data data_configs/smoke.yaml --epochs 100 --model fasterrcnn_mobilenetv3_large_fpn --name smoke_training --batch 4 --log-reduce-every 50
 """
 from torch_utils.engine import (
-    train_one_epoch, evaluate, utils
+    train_one_epoch, train_one_epoch_cached, evaluate, utils
 )
 from torch.utils.data import (
-    distributed, RandomSampler, SequentialSampler
+    distributed, RandomSampler, SequentialSampler, DataLoader
 )
 from datasets import (
     create_train_dataset, create_valid_dataset, 
-    create_train_loader, create_valid_loader
+    create_train_loader, create_valid_loader,
+    InfiniteSampler, StepWindow
 )
 from models.create_fasterrcnn_model import create_model
+from models.checkpointing import apply_activation_checkpointing
+from torch_utils.profiling import create_profiler, add_module_ranges
+from torch_utils.async_eval import AsyncEvaluator
+from utils.autobatch import autobatch, parse_batch_size
+from utils.optimizer import (
+    build_optimizer, consolidate_state_dict, warmup_cosine_scheduler,
+    OPTIMIZERS, IMPLEMENTATIONS, STATE_COPIES
+)
 from utils.general import (
     set_training_dir, Averager, 
     save_model, save_loss_plot,
     show_tranformed_image,
-    save_mAP, save_model_state, SaveBestModel,
+    save_mAP, save_model_state, SaveBestModel, CheckpointWriter,
     yaml_save, init_seeds
 )
+from utils.feature_cache import FeatureCache, file_signature, names_digest
+from utils.distillation import TeacherCache, DistillationLoss
+from utils.freeze import (
+    FreezeScheduler, transfer_optimizer_state, transfer_scheduler_state
+)
+from utils.quantization import (
+    prepare_qat, update_qat_state, convert_qat, measure_latency,
+    assert_float_checkpoint
+)
 from utils.logging import (
     set_log, coco_log,
     set_summary_writer, 
@@ -49,6 +112,7 @@ import yaml
 import numpy as np
 import torchinfo
 import os
+import copy
 
 torch.multiprocessing.set_sharing_strategy('file_system')
 
@@ -90,8 +154,9 @@ def parse_opt():
     parser.add_argument(
         '-b', '--batch', 
         default=4, 
-        type=int, 
-        help='batch size to load the data'
+        type=parse_batch_size, 
+        help='batch size to load the data, or auto to use the largest \
+              batch size that fits in memory'
     )
     parser.add_argument(
         '--lr', 
@@ -99,6 +164,40 @@ def parse_opt():
         help='learning rate for the optimizer',
         type=float
     )
+    parser.add_argument(
+        '--optimizer',
+        default='sgd',
+        choices=OPTIMIZERS,
+        help='sgd (Nesterov momentum 0.9) or adamw'
+    )
+    parser.add_argument(
+        '--optimizer-impl',
+        dest='optimizer_impl',
+        default='foreach',
+        choices=IMPLEMENTATIONS,
+        help='optimizer step implementation, foreach (multi tensor), \
+              fused (single kernel) or for-loop'
+    )
+    parser.add_argument(
+        '--weight-decay',
+        dest='weight_decay',
+        default=0.0,
+        type=float,
+        help='weight decay, not applied to norm layers and biases'
+    )
+    parser.add_argument(
+        '--backbone-lr-mult',
+        dest='backbone_lr_mult',
+        default=1.0,
+        type=float,
+        help='learning rate multiplier for the backbone parameters'
+    )
+    parser.add_argument(
+        '--zero',
+        action='store_true',
+        help='shard the optimizer state across the distributed processes \
+              with ZeroRedundancyOptimizer'
+    )
     parser.add_argument(
         '-ims', '--imgsz',
         default=640, 
@@ -203,6 +302,222 @@ def parse_opt():
               --project-dir will be named if not already present',
         type=str
     )
+    parser.add_argument(
+        '--keep-checkpoints',
+        dest='keep_checkpoints',
+        default=0,
+        type=int,
+        help='number of per epoch copies of last_model.pth to keep, \
+              (default 0, only the latest)'
+    )
+    parser.add_argument(
+        '--cache-features',
+        dest='cache_features',
+        action='store_true',
+        help='freeze the backbone, cache its features for the non-augmented \
+              training images once and train only the RPN and RoI heads \
+              from the cache'
+    )
+    parser.add_argument(
+        '--feature-cache-dir',
+        dest='feature_cache_dir',
+        default=None,
+        type=str,
+        help='directory for the backbone feature cache, \
+              (default feature_cache inside the training result dir)'
+    )
+    parser.add_argument(
+        '--teacher-model',
+        dest='teacher_model',
+        default=None,
+        help='name of a trained teacher model to distill from, trains on \
+              the non-augmented training images with the cached teacher \
+              RoI head logits and RPN objectness as extra targets'
+    )
+    parser.add_argument(
+        '--teacher-weights',
+        dest='teacher_weights',
+        default=None,
+        help='path to the teacher model weights'
+    )
+    parser.add_argument(
+        '--teacher-cache-dir',
+        dest='teacher_cache_dir',
+        default=None,
+        help='directory for the cached teacher outputs, \
+              (default teacher_cache inside the training result dir)'
+    )
+    parser.add_argument(
+        '--distill-alpha',
+        dest='distill_alpha',
+        default=1.0,
+        type=float,
+        help='weight of the distillation losses'
+    )
+    parser.add_argument(
+        '--distill-temp',
+        dest='distill_temp',
+        default=2.0,
+        type=float,
+        help='softmax temperature of the class logit distillation'
+    )
+    parser.add_argument(
+        '--qat',
+        action='store_true',
+        help='quantization aware training of the backbone and box head, \
+              converts to an int8 CPU model at the end and compares its \
+              mAP and latency with the float model'
+    )
+    parser.add_argument(
+        '--qat-backend',
+        dest='qat_backend',
+        default='x86',
+        choices=['x86', 'fbgemm', 'qnnpack'],
+        help='quantized engine of the target CPU, qnnpack for ARM'
+    )
+    parser.add_argument(
+        '--freeze-backbone-epochs',
+        dest='freeze_backbone_epochs',
+        default=0,
+        type=int,
+        help='number of epochs to train with the backbone frozen, the \
+              frozen stages run without gradients and are left out of \
+              the optimizer'
+    )
+    parser.add_argument(
+        '--unfreeze-every',
+        dest='unfreeze_every',
+        default=0,
+        type=int,
+        help='after --freeze-backbone-epochs, unfreeze one backbone stage \
+              every this many epochs from the output side, \
+              (default 0, all stages at once)'
+    )
+    parser.add_argument(
+        '--grad-checkpoint',
+        dest='grad_checkpoint',
+        action='store_true',
+        help='activation checkpointing for the ResNet, ConvNeXt and ViT \
+              backbone blocks, less memory for larger batches at the cost \
+              of recomputing the block forward passes'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='profile a window of training and evaluation steps of the \
+              first epoch with torch.profiler, saves Chrome traces and \
+              top operator tables in the training result dir'
+    )
+    parser.add_argument(
+        '--profile-steps',
+        dest='profile_steps',
+        default=[5, 2, 5],
+        type=int,
+        nargs=3,
+        metavar=('WAIT', 'WARMUP', 'ACTIVE'),
+        help='profiler window, steps to skip, warmup steps and recorded steps'
+    )
+    parser.add_argument(
+        '--data-cache',
+        dest='data_cache',
+        default=None,
+        help='directory of a decoded image and annotation cache shared \
+              between runs, built on first use'
+    )
+    parser.add_argument(
+        '--packed-batch',
+        dest='packed_batch',
+        action='store_true',
+        help='collate every batch into one pinned buffer that is moved to \
+              the device with a single copy'
+    )
+    parser.add_argument(
+        '--cpu-threads',
+        dest='cpu_threads',
+        default=None,
+        type=int,
+        help='intra-op threads per process for distributed CPU training, \
+              (default, CPU cores split evenly between the local processes)'
+    )
+    parser.add_argument(
+        '--max-steps',
+        dest='max_steps',
+        default=None,
+        type=int,
+        help='train for this many iterations instead of --epochs, the data \
+              stream continues across epoch boundaries and the learning \
+              rate follows a per step warmup + cosine schedule'
+    )
+    parser.add_argument(
+        '--eval-every',
+        dest='eval_every',
+        default=None,
+        type=int,
+        help='with --max-steps, evaluate and log every this many steps, \
+              (default, once per pass over the training set)'
+    )
+    parser.add_argument(
+        '--ckpt-every',
+        dest='ckpt_every',
+        default=None,
+        type=int,
+        help='with --max-steps, save the last model checkpoint every this \
+              many steps, (default, same as --eval-every)'
+    )
+    parser.add_argument(
+        '--warmup-steps',
+        dest='warmup_steps',
+        default=1000,
+        type=int,
+        help='with --max-steps, linear learning rate warmup steps'
+    )
+    parser.add_argument(
+        '--evaluator',
+        default='coco',
+        choices=['coco', 'fast', 'parallel'],
+        help='validation mAP engine, pycocotools, the vectorized bbox \
+              only evaluator or pycocotools in worker processes that \
+              overlap with the inference, all give the same stats'
+    )
+    parser.add_argument(
+        '--eval-workers',
+        dest='eval_workers',
+        default=None,
+        type=int,
+        help='worker processes of --evaluator parallel, (default, half \
+              of the CPU cores split between the local processes)'
+    )
+    parser.add_argument(
+        '--log-reduce-every',
+        dest='log_reduce_every',
+        default=1,
+        type=int,
+        help='average the logged training losses over the distributed \
+              processes every this many steps, on the other steps each \
+              process logs its own losses'
+    )
+    parser.add_argument(
+        '--async-eval',
+        dest='async_eval',
+        action='store_true',
+        help='evaluate in a background process on a CPU copy of the \
+              weights, training continues and the mAP is logged (and the \
+              best model saved) when the evaluation is done'
+    )
+    parser.add_argument(
+        '--async-eval-threads',
+        dest='async_eval_threads',
+        default=None,
+        type=int,
+        help='intra-op threads of the --async-eval process, (default, \
+              half of the training process threads)'
+    )
+    parser.add_argument(
+        '--async-eval-device',
+        dest='async_eval_device',
+        default='cpu',
+        help='device the --async-eval process runs the model on'
+    )
 
     args = vars(parser.parse_args())
     return args
@@ -212,7 +527,7 @@ def main(args):
     utils.init_distributed_mode(args)
 
     # Initialize W&B with project name.
-    if not args['disable_wandb']:
+    if not args['disable_wandb'] and utils.is_main_process():
         wandb_init(name=args['name'])
     # Load the data configurations
     with open(args['data']) as file:
@@ -234,58 +549,26 @@ def main(args):
     SAVE_VALID_PREDICTIONS = data_configs['SAVE_VALID_PREDICTION_IMAGES']
     BATCH_SIZE = args['batch']
     VISUALIZE_TRANSFORMED_IMAGES = args['vis_transformed']
-    OUT_DIR = set_training_dir(args['name'], args['project_dir'])
+    # Only rank 0 creates the training directory, logs and checkpoints.
+    # The other processes get the same path for the validation images.
+    MAIN_PROCESS = utils.is_main_process()
+    OUT_DIR = None
+    if MAIN_PROCESS:
+        OUT_DIR = set_training_dir(args['name'], args['project_dir'])
+    OUT_DIR = utils.broadcast_object(OUT_DIR)
     COLORS = np.random.uniform(0, 1, size=(len(CLASSES), 3))
     SCALER = torch.cuda.amp.GradScaler() if args['amp'] else None
-    # Set logging file.
-    set_log(OUT_DIR)
-    writer = set_summary_writer(OUT_DIR)
+    writer = None
+    if MAIN_PROCESS:
+        # Set logging file.
+        set_log(OUT_DIR)
+        writer = set_summary_writer(OUT_DIR)
 
-    yaml_save(file_path=os.path.join(OUT_DIR, 'opt.yaml'), data=args)
+        yaml_save(file_path=os.path.join(OUT_DIR, 'opt.yaml'), data=args)
 
     # Model configurations
     IMAGE_SIZE = args['imgsz']
     
-    train_dataset = create_train_dataset(
-        TRAIN_DIR_IMAGES, 
-        TRAIN_DIR_LABELS,
-        IMAGE_SIZE, 
-        CLASSES,
-        use_train_aug=args['use_train_aug'],
-        mosaic=args['mosaic'],
-        square_training=args['square_training']
-    )
-    valid_dataset = create_valid_dataset(
-        VALID_DIR_IMAGES, 
-        VALID_DIR_LABELS, 
-        IMAGE_SIZE, 
-        CLASSES,
-        square_training=args['square_training']
-    )
-    print('Creating data loaders')
-    if args['distributed']:
-        train_sampler = distributed.DistributedSampler(
-            train_dataset
-        )
-        valid_sampler = distributed.DistributedSampler(
-            valid_dataset, shuffle=False
-        )
-    else:
-        train_sampler = RandomSampler(train_dataset)
-        valid_sampler = SequentialSampler(valid_dataset)
-
-    train_loader = create_train_loader(
-        train_dataset, BATCH_SIZE, NUM_WORKERS, batch_sampler=train_sampler
-    )
-    valid_loader = create_valid_loader(
-        valid_dataset, BATCH_SIZE, NUM_WORKERS, batch_sampler=valid_sampler
-    )
-    print(f"Number of training samples: {len(train_dataset)}")
-    print(f"Number of validation samples: {len(valid_dataset)}\n")
-
-    if VISUALIZE_TRANSFORMED_IMAGES:
-        show_tranformed_image(train_loader, DEVICE, CLASSES, COLORS)
-
     # Initialize the Averager class.
     train_loss_hist = Averager()
     # Train and validation loss lists to store loss values of all
@@ -299,6 +582,7 @@ def main(args):
     val_map_05 = []
     val_map = []
     start_epochs = 0
+    start_step = 0
 
     if args['weights'] is None:
         print('Building model from scratch...')
@@ -311,6 +595,7 @@ def main(args):
         
         # Load the pretrained checkpoint.
         checkpoint = torch.load(args['weights'], map_location=DEVICE) 
+        assert_float_checkpoint(checkpoint)
         keys = list(checkpoint['model_state_dict'].keys())
         ckpt_state_dict = checkpoint['model_state_dict']
         # Get the number of classes from the loaded checkpoint.
@@ -321,6 +606,13 @@ def main(args):
         model = build_model(num_classes=old_classes)
         # Load weights.
         model.load_state_dict(ckpt_state_dict)
+        if args['qat']:
+            # QAT fine-tunes the trained float model, the head is kept.
+            assert old_classes == NUM_CLASSES, \
+                f"--qat needs weights trained on the {NUM_CLASSES} dataset classes, got {old_classes}"
+            # Float copy for the comparison with the int8 model at the end.
+            float_model = copy.deepcopy(model).cpu().eval()
+            float_model.transform.min_size = (args['imgsz'], )
 
         # Change output features for class predictor and box predictor
         # according to current dataset classes.
@@ -350,16 +642,153 @@ def main(args):
                 val_map = checkpoint['val_map']
             if checkpoint['val_map_05']:
                 val_map_05 = checkpoint['val_map_05']
+            if checkpoint.get('step'):
+                start_step = checkpoint['step']
+                print(f"Resuming from step {start_step}...")
+
+    if args['qat']:
+        assert not args['grad_checkpoint'] and not args['cache_features'], \
+            '--qat is not supported with --grad-checkpoint or --cache-features'
+        assert args['weights'] is not None and not args['resume_training'], \
+            '--qat fine-tunes a trained float model, pass its --weights (resuming is not supported)'
+        prepare_qat(model, IMAGE_SIZE, backend=args['qat_backend'])
+
+    if args['grad_checkpoint']:
+        num_blocks = apply_activation_checkpointing(model)
+        assert num_blocks > 0, \
+            f"--grad-checkpoint does not support {args['model']}"
+        print(f"Activation checkpointing {num_blocks} blocks")
 
     # Make the model transform's `min_size` same as `imgsz` argument. 
     model.transform.min_size = (args['imgsz'], )
+    if args['async_eval'] and MAIN_PROCESS:
+        # Model structure for the background evaluator, copied before it
+        # is moved to the device. The weights are sent at every evaluation.
+        eval_model = copy.deepcopy(model)
     model = model.to(DEVICE)
+    if BATCH_SIZE == 'auto':
+        # Probe before the DDP wrapper, only on rank 0 so that the probes
+        # of several processes do not compete for the memory. The other
+        # processes wait for its result.
+        if MAIN_PROCESS:
+            BATCH_SIZE = autobatch(
+                model, 
+                IMAGE_SIZE, 
+                DEVICE, 
+                amp=args['amp'],
+                # Aspect ratio resizing keeps the short side at `imgsz`,
+                # probe with the common 4:3 images.
+                aspect_ratio=1.0 if args['square_training'] else 4 / 3,
+                # The ZeRO optimizer state is sharded across the processes.
+                optimizer_state_copies=STATE_COPIES[args['optimizer']] / (
+                    utils.get_world_size() if args['zero'] else 1
+                )
+            )
+        BATCH_SIZE = utils.broadcast_object(BATCH_SIZE)
     if args['sync_bn'] and args['distributed']:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    freeze_scheduler = None
+    if args['freeze_backbone_epochs'] > 0:
+        assert not args['cache_features'], \
+            '--freeze-backbone-epochs is not supported with --cache-features'
+        # Before the DDP wrapper so that the frozen parameters are not
+        # part of its gradient buckets.
+        freeze_scheduler = FreezeScheduler(
+            model, args['freeze_backbone_epochs'], args['unfreeze_every']
+        )
+        # A resumed optimizer state holds the trainable parameters of the
+        # last finished epoch.
+        freeze_scheduler.step(max(start_epochs - 1, 0))
+    model_without_ddp = model
     if args['distributed']:
         model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[args['gpu']]
+            model, 
+            device_ids=[args['gpu']] if DEVICE.type == 'cuda' else None
+        )
+        model_without_ddp = model.module
+
+    if args['data_cache'] is not None and args['distributed'] and not MAIN_PROCESS:
+        # The main process builds the shared data cache first.
+        torch.distributed.barrier()
+    train_dataset = create_train_dataset(
+        TRAIN_DIR_IMAGES, 
+        TRAIN_DIR_LABELS,
+        IMAGE_SIZE, 
+        CLASSES,
+        use_train_aug=args['use_train_aug'],
+        mosaic=args['mosaic'],
+        square_training=args['square_training'],
+        cache_dir=args['data_cache']
+    )
+    valid_dataset = create_valid_dataset(
+        VALID_DIR_IMAGES, 
+        VALID_DIR_LABELS, 
+        IMAGE_SIZE, 
+        CLASSES,
+        square_training=args['square_training'],
+        cache_dir=args['data_cache']
+    )
+    if args['data_cache'] is not None and args['distributed'] and MAIN_PROCESS:
+        torch.distributed.barrier()
+    print('Creating data loaders')
+    if args['distributed']:
+        train_sampler = distributed.DistributedSampler(
+            train_dataset
         )
+        valid_sampler = distributed.DistributedSampler(
+            valid_dataset, shuffle=False
+        )
+    else:
+        train_sampler = RandomSampler(train_dataset)
+        valid_sampler = SequentialSampler(valid_dataset)
+
+    train_loader = create_train_loader(
+        train_dataset, 
+        BATCH_SIZE, 
+        NUM_WORKERS, 
+        batch_sampler=train_sampler, 
+        packed=args['packed_batch']
+    )
+    valid_loader = create_valid_loader(
+        valid_dataset, 
+        BATCH_SIZE, 
+        NUM_WORKERS, 
+        batch_sampler=valid_sampler, 
+        packed=args['packed_batch']
+    )
+    print(f"Number of training samples: {len(train_dataset)}")
+    print(f"Number of validation samples: {len(valid_dataset)}\n")
+
+    # Only the main process evaluates in the background, over the whole
+    # validation set.
+    async_evaluator = None
+    if args['async_eval'] and MAIN_PROCESS:
+        async_evaluator = AsyncEvaluator(
+            eval_model,
+            dict(
+                valid_dir_images=VALID_DIR_IMAGES,
+                valid_dir_labels=VALID_DIR_LABELS,
+                img_size=IMAGE_SIZE,
+                classes=CLASSES,
+                square_training=args['square_training'],
+                cache_dir=args['data_cache']
+            ),
+            BATCH_SIZE,
+            NUM_WORKERS,
+            num_threads=args['async_eval_threads'],
+            device=args['async_eval_device'],
+            save_valid_preds=SAVE_VALID_PREDICTIONS,
+            out_dir=OUT_DIR,
+            classes=CLASSES,
+            colors=COLORS,
+            evaluator=args['evaluator'],
+            eval_workers=args['eval_workers']
+        )
+        del eval_model
+
+    if VISUALIZE_TRANSFORMED_IMAGES:
+        show_tranformed_image(train_loader, DEVICE, CLASSES, COLORS)
+
     try:
         torchinfo.summary(
             model, 
@@ -370,65 +799,362 @@ def main(args):
         )
     except:
         print(model)
+    if args['cache_features']:
+        assert not args['distributed'], \
+            '--cache-features is not supported with distributed training'
+        # Freeze the backbone (and FPN).
+        for p in model.backbone.parameters():
+            p.requires_grad_(False)
     # Total parameters and trainable parameters.
     total_params = sum(p.numel() for p in model.parameters())
     print(f"{total_params:,} total parameters.")
     total_trainable_params = sum(
         p.numel() for p in model.parameters() if p.requires_grad)
     print(f"{total_trainable_params:,} training parameters.")
-    # Get the model parameters.
-    params = [p for p in model.parameters() if p.requires_grad]
+    if args['cache_features']:
+        # Cache the frozen backbone outputs for the non-augmented
+        # training images once. Only the RPN and RoI heads train.
+        cache_dataset = create_valid_dataset(
+            TRAIN_DIR_IMAGES,
+            TRAIN_DIR_LABELS,
+            IMAGE_SIZE,
+            CLASSES,
+            square_training=args['square_training'],
+            cache_dir=args['data_cache']
+        )
+        feature_cache = FeatureCache(
+            args['feature_cache_dir'] or os.path.join(OUT_DIR, 'feature_cache')
+        )
+        cache_meta = {
+            'model': args['model'],
+            'weights': args['weights'],
+            'weights_file': file_signature(args['weights']),
+            'imgsz': IMAGE_SIZE,
+            'square_training': args['square_training'],
+            'num_images': len(cache_dataset),
+            'images': names_digest(cache_dataset.all_images)
+        }
+        if not feature_cache.is_valid(cache_meta):
+            feature_cache.build(
+                model,
+                create_valid_loader(cache_dataset, BATCH_SIZE, NUM_WORKERS),
+                DEVICE,
+                cache_meta
+            )
+        else:
+            print(f"Using cached features from {feature_cache.cache_dir}")
+        cached_train_loader = DataLoader(
+            feature_cache,
+            batch_size=BATCH_SIZE,
+            sampler=RandomSampler(feature_cache),
+            num_workers=NUM_WORKERS,
+            collate_fn=feature_cache.collate_fn
+        )
+    distill_loss = None
+    if args['teacher_model'] is not None:
+        assert args['teacher_weights'] is not None, \
+            '--teacher-model needs --teacher-weights'
+        assert not args['distributed'] and not args['cache_features'], \
+            'distillation is not supported with distributed training or --cache-features'
+        # The teacher outputs are cached for the non-augmented training
+        # images, so the student trains on those too.
+        distill_dataset = create_valid_dataset(
+            TRAIN_DIR_IMAGES,
+            TRAIN_DIR_LABELS,
+            IMAGE_SIZE,
+            CLASSES,
+            square_training=args['square_training'],
+            cache_dir=args['data_cache']
+        )
+        teacher_cache = TeacherCache(
+            args['teacher_cache_dir'] or os.path.join(OUT_DIR, 'teacher_cache')
+        )
+        teacher_meta = {
+            'model': args['teacher_model'],
+            'weights': args['teacher_weights'],
+            'weights_file': file_signature(args['teacher_weights']),
+            'imgsz': IMAGE_SIZE,
+            'square_training': args['square_training'],
+            'num_images': len(distill_dataset),
+            'images': names_digest(distill_dataset.all_images)
+        }
+        if not teacher_cache.is_valid(teacher_meta):
+            print(f"Loading teacher {args['teacher_model']}...")
+            teacher_checkpoint = torch.load(
+                args['teacher_weights'], map_location=DEVICE
+            )
+            teacher = create_model[args['teacher_model']](
+                num_classes=NUM_CLASSES, pretrained=False
+            )
+            teacher.load_state_dict(teacher_checkpoint['model_state_dict'])
+            teacher.transform.min_size = (IMAGE_SIZE, )
+            teacher_cache.build(
+                teacher.to(DEVICE),
+                create_valid_loader(distill_dataset, BATCH_SIZE, NUM_WORKERS),
+                DEVICE,
+                teacher_meta
+            )
+            del teacher, teacher_checkpoint
+        else:
+            print(f"Using cached teacher outputs from {teacher_cache.cache_dir}")
+        train_loader = create_train_loader(
+            distill_dataset,
+            BATCH_SIZE,
+            NUM_WORKERS,
+            batch_sampler=RandomSampler(distill_dataset),
+            packed=args['packed_batch']
+        )
+        distill_loss = DistillationLoss(
+            teacher_cache,
+            alpha=args['distill_alpha'],
+            temperature=args['distill_temp']
+        )
+
+    MAX_STEPS = args['max_steps']
+    if MAX_STEPS is not None:
+        assert not args['cache_features'], \
+            '--max-steps is not supported with --cache-features'
+        steps_per_epoch = len(train_loader)
+        EVAL_EVERY = args['eval_every'] or steps_per_epoch
+        CKPT_EVERY = args['ckpt_every'] or EVAL_EVERY
+        # Passes over the training set, for the freezing and QAT schedules.
+        NUM_EPOCHS = -(-MAX_STEPS // steps_per_epoch)
+        # One endless stream of batches, continued from `start_step`.
+        train_stream = iter(create_train_loader(
+            train_loader.dataset,
+            BATCH_SIZE,
+            NUM_WORKERS,
+            batch_sampler=InfiniteSampler(
+                train_loader.sampler,
+                start_index=start_step * BATCH_SIZE,
+                seed=args['seed']
+            ),
+            packed=args['packed_batch']
+        ))
+        print(
+            f"Training for {MAX_STEPS} steps ({steps_per_epoch} per epoch), "
+            f"evaluating every {EVAL_EVERY} and saving every {CKPT_EVERY} steps"
+        )
+    global_step = start_step
+
     # Define the optimizer.
-    optimizer = torch.optim.SGD(params, lr=args['lr'], momentum=0.9, nesterov=True)
-    # optimizer = torch.optim.AdamW(params, lr=0.0001, weight_decay=0.0005)
-    if args['resume_training']: 
-        # LOAD THE OPTIMIZER STATE DICTIONARY FROM THE CHECKPOINT.
-        print('Loading optimizer state dictionary...')
-        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if args['zero']:
+        assert args['distributed'], '--zero needs distributed training'
+    def create_optimizer():
+        return build_optimizer(
+            model_without_ddp,
+            name=args['optimizer'],
+            lr=args['lr'],
+            weight_decay=args['weight_decay'],
+            backbone_lr_mult=args['backbone_lr_mult'],
+            impl=args['optimizer_impl'],
+            zero=args['zero']
+        )
 
-    if args['cosine_annealing']:
+    def create_scheduler(optimizer):
+        if MAX_STEPS is not None:
+            return warmup_cosine_scheduler(
+                optimizer,
+                MAX_STEPS,
+                warmup_steps=args['warmup_steps'],
+                start_step=global_step
+            )
+        if not args['cosine_annealing']:
+            return None
         # LR will be zero as we approach `steps` number of epochs each time.
         # If `steps = 5`, LR will slowly reduce to zero every 5 epochs.
         steps = NUM_EPOCHS + 10
-        scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(
+        return torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(
             optimizer, 
             T_0=steps,
             T_mult=1,
             verbose=False
         )
-    else:
-        scheduler = None
+
+    optimizer = create_optimizer()
+    if args['resume_training']: 
+        # LOAD THE OPTIMIZER STATE DICTIONARY FROM THE CHECKPOINT.
+        print('Loading optimizer state dictionary...')
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    scheduler = create_scheduler(optimizer)
+
+    if args['profile']:
+        add_module_ranges(model_without_ddp)
 
     save_best_model = SaveBestModel()
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter(keep=args['keep_checkpoints'])
 
-    for epoch in range(start_epochs, NUM_EPOCHS):
-        train_loss_hist.reset()
+    def log_evaluation(tag, stats, val_pred_image, state_dict=None):
+        """
+        Log the COCO stats of one evaluation and save the best model.
 
-        _, batch_loss_list, \
-            batch_loss_cls_list, \
-            batch_loss_box_reg_list, \
-            batch_loss_objectness_list, \
-            batch_loss_rpn_list = train_one_epoch(
-            model, 
-            optimizer, 
-            train_loader, 
-            DEVICE, 
+        :param tag: `(epoch, end_step, round_losses)` of the round the
+            evaluated weights are from.
+        :param state_dict: The evaluated weights of an asynchronous
+            evaluation, None for the current weights.
+        """
+        epoch, end_step, (
+            epoch_loss,
+            batch_losses,
+            train_losses,
+            cls_losses,
+            box_reg_losses,
+            objectness_losses,
+            rpn_losses
+        ) = tag
+        val_map_05.append(stats[1])
+        val_map.append(stats[0])
+
+        # Save mAP plots.
+        save_mAP(OUT_DIR, val_map_05, val_map)
+
+        # Save mAP plot using TensorBoard.
+        tensorboard_map_log(
+            name='mAP', 
+            val_map_05=np.array(val_map_05), 
+            val_map=np.array(val_map),
+            writer=writer,
+            epoch=epoch if end_step is None else end_step
+        )
+
+        coco_log(OUT_DIR, stats)
+        # The rows of step based training are numbered by evaluation.
+        csv_log(
+            OUT_DIR, 
+            stats, 
+            epoch if end_step is None else len(val_map) - 1,
+            train_losses,
+            cls_losses,
+            box_reg_losses,
+            objectness_losses,
+            rpn_losses
+        )
+
+        # WandB logging.
+        if not args['disable_wandb']:
+            wandb_log(
+                epoch_loss,
+                batch_losses,
+                cls_losses,
+                box_reg_losses,
+                objectness_losses,
+                rpn_losses,
+                stats[1],
+                stats[0],
+                val_pred_image,
+                IMAGE_SIZE
+            )
+
+        # Save best model if the current mAP @0.5:0.95 IoU is
+        # greater than the last hightest.
+        save_best_model(
+            model_without_ddp, 
+            stats[0], 
             epoch, 
-            train_loss_hist,
-            print_freq=100,
-            scheduler=scheduler,
-            scaler=SCALER
+            OUT_DIR,
+            data_configs,
+            args['model'],
+            writer=checkpoint_writer,
+            state_dict=state_dict
         )
 
-        stats, val_pred_image = evaluate(
-            model, 
-            valid_loader, 
-            device=DEVICE,
-            save_valid_preds=SAVE_VALID_PREDICTIONS,
-            out_dir=OUT_DIR,
-            classes=CLASSES,
-            colors=COLORS
+    # A round trains one epoch, or with `--max-steps` up to the next
+    # evaluation or checkpoint step.
+    if MAX_STEPS is None:
+        rounds = [
+            (epoch, None, True, True) for epoch in range(start_epochs, NUM_EPOCHS)
+        ]
+    else:
+        boundaries = sorted(
+            set(range(EVAL_EVERY, MAX_STEPS, EVAL_EVERY))
+            | set(range(CKPT_EVERY, MAX_STEPS, CKPT_EVERY))
+            | {MAX_STEPS}
         )
+        rounds = []
+        step = start_step
+        for end_step in boundaries:
+            if end_step <= step:
+                continue
+            rounds.append((
+                step // steps_per_epoch,
+                end_step,
+                end_step % EVAL_EVERY == 0 or end_step == MAX_STEPS,
+                end_step % CKPT_EVERY == 0 or end_step == MAX_STEPS
+            ))
+            step = end_step
+
+    for round_idx, (epoch, end_step, do_eval, do_ckpt) in enumerate(rounds):
+        step_based = end_step is not None
+        train_loss_hist.reset()
+        if args['qat']:
+            update_qat_state(model, epoch, NUM_EPOCHS)
+        if freeze_scheduler is not None and freeze_scheduler.step(epoch):
+            # The trainable parameters changed, rebuild everything that
+            # holds on to them.
+            if args['distributed']:
+                model = torch.nn.parallel.DistributedDataParallel(
+                    model_without_ddp, 
+                    device_ids=[args['gpu']] if DEVICE.type == 'cuda' else None
+                )
+            new_optimizer = create_optimizer()
+            transfer_optimizer_state(optimizer, new_optimizer)
+            optimizer = new_optimizer
+            if scheduler is not None:
+                new_scheduler = create_scheduler(optimizer)
+                transfer_scheduler_state(scheduler, new_scheduler)
+                scheduler = new_scheduler
+        if args['distributed'] and not step_based:
+            # Different shuffling of the shards every epoch.
+            train_sampler.set_epoch(epoch)
+
+        # Only the first round is profiled, on the main process.
+        train_profiler, eval_profiler = None, None
+        if args['profile'] and round_idx == 0 and MAIN_PROCESS:
+            wait, warmup, active = args['profile_steps']
+            train_profiler = create_profiler(OUT_DIR, 'train', wait, warmup, active)
+            eval_profiler = create_profiler(OUT_DIR, 'eval', wait, warmup, active)
+
+        if args['cache_features']:
+            _, batch_loss_list, \
+                batch_loss_cls_list, \
+                batch_loss_box_reg_list, \
+                batch_loss_objectness_list, \
+                batch_loss_rpn_list = train_one_epoch_cached(
+                model,
+                optimizer,
+                cached_train_loader,
+                DEVICE,
+                epoch,
+                train_loss_hist,
+                print_freq=100,
+                scheduler=scheduler,
+                scaler=SCALER,
+                reduce_every=args['log_reduce_every']
+            )
+        else:
+            _, batch_loss_list, \
+                batch_loss_cls_list, \
+                batch_loss_box_reg_list, \
+                batch_loss_objectness_list, \
+                batch_loss_rpn_list = train_one_epoch(
+                model, 
+                optimizer, 
+                StepWindow(train_stream, end_step - global_step) \
+                    if step_based else train_loader, 
+                DEVICE, 
+                epoch, 
+                train_loss_hist,
+                print_freq=100,
+                scheduler=None if step_based else scheduler,
+                scaler=SCALER,
+                profiler=train_profiler,
+                loss_fn=distill_loss,
+                step_scheduler=scheduler if step_based else None,
+                reduce_every=args['log_reduce_every']
+            )
+        if step_based:
+            global_step = end_step
 
         # Append the current epoch's batch-wise losses to the `train_loss_list`.
         train_loss_list.extend(batch_loss_list)
@@ -439,8 +1165,49 @@ def main(args):
 
         # Append curent epoch's average loss to `train_loss_list_epoch`.
         train_loss_list_epoch.append(train_loss_hist.value)
-        val_map_05.append(stats[1])
-        val_map.append(stats[0])
+
+        # An evaluation is logged with the round it was taken at, the
+        # asynchronous results arrive in later rounds.
+        round_tag = (
+            epoch,
+            end_step,
+            (
+                train_loss_hist.value,
+                batch_loss_list,
+                train_loss_list[-1:],
+                loss_cls_list[-1:],
+                loss_box_reg_list[-1:],
+                loss_objectness_list[-1:],
+                loss_rpn_list[-1:]
+            )
+        )
+        evaluations = []
+        if do_eval and not args['async_eval']:
+            stats, val_pred_image = evaluate(
+                model, 
+                valid_loader, 
+                device=DEVICE,
+                save_valid_preds=SAVE_VALID_PREDICTIONS and MAIN_PROCESS,
+                out_dir=OUT_DIR,
+                classes=CLASSES,
+                colors=COLORS,
+                profiler=eval_profiler,
+                evaluator=args['evaluator'],
+                eval_workers=args['eval_workers']
+            )
+            evaluations.append((round_tag, stats, val_pred_image, None))
+        elif do_eval and async_evaluator is not None:
+            async_evaluator.submit(round_tag, model_without_ddp)
+        if async_evaluator is not None:
+            evaluations.extend(async_evaluator.poll())
+
+        if do_ckpt:
+            # The sharded optimizer state is gathered on the main process
+            # for saving, every process has to take part.
+            consolidate_state_dict(optimizer)
+
+        if not MAIN_PROCESS:
+            continue
 
         # Save loss plot for batch-wise list.
         save_loss_plot(OUT_DIR, train_loss_list)
@@ -482,87 +1249,78 @@ def main(args):
             save_name='train_loss_rpn_bbox'
         )
 
-        # Save mAP plots.
-        save_mAP(OUT_DIR, val_map_05, val_map)
-
         # Save batch-wise train loss plot using TensorBoard. Better not to use it
         # as it increases the TensorBoard log sizes by a good extent (in 100s of MBs).
         # tensorboard_loss_log('Train loss', np.array(train_loss_list), writer)
 
-        # Save epoch-wise train loss plot using TensorBoard.
+        # Save epoch-wise train loss plot using TensorBoard. Step based
+        # training logs against the step.
         tensorboard_loss_log(
             'Train loss', 
             np.array(train_loss_list_epoch), 
             writer,
-            epoch
+            end_step if step_based else epoch
         )
 
-        # Save mAP plot using TensorBoard.
-        tensorboard_map_log(
-            name='mAP', 
-            val_map_05=np.array(val_map_05), 
-            val_map=np.array(val_map),
-            writer=writer,
-            epoch=epoch
-        )
+        for evaluation in evaluations:
+            log_evaluation(*evaluation)
 
-        coco_log(OUT_DIR, stats)
-        csv_log(
-            OUT_DIR, 
-            stats, 
-            epoch,
-            train_loss_list,
-            loss_cls_list,
-            loss_box_reg_list,
-            loss_objectness_list,
-            loss_rpn_list
-        )
-
-        # WandB logging.
-        if not args['disable_wandb']:
-            wandb_log(
-                train_loss_hist.value,
-                batch_loss_list,
-                loss_cls_list,
-                loss_box_reg_list,
-                loss_objectness_list,
-                loss_rpn_list,
-                stats[1],
-                stats[0],
-                val_pred_image,
-                IMAGE_SIZE
+        if do_ckpt:
+            # Save the current epoch model state. This can be used 
+            # to resume training. It saves model state dict, number of
+            # epochs trained for, optimizer state dict, and loss function.
+            save_model(
+                epoch, 
+                model_without_ddp, 
+                optimizer, 
+                train_loss_list, 
+                train_loss_list_epoch,
+                val_map,
+                val_map_05,
+                OUT_DIR,
+                data_configs,
+                args['model'],
+                writer=checkpoint_writer,
+                step=global_step if step_based else None
             )
+            # Save the model dictionary only for the current epoch.
+            save_model_state(
+                model_without_ddp, OUT_DIR, data_configs, args['model'],
+                writer=checkpoint_writer
+            )
+    
+    if async_evaluator is not None:
+        # Wait for the evaluations still running.
+        for evaluation in async_evaluator.close():
+            log_evaluation(*evaluation)
+    # Wait for the last checkpoints to be written.
+    checkpoint_writer.close()
 
-        # Save the current epoch model state. This can be used 
-        # to resume training. It saves model state dict, number of
-        # epochs trained for, optimizer state dict, and loss function.
-        save_model(
-            epoch, 
-            model, 
-            optimizer, 
-            train_loss_list, 
-            train_loss_list_epoch,
-            val_map,
-            val_map_05,
-            OUT_DIR,
-            data_configs,
-            args['model']
+    if args['qat']:
+        # Compare the int8 model with the float model on the CPU.
+        quantized_model = convert_qat(model_without_ddp, args['qat_backend'])
+        cpu_device = torch.device('cpu')
+        print('Evaluating the float model...')
+        float_stats, _ = evaluate(float_model, valid_loader, device=cpu_device)
+        print('Evaluating the int8 model...')
+        quantized_stats, _ = evaluate(
+            quantized_model, valid_loader, device=cpu_device
         )
-        # Save the model dictionary only for the current epoch.
-        save_model_state(model, OUT_DIR, data_configs, args['model'])
-        # Save best model if the current mAP @0.5:0.95 IoU is
-        # greater than the last hightest.
-        save_best_model(
-            model, 
-            val_map[-1], 
-            epoch, 
-            OUT_DIR,
-            data_configs,
-            args['model']
-        )
-    
+        float_latency = measure_latency(float_model, IMAGE_SIZE)
+        quantized_latency = measure_latency(quantized_model, IMAGE_SIZE)
+        print(f"\n{'model':<6} {'mAP@0.5':>8} {'mAP@0.5:0.95':>13} {'CPU latency (ms)':>17}")
+        for name, stats, latency in (
+            ('float', float_stats, float_latency),
+            ('int8', quantized_stats, quantized_latency)
+        ):
+            print(f"{name:<6} {stats[1]:>8.3f} {stats[0]:>13.3f} {latency:>17.1f}")
+        if MAIN_PROCESS:
+            # The whole module is saved, load with `torch.load(..., weights_only=False)`.
+            torch.save(quantized_model, os.path.join(OUT_DIR, 'quantized_model.pt'))
+            print(f"Quantized model saved to {os.path.join(OUT_DIR, 'quantized_model.pt')}")
+
     # Save models to Weights&Biases.
-    if not args['disable_wandb']:
+    if not args['disable_wandb'] and MAIN_PROCESS:
         wandb_save_model(OUT_DIR)
 
 
@@ -22,15 +22,19 @@ import numpy as np
 import torchinfo
 import os
 import pandas as pd
-from torch_utils.engine import utils, evaluate, train_one_epoch
+from torch_utils.engine import utils, evaluate, validate, train_one_epoch
+from torch_utils.coco_utils import get_coco_api_from_dataset
 from torch.utils.data import distributed, RandomSampler, SequentialSampler
-from datasets import create_train_dataset, create_valid_dataset, create_train_loader, create_valid_loader
+from datasets import (
+    create_train_dataset, create_valid_dataset, create_train_eval_dataset,
+    create_train_loader, create_valid_loader
+)
 from models.create_fasterrcnn_model import create_model
 from utils.general import (
     set_training_dir, Averager, 
     save_model, save_loss_plot,
     show_tranformed_image,
-    save_mAP, save_model_state, SaveBestModel,
+    save_mAP, save_model_state, SaveBestModel, CheckpointWriter,
     yaml_save, init_seeds
 )
 from utils.logging import (
@@ -96,56 +100,15 @@ def parse_opt():
                         help='golabl seed for training')
     parser.add_argument('--project-dir', dest='project_dir', default=None, type=str, 
                         help='save resutls to custom dir instead of `outputs` directory, --project-dir will be named if not already present')
+    parser.add_argument('--keep-checkpoints', dest='keep_checkpoints', default=0, type=int,
+                        help='number of per epoch copies of last_model.pth to keep, (default 0, only the latest)')
+    parser.add_argument('--train-eval-samples', dest='train_eval_samples', default=500, type=int,
+                        help='number of non-augmented training images (fixed random sample) used to estimate the train mAP every epoch')
 
     args = vars(parser.parse_args())
     return args
 
 
-def validate_one_epoch(model, val_loader, device, epoch, val_loss_hist, print_freq):
-    model.eval()  # Set model to evaluation mode
-    metric_logger = utils.MetricLogger(delimiter="  ")
-    metric_logger.add_meter("lr", utils.SmoothedValue(window_size=1, fmt="{value:.6f}"))
-    header = f"Epoch: [{epoch}]"
-
-    # Lists to store batch losses
-    batch_loss_list = []
-    batch_loss_cls_list = []
-    batch_loss_box_reg_list = []
-    batch_loss_objectness_list = []
-    batch_loss_rpn_list = []
-
-    with torch.no_grad():  # Disable gradient calculation
-        for images, targets in metric_logger.log_every(val_loader, print_freq, header):
-            images = list(image.to(device) for image in images)
-            targets = [{k: v.to(device).to(torch.int64) for k, v in t.items()} for t in targets]
-
-            with torch.cuda.amp.autocast(enabled=False):  # No autocasting during validation
-                loss_dict = model(images, targets)
-                print(loss_dict)
-                losses = sum(loss for loss in loss_dict.values())
-
-            # Reduce losses over all GPUs for logging purposes
-            loss_dict_reduced = utils.reduce_dict(loss_dict)
-            losses_reduced = sum(loss for loss in loss_dict_reduced.values())
-
-            loss_value = losses_reduced.item()
-
-            metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
-            metric_logger.update(lr=0)  # Learning rate is not updated during validation
-
-            batch_loss_list.append(loss_value)
-            batch_loss_cls_list.append(loss_dict_reduced.get('loss_classifier', torch.tensor(0)).detach().cpu())
-            batch_loss_box_reg_list.append(loss_dict_reduced.get('loss_box_reg', torch.tensor(0)).detach().cpu())
-            batch_loss_objectness_list.append(loss_dict_reduced.get('loss_objectness', torch.tensor(0)).detach().cpu())
-            batch_loss_rpn_list.append(loss_dict_reduced.get('loss_rpn_box_reg', torch.tensor(0)).detach().cpu())
-            val_loss_hist.send(loss_value)
-
-    return (
-        metric_logger, batch_loss_list, batch_loss_cls_list, 
-        batch_loss_box_reg_list, batch_loss_objectness_list, batch_loss_rpn_list
-    )
-
-
 def create_log_csv(log_dir):
     cols = ['epoch', 
             'train_map', 'train_map_05',
@@ -257,6 +220,29 @@ def main(args):
     print(f"Number of training samples: {len(train_dataset)}")
     print(f"Number of validation samples: {len(valid_dataset)}\n")
 
+    # Train mAP is estimated on a fixed random sample of the training images
+    # without augmentations, its ground truth is converted only once.
+    train_eval_dataset = create_train_eval_dataset(
+        TRAIN_DIR_IMAGES, 
+        TRAIN_DIR_LABELS,
+        IMAGE_SIZE, 
+        CLASSES,
+        args['train_eval_samples'],
+        seed=args['seed'],
+        square_training=args['square_training']
+    )
+    if args['distributed']:
+        train_eval_sampler = distributed.DistributedSampler(
+            train_eval_dataset, shuffle=False
+        )
+    else:
+        train_eval_sampler = SequentialSampler(train_eval_dataset)
+    train_eval_loader = create_valid_loader(
+        train_eval_dataset, BATCH_SIZE, NUM_WORKERS, batch_sampler=train_eval_sampler
+    )
+    train_eval_coco = get_coco_api_from_dataset(train_eval_dataset)
+    print(f"Number of train mAP samples: {len(train_eval_dataset)}\n")
+
     if VISUALIZE_TRANSFORMED_IMAGES:
         show_tranformed_image(train_loader, DEVICE, CLASSES, COLORS)
 
@@ -384,9 +370,12 @@ def main(args):
         scheduler = None
 
     save_best_model = SaveBestModel()
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter(keep=args['keep_checkpoints'])
 
     for epoch in range(start_epochs, NUM_EPOCHS):
         train_loss_hist.reset()
+        val_loss_hist.reset()
 
         _, batch_loss_list, \
             batch_loss_cls_list, \
@@ -398,30 +387,25 @@ def main(args):
                 print_freq=100, scheduler=scheduler, scaler=SCALER
                 )
 
-        _, batch_loss_list_val, \
+        stats_val, val_pred_image, \
+            batch_loss_list_val, \
             batch_loss_cls_list_val, \
             batch_loss_box_reg_list_val, \
             batch_loss_objectness_list_val, \
-            batch_loss_rpn_list_val = validate_one_epoch(
-                model, valid_loader, 
-                DEVICE, epoch, val_loss_hist,
+            batch_loss_rpn_list_val = validate(
+                model, valid_loader,
+                DEVICE, val_loss_hist,
+                save_valid_preds=SAVE_VALID_PREDICTIONS,
+                out_dir=OUT_DIR, classes=CLASSES, colors=COLORS,
                 print_freq=100
                 )
 
-
-
         stats_train, _ = evaluate(
             model, 
-            train_loader, 
-            device=DEVICE, save_valid_preds=SAVE_VALID_PREDICTIONS,
-            out_dir=OUT_DIR, classes=CLASSES,colors=COLORS
-        )
-
-        stats_val, val_pred_image = evaluate(
-            model, 
-            valid_loader, 
-            device=DEVICE, save_valid_preds=SAVE_VALID_PREDICTIONS,
-            out_dir=OUT_DIR, classes=CLASSES, colors=COLORS
+            train_eval_loader, 
+            device=DEVICE, save_valid_preds=False,
+            out_dir=OUT_DIR, classes=CLASSES,colors=COLORS,
+            coco_gt=train_eval_coco
         )
 
         # Append the current epoch's batch-wise losses to the `train_loss_list`.
@@ -496,14 +480,18 @@ def main(args):
         save_model(epoch, model, optimizer, 
                    train_loss_list, train_loss_list_epoch,
                    val_map, val_map_05,
-                   OUT_DIR, data_configs, args['model']
+                   OUT_DIR, data_configs, args['model'],
+                   writer=checkpoint_writer
                    )
         # Save the model dictionary only for the current epoch.
-        save_model_state(model, OUT_DIR, data_configs, args['model'])
+        save_model_state(model, OUT_DIR, data_configs, args['model'], writer=checkpoint_writer)
         # Save best model if the current mAP @0.5:0.95 IoU is
         # greater than the last hightest.
-        save_best_model(model, val_map[-1], epoch, OUT_DIR, data_configs, args['model'])
+        save_best_model(model, val_map[-1], epoch, OUT_DIR, data_configs, args['model'], writer=checkpoint_writer)
     
+    # Wait for the last checkpoints to be written.
+    checkpoint_writer.close()
+
     # Save models to Weights&Biases.
     if not args['disable_wandb']:
         wandb_save_model(OUT_DIR)
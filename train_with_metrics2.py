@@ -22,15 +22,19 @@ import numpy as np
 import torchinfo
 import os
 import pandas as pd
-from torch_utils.engine import utils, evaluate, train_one_epoch
+from torch_utils.engine import utils, evaluate, validate, train_one_epoch
+from torch_utils.coco_utils import get_coco_api_from_dataset
 from torch.utils.data import distributed, RandomSampler, SequentialSampler
-from datasets import create_train_dataset, create_valid_dataset, create_train_loader, create_valid_loader
+from datasets import (
+    create_train_dataset, create_valid_dataset, create_train_eval_dataset,
+    create_train_loader, create_valid_loader
+)
 from models.create_fasterrcnn_model import create_model
 from utils.general import (
     set_training_dir, Averager, 
     save_model, save_loss_plot,
     show_tranformed_image,
-    save_mAP, save_model_state, SaveBestModel,
+    save_mAP, save_model_state, SaveBestModel, CheckpointWriter,
     yaml_save, init_seeds
 )
 from utils.logging import (
@@ -38,7 +42,6 @@ from utils.logging import (
     tensorboard_loss_log, tensorboard_map_log, #csv_log,
     wandb_log, wandb_save_model, wandb_init
 )
-from utils.eval_utils import eval_forward
 print("import finished")
 
 torch.multiprocessing.set_sharing_strategy('file_system')
@@ -97,28 +100,15 @@ def parse_opt():
                         help='golabl seed for training')
     parser.add_argument('--project-dir', dest='project_dir', default=None, type=str, 
                         help='save resutls to custom dir instead of `outputs` directory, --project-dir will be named if not already present')
+    parser.add_argument('--keep-checkpoints', dest='keep_checkpoints', default=0, type=int,
+                        help='number of per epoch copies of last_model.pth to keep, (default 0, only the latest)')
+    parser.add_argument('--train-eval-samples', dest='train_eval_samples', default=500, type=int,
+                        help='number of non-augmented training images (fixed random sample) used to estimate the train mAP every epoch')
 
     args = vars(parser.parse_args())
     return args
 
 
-def evaluate_loss(model, data_loader, device):
-    val_loss = 0
-    with torch.no_grad():
-      for images, targets in data_loader:
-          images = list(image.to(device) for image in images)
-          targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-          losses_dict, detections = eval_forward(model, images, targets)
-         
-          losses = sum(loss for loss in losses_dict.values())
-
-          val_loss += losses
-          
-    validation_loss = val_loss/ len(data_loader)    
-    validation_loss = validation_loss.cpu().numpy()
-    return validation_loss
-
-
 def create_log_csv(log_dir):
     cols = ['epoch', 
             'train_map', 'train_map_05',
@@ -213,6 +203,29 @@ def main(args):
     print(f"Number of training samples: {len(train_dataset)}")
     print(f"Number of validation samples: {len(valid_dataset)}\n")
 
+    # Train mAP is estimated on a fixed random sample of the training images
+    # without augmentations, its ground truth is converted only once.
+    train_eval_dataset = create_train_eval_dataset(
+        TRAIN_DIR_IMAGES, 
+        TRAIN_DIR_LABELS,
+        IMAGE_SIZE, 
+        CLASSES,
+        args['train_eval_samples'],
+        seed=args['seed'],
+        square_training=args['square_training']
+    )
+    if args['distributed']:
+        train_eval_sampler = distributed.DistributedSampler(
+            train_eval_dataset, shuffle=False
+        )
+    else:
+        train_eval_sampler = SequentialSampler(train_eval_dataset)
+    train_eval_loader = create_valid_loader(
+        train_eval_dataset, BATCH_SIZE, NUM_WORKERS, batch_sampler=train_eval_sampler
+    )
+    train_eval_coco = get_coco_api_from_dataset(train_eval_dataset)
+    print(f"Number of train mAP samples: {len(train_eval_dataset)}\n")
+
     if VISUALIZE_TRANSFORMED_IMAGES:
         show_tranformed_image(train_loader, DEVICE, CLASSES, COLORS)
 
@@ -334,6 +347,8 @@ def main(args):
         scheduler = None
 
     save_best_model = SaveBestModel()
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter(keep=args['keep_checkpoints'])
 
     for epoch in range(start_epochs, NUM_EPOCHS):
         train_loss_hist.reset()
@@ -348,23 +363,24 @@ def main(args):
                 print_freq=100, scheduler=scheduler, scaler=SCALER
                 )
 
-        validation_loss  = evaluate_loss(model, valid_loader, device=DEVICE)
+        stats_val, val_pred_image, \
+            batch_loss_list_val, \
+            _, _, _, _ = validate(
+                model, valid_loader,
+                DEVICE,
+                save_valid_preds=SAVE_VALID_PREDICTIONS,
+                out_dir=OUT_DIR, classes=CLASSES, colors=COLORS,
+                print_freq=100
+                )
+        validation_loss = np.mean(np.array(batch_loss_list_val))
         print(validation_loss)
 
-
-
         stats_train, _ = evaluate(
             model, 
-            train_loader, 
-            device=DEVICE, save_valid_preds=SAVE_VALID_PREDICTIONS,
-            out_dir=OUT_DIR, classes=CLASSES,colors=COLORS
-        )
-
-        stats_val, val_pred_image = evaluate(
-            model, 
-            valid_loader, 
-            device=DEVICE, save_valid_preds=SAVE_VALID_PREDICTIONS,
-            out_dir=OUT_DIR, classes=CLASSES, colors=COLORS
+            train_eval_loader, 
+            device=DEVICE, save_valid_preds=False,
+            out_dir=OUT_DIR, classes=CLASSES,colors=COLORS,
+            coco_gt=train_eval_coco
         )
 
         # Append the current epoch's batch-wise losses to the `train_loss_list`.
@@ -437,14 +453,18 @@ def main(args):
         save_model(epoch, model, optimizer, 
                    train_loss_list, train_loss_list_epoch,
                    val_map, val_map_05,
-                   OUT_DIR, data_configs, args['model']
+                   OUT_DIR, data_configs, args['model'],
+                   writer=checkpoint_writer
                    )
         # Save the model dictionary only for the current epoch.
-        save_model_state(model, OUT_DIR, data_configs, args['model'])
+        save_model_state(model, OUT_DIR, data_configs, args['model'], writer=checkpoint_writer)
         # Save best model if the current mAP @0.5:0.95 IoU is
         # greater than the last hightest.
-        save_best_model(model, val_map[-1], epoch, OUT_DIR, data_configs, args['model'])
+        save_best_model(model, val_map[-1], epoch, OUT_DIR, data_configs, args['model'], writer=checkpoint_writer)
     
+    # Wait for the last checkpoints to be written.
+    checkpoint_writer.close()
+
     # Save models to Weights&Biases.
     if not args['disable_wandb']:
         wandb_save_model(OUT_DIR)
@@ -14,7 +14,7 @@ python train.py --model fasterrcnn_resnet50_fpn --epochs 2 --use-train-aug --dat
 export CUDA_VISIBLE_DEVICES=0,1
 python -m torch.distributed.launch --nproc_per_node=2 --use_env train.py --data data_configs/smoke.yaml --epochs 100 --model fasterrcnn_resnet50_fpn --name smoke_training --batch 16
 """
-from torch_utils.engine import train_one_epoch, evaluate, utils
+from torch_utils.engine import train_one_epoch, validate, utils
 from torch.utils.data import distributed, RandomSampler, SequentialSampler
 from datasets import create_train_dataset, create_valid_dataset, create_train_loader, create_valid_loader
 from models.create_fasterrcnn_model import create_model
@@ -22,11 +22,11 @@ from utils.general import (
     set_training_dir, Averager, 
     save_model, save_loss_plot,
     show_tranformed_image,
-    save_mAP, save_model_state, SaveBestModel,
+    save_mAP, save_model_state, SaveBestModel, CheckpointWriter,
     yaml_save, init_seeds
 )
 from utils.logging import (
-    set_log, coco_log, csv_log
+    set_log, coco_log, csv_log,
     set_summary_writer, 
     tensorboard_loss_log, tensorboard_map_log,
     wandb_log, wandb_save_model, wandb_init
@@ -62,7 +62,7 @@ def parse_opt():
     parser.add_argument('--mosaic', default=0.0, type=float, help='probability of applying mosaic, (default, always apply)')
     parser.add_argument('-uta', '--use-train-aug', dest='use_train_aug', action='store_true', help='whether to use train augmentation, blur, gray,brightness contrast, color jitter, random gammaall at once')
     parser.add_argument( '-ca', '--cosine-annealing', dest='cosine_annealing', action='store_true', help='use cosine annealing warm restarts' )
-    parser.add_argument( '-w', '--weights', default=None, type=str, help='path to model weights if using pretrained weights' )    parser.add_argument(
+    parser.add_argument( '-w', '--weights', default=None, type=str, help='path to model weights if using pretrained weights' )
     parser.add_argument( '-r', '--resume-training', dest='resume_training', action='store_true', help='whether to resume training, if true, loads previous training plots and epochs and also loads the otpimizer state dictionary' )
     parser.add_argument( '-st', '--square-training', dest='square_training', action='store_true', help='Resize images to square shape instead of aspect ratio resizing for single image training. For mosaic training, this resizes \ single images to square shape first then puts them on a \ square canvas.' )
     parser.add_argument( '--world-size', default=1, type=int, help='number of distributed processes' )
@@ -72,6 +72,7 @@ def parse_opt():
     parser.add_argument( '--amp', action='store_true', help='use automatic mixed precision' )
     parser.add_argument( '--seed', default=0, type=int , help='golabl seed for training' )
     parser.add_argument( '--project-dir', dest='project_dir', default=None, help='save resutls to custom dir instead of `outputs` directory, --project-dir will be named if not already present', type=str )
+    parser.add_argument( '--keep-checkpoints', dest='keep_checkpoints', default=0, type=int, help='number of per epoch copies of last_model.pth to keep, (default 0, only the latest)' )
 
 
     args = vars(parser.parse_args())
@@ -146,6 +147,7 @@ def main(args):
 
     # Initialize the Averager class.
     train_loss_hist = Averager()
+    val_loss_hist = Averager()
     # Train and validation loss lists to store loss values of all
     # iterations till ena and plot graphs for all iterations.
     train_loss_list = []
@@ -154,6 +156,7 @@ def main(args):
     loss_objectness_list = []
     loss_rpn_list = []
     train_loss_list_epoch = []
+    val_loss_list_epoch = []
     val_map_05 = []
     val_map = []
     start_epochs = 0
@@ -255,9 +258,12 @@ def main(args):
         scheduler = None
 
     save_best_model = SaveBestModel()
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter(keep=args['keep_checkpoints'])
 
     for epoch in range(start_epochs, NUM_EPOCHS):
         train_loss_hist.reset()
+        val_loss_hist.reset()
 
         _, batch_loss_list, \
             batch_loss_cls_list, \
@@ -275,10 +281,11 @@ def main(args):
             scaler=SCALER
         )
 
-        stats, val_pred_image = evaluate(
+        stats, val_pred_image, _, _, _, _, _ = validate(
             model, 
             valid_loader, 
-            device=DEVICE,
+            DEVICE,
+            val_loss_hist,
             save_valid_preds=SAVE_VALID_PREDICTIONS,
             out_dir=OUT_DIR,
             classes=CLASSES,
@@ -294,6 +301,7 @@ def main(args):
 
         # Append curent epoch's average loss to `train_loss_list_epoch`.
         train_loss_list_epoch.append(train_loss_hist.value)
+        val_loss_list_epoch.append(val_loss_hist.value)
         val_map_05.append(stats[1])
         val_map.append(stats[0])
 
@@ -307,6 +315,13 @@ def main(args):
             'train loss',
             save_name='train_loss_epoch' 
         )
+        save_loss_plot(
+            OUT_DIR, 
+            val_loss_list_epoch,
+            'epochs',
+            'val loss',
+            save_name='val_loss_epoch' 
+        )
         # Save all the training loss plots.
         save_loss_plot(
             OUT_DIR, 
@@ -401,10 +416,11 @@ def main(args):
             val_map_05,
             OUT_DIR,
             data_configs,
-            args['model']
+            args['model'],
+            writer=checkpoint_writer
         )
         # Save the model dictionary only for the current epoch.
-        save_model_state(model, OUT_DIR, data_configs, args['model'])
+        save_model_state(model, OUT_DIR, data_configs, args['model'], writer=checkpoint_writer)
         # Save best model if the current mAP @0.5:0.95 IoU is
         # greater than the last hightest.
         save_best_model(
@@ -413,9 +429,13 @@ def main(args):
             epoch, 
             OUT_DIR,
             data_configs,
-            args['model']
+            args['model'],
+            writer=checkpoint_writer
         )
     
+    # Wait for the last checkpoints to be written.
+    checkpoint_writer.close()
+
     # Save models to Weights&Biases.
     if not args['disable_wandb']:
         wandb_save_model(OUT_DIR)
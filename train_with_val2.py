@@ -14,7 +14,7 @@ python train.py --model fasterrcnn_resnet50_fpn --epochs 2 --use-train-aug --dat
 export CUDA_VISIBLE_DEVICES=0,1
 python -m torch.distributed.launch --nproc_per_node=2 --use_env train.py --data data_configs/smoke.yaml --epochs 100 --model fasterrcnn_resnet50_fpn --name smoke_training --batch 16
 """
-from torch_utils.engine import train_one_epoch, evaluate, utils
+from torch_utils.engine import train_one_epoch, validate, utils
 from torch.utils.data import distributed, RandomSampler, SequentialSampler
 from datasets import create_train_dataset, create_valid_dataset, create_train_loader, create_valid_loader
 from models.create_fasterrcnn_model import create_model
@@ -22,11 +22,11 @@ from utils.general import (
     set_training_dir, Averager, 
     save_model, save_loss_plot,
     show_tranformed_image,
-    save_mAP, save_model_state, SaveBestModel,
+    save_mAP, save_model_state, SaveBestModel, CheckpointWriter,
     yaml_save, init_seeds
 )
 from utils.logging import (
-    set_log, coco_log, csv_log
+    set_log, coco_log, csv_log,
     set_summary_writer, 
     tensorboard_loss_log, tensorboard_map_log,
     wandb_log, wandb_save_model, wandb_init
@@ -62,7 +62,7 @@ def parse_opt():
     parser.add_argument('--mosaic', default=0.0, type=float, help='probability of applying mosaic, (default, always apply)')
     parser.add_argument('-uta', '--use-train-aug', dest='use_train_aug', action='store_true', help='whether to use train augmentation, blur, gray,brightness contrast, color jitter, random gammaall at once')
     parser.add_argument( '-ca', '--cosine-annealing', dest='cosine_annealing', action='store_true', help='use cosine annealing warm restarts' )
-    parser.add_argument( '-w', '--weights', default=None, type=str, help='path to model weights if using pretrained weights' )    parser.add_argument(
+    parser.add_argument( '-w', '--weights', default=None, type=str, help='path to model weights if using pretrained weights' )
     parser.add_argument( '-r', '--resume-training', dest='resume_training', action='store_true', help='whether to resume training, if true, loads previous training plots and epochs and also loads the otpimizer state dictionary' )
     parser.add_argument( '-st', '--square-training', dest='square_training', action='store_true', help='Resize images to square shape instead of aspect ratio resizing for single image training. For mosaic training, this resizes \ single images to square shape first then puts them on a \ square canvas.' )
     parser.add_argument( '--world-size', default=1, type=int, help='number of distributed processes' )
@@ -72,6 +72,7 @@ def parse_opt():
     parser.add_argument( '--amp', action='store_true', help='use automatic mixed precision' )
     parser.add_argument( '--seed', default=0, type=int , help='golabl seed for training' )
     parser.add_argument( '--project-dir', dest='project_dir', default=None, help='save resutls to custom dir instead of `outputs` directory, --project-dir will be named if not already present', type=str )
+    parser.add_argument( '--keep-checkpoints', dest='keep_checkpoints', default=0, type=int, help='number of per epoch copies of last_model.pth to keep, (default 0, only the latest)' )
 
 
     args = vars(parser.parse_args())
@@ -146,21 +147,19 @@ def main(args):
 
     # Initialize the Averager class.
     train_loss_hist = Averager()
+    val_loss_hist = Averager()
     # Train and validation loss lists to store loss values of all
     # iterations till ena and plot graphs for all iterations.
-    #train_loss_list = []
-    #loss_cls_list = []
-    #loss_box_reg_list = []
-    #loss_objectness_list = []
-    #loss_rpn_list = []
-    #train_loss_list_epoch = []
-    #val_map_05 = []
-    #val_map = []
-    start_epochs = 0
+    train_loss_list = []
+    loss_cls_list = []
+    loss_box_reg_list = []
+    loss_objectness_list = []
+    loss_rpn_list = []
     train_loss_list_epoch = []
     val_loss_list_epoch = []
-    train_map_list_epoch = []
-    val_map_list_epoch = []
+    val_map_05 = []
+    val_map = []
+    start_epochs = 0
 
     if args['weights'] is None:
         print('Building model from scratch...')
@@ -259,17 +258,28 @@ def main(args):
         scheduler = None
 
     save_best_model = SaveBestModel()
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter(keep=args['keep_checkpoints'])
 
     for epoch in range(start_epochs, NUM_EPOCHS):
+        train_loss_hist.reset()
+        val_loss_hist.reset()
+
         # Perform training and evaluation
-        avg_train_loss, avg_train_map, avg_val_loss, avg_val_map, train_loss_hist = train_and_evaluate(
+        batch_loss_list, \
+            batch_loss_cls_list, \
+            batch_loss_box_reg_list, \
+            batch_loss_objectness_list, \
+            batch_loss_rpn_list, \
+            stats, val_pred_image = train_and_evaluate(
             model, 
             optimizer, 
             train_loader, 
             valid_loader, 
             device=DEVICE,
-            criterion=criterion,
             epoch=epoch,
+            train_loss_hist=train_loss_hist,
+            val_loss_hist=val_loss_hist,
             print_freq=100,
             scheduler=scheduler,
             scaler=SCALER,
@@ -278,53 +288,45 @@ def main(args):
             classes=CLASSES,
             colors=COLORS)
 
-        # Append current epoch's metrics
-        train_loss_list_epoch.append(avg_train_loss)
-        val_loss_list_epoch.append(avg_val_loss)
-        train_map_list_epoch.append(avg_train_map)
-        val_map_list_epoch.append(avg_val_map)
-
         # Append the current epoch's batch-wise losses to the `train_loss_list`.
-       # train_loss_list.extend(batch_loss_list)
-       # loss_cls_list.append(np.mean(np.array(batch_loss_cls_list,)))
-       # loss_box_reg_list.append(np.mean(np.array(batch_loss_box_reg_list)))
-       # loss_objectness_list.append(np.mean(np.array(batch_loss_objectness_list)))
-       # loss_rpn_list.append(np.mean(np.array(batch_loss_rpn_list)))
+        train_loss_list.extend(batch_loss_list)
+        loss_cls_list.append(np.mean(np.array(batch_loss_cls_list,)))
+        loss_box_reg_list.append(np.mean(np.array(batch_loss_box_reg_list)))
+        loss_objectness_list.append(np.mean(np.array(batch_loss_objectness_list)))
+        loss_rpn_list.append(np.mean(np.array(batch_loss_rpn_list)))
 
         # Append curent epoch's average loss to `train_loss_list_epoch`.
-       # train_loss_list_epoch.append(train_loss_hist.value)
-       # val_map_05.append(stats[1])
-       # val_map.append(stats[0])
+        train_loss_list_epoch.append(train_loss_hist.value)
+        val_loss_list_epoch.append(val_loss_hist.value)
+        val_map_05.append(stats[1])
+        val_map.append(stats[0])
 
         # Save loss plot for batch-wise list.
         save_loss_plot(OUT_DIR, train_loss_list)
         # Save loss plot for epoch-wise list.
         save_loss_plot( OUT_DIR, train_loss_list_epoch, 'epochs', 'train loss', save_name='train_loss_epoch' )
+        save_loss_plot( OUT_DIR, val_loss_list_epoch, 'epochs', 'val loss', save_name='val_loss_epoch' )
  
         # Save all the training loss plots.
-       # save_loss_plot( OUT_DIR, loss_cls_list, 'epochs', 'loss cls', save_name='train_loss_cls' ) 
-       # save_loss_plot( OUT_DIR, loss_box_reg_list, 'epochs', 'loss bbox reg', save_name='train_loss_bbox_reg' ) 
-       # save_loss_plot( OUT_DIR, loss_objectness_list, 'epochs', 'loss obj', save_name='train_loss_obj' ) 
-       # save_loss_plot( OUT_DIR, loss_rpn_list, 'epochs', 'loss rpn bbox', save_name='train_loss_rpn_bbox' )
-
-
+        save_loss_plot( OUT_DIR, loss_cls_list, 'epochs', 'loss cls', save_name='train_loss_cls' ) 
+        save_loss_plot( OUT_DIR, loss_box_reg_list, 'epochs', 'loss bbox reg', save_name='train_loss_bbox_reg' ) 
+        save_loss_plot( OUT_DIR, loss_objectness_list, 'epochs', 'loss obj', save_name='train_loss_obj' ) 
+        save_loss_plot( OUT_DIR, loss_rpn_list, 'epochs', 'loss rpn bbox', save_name='train_loss_rpn_bbox' )
 
         # Save mAP plots.
-        #save_mAP(OUT_DIR, val_map_05, val_map)
-        save_mAP(OUT_DIR, train_map_list_epoch, val_map_list_epoch)
+        save_mAP(OUT_DIR, val_map_05, val_map)
         # Save batch-wise train loss plot using TensorBoard. Better not to use it
         # as it increases the TensorBoard log sizes by a good extent (in 100s of MBs).
         # tensorboard_loss_log('Train loss', np.array(train_loss_list), writer)
 
         # Save epoch-wise train loss plot using TensorBoard.
-       # tensorboard_loss_log('Train loss', np.array(train_loss_list_epoch), writer, epoch)
+        tensorboard_loss_log('Train loss', np.array(train_loss_list_epoch), writer, epoch)
 
         # Save mAP plot using TensorBoard.
-       # tensorboard_map_log(name='mAP', val_map_05=np.array(val_map_05), val_map=np.array(val_map), writer=writer, epoch=epoch)
+        tensorboard_map_log(name='mAP', val_map_05=np.array(val_map_05), val_map=np.array(val_map), writer=writer, epoch=epoch)
 
-#        coco_log(OUT_DIR, stats)
-#        csv_log(OUT_DIR, stats,epoch,train_loss_list,loss_cls_list,loss_box_reg_list,loss_objectness_list,loss_rpn_list)
-#        csv_log(OUT_DIR, epoch,train_loss_list,loss_cls_list,loss_box_reg_list,loss_objectness_list,loss_rpn_list)
+        coco_log(OUT_DIR, stats)
+        csv_log(OUT_DIR, stats,epoch,train_loss_list,loss_cls_list,loss_box_reg_list,loss_objectness_list,loss_rpn_list)
 
         # WandB logging.
         if not args['disable_wandb']:
@@ -343,10 +345,11 @@ def main(args):
             val_map_05,
             OUT_DIR,
             data_configs,
-            args['model']
+            args['model'],
+            writer=checkpoint_writer
         )
         # Save the model dictionary only for the current epoch.
-        save_model_state(model, OUT_DIR, data_configs, args['model'])
+        save_model_state(model, OUT_DIR, data_configs, args['model'], writer=checkpoint_writer)
         # Save best model if the current mAP @0.5:0.95 IoU is
         # greater than the last hightest.
         save_best_model(
@@ -355,9 +358,13 @@ def main(args):
             epoch, 
             OUT_DIR,
             data_configs,
-            args['model']
+            args['model'],
+            writer=checkpoint_writer
         )
     
+    # Wait for the last checkpoints to be written.
+    checkpoint_writer.close()
+
     # Save models to Weights&Biases.
     if not args['disable_wandb']:
         wandb_save_model(OUT_DIR)
@@ -365,100 +372,52 @@ def main(args):
 
 def train_and_evaluate(
     model, optimizer, train_loader, valid_loader,
-    device, criterion, epoch, print_freq=100,
+    device, epoch, train_loss_hist, val_loss_hist,
+    print_freq=100,
     scheduler=None, scaler=None,
     save_valid_preds=False,
     out_dir=None, classes=None, colors=None):
-    # Initialize metrics and loss lists
-    train_loss_hist = AverageMeter()
-    batch_loss_list = []
-    batch_loss_cls_list = []
-    batch_loss_box_reg_list = []
-    batch_loss_objectness_list = []
-    batch_loss_rpn_list = []
-
-    # Training
-    model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
-    metric_logger.add_meter("lr", utils.SmoothedValue(window_size=1, fmt="{value:.6f}"))
-    header = f"Epoch: [{epoch}]"
-
-    for images, targets in metric_logger.log_every(train_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device).to(torch.int64) for k, v in t.items()} for t in targets]
-
-        with torch.cuda.amp.autocast(enabled=scaler is not None):
-            loss_dict = model(images, targets)
-            losses = sum(loss for loss in loss_dict.values())
-
-        # Reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        losses_reduced = sum(loss for loss in loss_dict_reduced.values())
-        loss_value = losses_reduced.item()
-
-        if not math.isfinite(loss_value):
-            print(f"Loss is {loss_value}, stopping training")
-            print(loss_dict_reduced)
-            sys.exit(1)
-
-        optimizer.zero_grad()
-        if scaler is not None:
-            scaler.scale(losses).backward()
-            scaler.step(optimizer)
-            scaler.update()
-        else:
-            losses.backward()
-            optimizer.step()
-
-        if scheduler is not None:
-            scheduler.step()
-
-        metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
-        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
-
-        batch_loss_list.append(loss_value)
-        batch_loss_cls_list.append(loss_dict_reduced['loss_classifier'].detach().cpu())
-        batch_loss_box_reg_list.append(loss_dict_reduced['loss_box_reg'].detach().cpu())
-        batch_loss_objectness_list.append(loss_dict_reduced['loss_objectness'].detach().cpu())
-        batch_loss_rpn_list.append(loss_dict_reduced['loss_rpn_box_reg'].detach().cpu())
-        train_loss_hist.send(loss_value)
-
-    # Compute training mAP
-    model.eval()
-    metric_logger = utils.MetricLogger(delimiter="  ")
-    coco = get_coco_api_from_dataset(train_loader.dataset)
-    iou_types = _get_iou_types(model)
-    coco_evaluator = CocoEvaluator(coco, iou_types)
-    
-    total_loss = 0.0
-    num_batches = 0
-    
-    for images, targets in metric_logger.log_every(train_loader, print_freq, header):
-        num_batches += 1
-        images = list(img.to(device) for img in images)
-        targets = [{k: v.to(device).to(torch.int64) for k, v in t.items()} for t in targets]
-
-        with torch.no_grad():
-            outputs = model(images)
-            if criterion:
-                loss_dict = criterion(outputs, targets)
-                total_loss += sum(loss for loss in loss_dict.values()).item()
-
-        outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
-        res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
-        coco_evaluator.update(res)
-
-    metric_logger.synchronize_between_processes()
-    coco_evaluator.synchronize_between_processes()
-    coco_evaluator.accumulate()
-    stats = coco_evaluator.summarize()
-
-    avg_train_loss = np.mean(batch_loss_list)
-    avg_train_map = stats[0]
-    avg_val_loss = total_loss / num_batches
-    avg_val_map = stats[1]
-
-    return avg_train_loss, avg_train_map, avg_val_loss, avg_val_map, train_loss_hist
+    """
+    One training epoch followed by a single pass validation which gives
+    the validation losses and the COCO stats from the same forward pass.
+    """
+    _, batch_loss_list, \
+        batch_loss_cls_list, \
+        batch_loss_box_reg_list, \
+        batch_loss_objectness_list, \
+        batch_loss_rpn_list = train_one_epoch(
+        model, 
+        optimizer, 
+        train_loader, 
+        device, 
+        epoch, 
+        train_loss_hist,
+        print_freq=print_freq,
+        scheduler=scheduler,
+        scaler=scaler
+    )
+
+    stats, val_pred_image, _, _, _, _, _ = validate(
+        model,
+        valid_loader,
+        device,
+        val_loss_hist,
+        save_valid_preds=save_valid_preds,
+        out_dir=out_dir,
+        classes=classes,
+        colors=colors,
+        print_freq=print_freq
+    )
+
+    return (
+        batch_loss_list,
+        batch_loss_cls_list,
+        batch_loss_box_reg_list,
+        batch_loss_objectness_list,
+        batch_loss_rpn_list,
+        stats,
+        val_pred_image
+    )
 
 
 
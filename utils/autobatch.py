@@ -0,0 +1,159 @@
+"""
+Automatic batch size selection. Runs a few synthetic training forward and
+backward passes with growing batch sizes and picks the largest batch whose
+peak memory stays within a headroom of the device memory.
+
+USAGE:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --imgsz 640 --batch auto
+"""
+
+import os
+import resource
+import time
+import torch
+
+def parse_batch_size(value):
+    """
+    `type` for the `--batch` argument, a positive integer or 'auto'.
+    """
+    if value == 'auto':
+        return value
+    return int(value)
+
+def synthetic_batch(batch_size, img_size, num_classes, aspect_ratio=1.0):
+    """
+    Random images of height `img_size` and width `img_size * aspect_ratio`
+    with four random boxes each.
+    """
+    width = int(round(img_size * aspect_ratio))
+    images = [torch.rand(3, img_size, width) for _ in range(batch_size)]
+    targets = []
+    for _ in range(batch_size):
+        xy = torch.rand(4, 2) * min(img_size, width) * 0.5
+        wh = torch.rand(4, 2) * min(img_size, width) * 0.4 + 16
+        targets.append({
+            'boxes': torch.cat([xy, xy + wh], dim=1),
+            'labels': torch.randint(1, num_classes, (4,))
+        })
+    return images, targets
+
+def _memory_limit(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    # The RAM is shared by all the local processes of a distributed run,
+    # each of them trains with the chosen batch size.
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // local_world_size
+
+def _peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    # Peak resident set size of the process, `ru_maxrss` is in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def autobatch(
+    model,
+    img_size,
+    device,
+    amp=False,
+    headroom=0.2,
+    max_batch=128,
+    steps=2,
+    aspect_ratio=1.0,
+    optimizer_state_copies=1
+):
+    """
+    Find the largest batch size (powers of 2) for training `model` at
+    `img_size`. The model weights, buffers (batch norm statistics) and
+    train/eval mode are restored afterwards.
+
+    :param model: The model, already on `device`.
+    :param img_size: Training image size (`--imgsz`).
+    :param device: Computation device.
+    :param amp: Probe with automatic mixed precision.
+    :param headroom: Fraction of the device memory to leave free.
+    :param max_batch: Largest batch size to try.
+    :param steps: Timed steps per candidate after one warmup step.
+    :param aspect_ratio: Width / height of the synthetic images.
+    :param optimizer_state_copies: Copies of the trainable parameters the
+        optimizer keeps as state per process (`utils.optimizer.STATE_COPIES`,
+        divided by the number of processes with ZeRO sharding).
+
+    Returns the chosen batch size.
+    """
+    device = torch.device(device)
+    num_classes = model.roi_heads.box_predictor.cls_score.out_features
+    limit = _memory_limit(device) * (1 - headroom)
+    # The optimizer is not part of the probe, its state is added to the
+    # measured peak.
+    optimizer_bytes = optimizer_state_copies * sum(
+        p.numel() * p.element_size() for p in model.parameters() if p.requires_grad
+    )
+
+    was_training = model.training
+    state_dict = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    model.train()
+
+    print(
+        f"Probing batch sizes at image size {img_size}, "
+        f"{'AMP' if amp else 'FP32'}, memory limit {limit / 1024**3:.2f} GB"
+    )
+    print(f"{'batch':>6} {'peak memory (GB)':>17} {'images/sec':>11}")
+    best = None
+    last = None
+    batch_size = 1
+    while batch_size <= max_batch:
+        images, targets = synthetic_batch(
+            batch_size, img_size, num_classes, aspect_ratio
+        )
+        images = [image.to(device) for image in images]
+        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        try:
+            for i in range(steps + 1):
+                if i == 1:
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize(device)
+                    start = time.time()
+                with torch.cuda.amp.autocast(enabled=amp):
+                    loss_dict = model(images, targets)
+                    losses = sum(loss for loss in loss_dict.values())
+                losses.backward()
+                model.zero_grad(set_to_none=True)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+        except torch.cuda.OutOfMemoryError:
+            print(f"{batch_size:>6} {'out of memory':>17}")
+            break
+        images_per_sec = batch_size * steps / (time.time() - start)
+        peak = _peak_memory(device) + optimizer_bytes
+        fits = peak <= limit
+        print(
+            f"{batch_size:>6} {peak / 1024**3:>17.2f} {images_per_sec:>11.2f}"
+            f"{'' if fits else '  (over the limit)'}"
+        )
+        if not fits:
+            break
+        best = batch_size
+        # Memory grows about linearly with the batch size. Do not try a
+        # batch that is expected to go over the limit, running out of
+        # memory on the CPU kills the process instead of raising.
+        if last is not None:
+            per_image = (peak - last[1]) / (batch_size - last[0])
+            if peak + per_image * batch_size > limit:
+                break
+        last = (batch_size, peak)
+        batch_size *= 2
+
+    model.zero_grad(set_to_none=True)
+    model.load_state_dict(state_dict)
+    model.train(was_training)
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    assert best is not None, \
+        f"Batch size 1 does not fit in memory at image size {img_size}"
+    print(f"Using batch size {best}")
+    return best
@@ -0,0 +1,111 @@
+"""
+Disk cache of the decoded images and parsed XML annotations of a dataset
+split, shared between training runs (e.g. the trials of `sweep.py`).
+
+The images are stored as RGB uint8 at their original resolution in a
+single memory-mapped file, so runs with a different `--imgsz` use the
+same cache. The file list is indexed and cleaned once. The cache is
+rebuilt when the image or label directory changes (files added, removed
+or renamed), delete it after editing files in place.
+
+USAGE:
+python train.py --model fasterrcnn_nano --data data_configs/voc.yaml --data-cache data_cache
+"""
+
+import hashlib
+import os
+import torch
+import numpy as np
+
+from tqdm.auto import tqdm
+
+class DataCache:
+    """
+    :param cache_dir: Root directory of the cache, every split gets its own
+        sub directory.
+    :param images_path: Image directory of the split.
+    :param labels_path: XML annotation directory of the split.
+    """
+    def __init__(self, cache_dir, images_path, labels_path):
+        images_path = os.path.abspath(images_path)
+        labels_path = os.path.abspath(labels_path)
+        key = hashlib.sha1(f"{images_path}|{labels_path}".encode()).hexdigest()[:12]
+        self.cache_dir = os.path.join(cache_dir, key)
+        self.images_file = os.path.join(self.cache_dir, 'images.u8')
+        self.index_path = os.path.join(self.cache_dir, 'index.pt')
+        self.meta = {
+            'images_path': images_path,
+            'labels_path': labels_path,
+            'images_mtime': os.stat(images_path).st_mtime,
+            'labels_mtime': os.stat(labels_path).st_mtime
+        }
+        self.index = None
+        self._memmap = None
+        if os.path.exists(self.index_path):
+            self.index = torch.load(self.index_path)
+
+    def __getstate__(self):
+        # Do not pickle the mapped images into the data loader workers.
+        state = self.__dict__.copy()
+        state['_memmap'] = None
+        return state
+
+    def is_valid(self):
+        """
+        Returns True if a complete cache of the current split exists.
+        """
+        return self.index is not None and self.index['meta'] == self.meta
+
+    def build(self, image_names, read_image, read_annotations):
+        """
+        Decode every image and parse every annotation file once.
+
+        :param image_names: Cleaned, sorted image file names of the split.
+        :param read_image: Function returning the RGB uint8 image of a name.
+        :param read_annotations: Function returning the list of
+            (class name, xmin, ymin, xmax, ymax) of a name.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        items = {}
+        annotations = {}
+        offset = 0
+        # Written under temporary names and moved in place at the end,
+        # the index last, so that a concurrent run never sees a partial
+        # cache.
+        images_tmp = f"{self.images_file}.{os.getpid()}.tmp"
+        print(f"Caching {len(image_names)} images in {self.cache_dir}...")
+        with open(images_tmp, 'wb') as f:
+            for image_name in tqdm(image_names, total=len(image_names)):
+                image = np.ascontiguousarray(read_image(image_name), dtype=np.uint8)
+                f.write(image.tobytes())
+                items[image_name] = (offset, image.shape)
+                offset += image.size
+                annotations[image_name] = read_annotations(image_name)
+        os.replace(images_tmp, self.images_file)
+        self.index = {
+            'meta': self.meta,
+            'items': items,
+            'annotations': annotations
+        }
+        index_tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        torch.save(self.index, index_tmp)
+        os.replace(index_tmp, self.index_path)
+        self._memmap = None
+
+    @property
+    def image_names(self):
+        return list(self.index['items'].keys())
+
+    def image(self, image_name):
+        """
+        RGB uint8 image, a read-only view of the cache file.
+        """
+        # Opened lazily so that every data loader worker gets its own map.
+        if self._memmap is None:
+            self._memmap = np.memmap(self.images_file, dtype=np.uint8, mode='r')
+        offset, shape = self.index['items'][image_name]
+        size = int(np.prod(shape))
+        return self._memmap[offset:offset+size].reshape(shape)
+
+    def annotations(self, image_name):
+        return self.index['annotations'][image_name]
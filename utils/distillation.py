@@ -0,0 +1,287 @@
+"""
+Knowledge distillation from a large, frozen teacher detector (any
+`create_model` entry) to a small student.
+
+The teacher runs once over the non-augmented training images. For every
+image its top scoring RPN proposals, their objectness and the RoI head
+class logits for them are stored in a memory-mapped file. The student then
+trains on the same images with its detection losses plus:
+- `loss_distill_cls`: KL divergence between the temperature softened class
+  distributions of the teacher and of the student RoI head, both on the
+  teacher's proposals.
+- `loss_distill_obj`: binary cross entropy between the student RPN
+  objectness of its anchors and the objectness of the teacher proposals
+  they overlap (0 for anchors that overlap none).
+
+USAGE:
+python train.py --model fasterrcnn_nano --data data_configs/voc.yaml --teacher-model fasterrcnn_resnet50_fpn_v2 --teacher-weights outputs/training/res_1/best_model.pth --distill-alpha 1.0 --distill-temp 2.0
+"""
+
+import os
+import torch
+import torch.nn.functional as F
+import numpy as np
+
+from collections import OrderedDict
+from torchvision.ops import boxes as box_ops
+from torchvision.models.detection.rpn import concat_box_prediction_layers
+from torchvision.models.detection.transform import resize_boxes
+from tqdm.auto import tqdm
+
+def rpn_forward(model, images, features):
+    """
+    `model.rpn` forward pass that also returns the raw head outputs and the
+    anchors, which `RegionProposalNetwork.forward` keeps to itself.
+
+    :param images: `ImageList` from `model.transform`.
+    :param features: Backbone features, OrderedDict.
+
+    Returns the flattened objectness logits and box deltas, the per image
+    anchors, and the filtered proposals with their objectness probability.
+    """
+    features = list(features.values())
+    objectness, pred_bbox_deltas = model.rpn.head(features)
+    anchors = model.rpn.anchor_generator(images, features)
+
+    num_images = len(anchors)
+    num_anchors_per_level = [o[0].numel() for o in objectness]
+    objectness, pred_bbox_deltas = concat_box_prediction_layers(
+        objectness, pred_bbox_deltas
+    )
+    proposals = model.rpn.box_coder.decode(pred_bbox_deltas.detach(), anchors)
+    proposals = proposals.view(num_images, -1, 4)
+    boxes, scores = model.rpn.filter_proposals(
+        proposals, objectness, images.image_sizes, num_anchors_per_level
+    )
+    return objectness, pred_bbox_deltas, anchors, boxes, scores
+
+def roi_class_logits(model, features, boxes, image_sizes):
+    """
+    RoI head class logits of `model` for the given per image `boxes`.
+    """
+    box_features = model.roi_heads.box_roi_pool(features, boxes, image_sizes)
+    box_features = model.roi_heads.box_head(box_features)
+    class_logits, _ = model.roi_heads.box_predictor(box_features)
+    return class_logits
+
+class TeacherCache:
+    """
+    Cached teacher outputs, one fixed size record per training image,
+    indexed by the dataset `image_id`. A record holds up to `top_k`
+    proposals as (x1, y1, x2, y2, objectness, class logits...) with the
+    boxes in the coordinates of the dataset image.
+
+    :param cache_dir: Directory holding `teacher.npy` and `index.pt`.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.outputs_path = os.path.join(cache_dir, 'teacher.npy')
+        self.index_path = os.path.join(cache_dir, 'index.pt')
+        self.index = None
+        self._outputs = None
+        if os.path.exists(self.index_path):
+            self.index = torch.load(self.index_path)
+
+    def is_valid(self, meta):
+        """
+        Returns True if a complete cache built with the same settings
+        (`meta`) already exists on disk.
+        """
+        return self.index is not None and self.index['meta'] == meta
+
+    @torch.inference_mode()
+    def build(self, teacher, data_loader, device, meta, top_k=64):
+        """
+        Run the teacher once over every image in `data_loader` and write
+        its outputs to disk.
+
+        :param teacher: The teacher Faster RCNN model.
+        :param data_loader: Loader over the non-augmented training images,
+            `image_id` has to be the dataset index.
+        :param device: Computation device.
+        :param meta: Dictionary of settings the cache depends on.
+        :param top_k: Number of teacher proposals kept per image.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        teacher.eval()
+        num_images = len(data_loader.dataset)
+        num_classes = teacher.roi_heads.box_predictor.cls_score.out_features
+        # Written under temporary names and moved in place at the end,
+        # the index last, so that an interrupted or concurrent build never
+        # leaves an index over a partial file.
+        outputs_tmp = f"{self.outputs_path}.{os.getpid()}.tmp"
+        outputs = np.lib.format.open_memmap(
+            outputs_tmp,
+            mode='w+',
+            dtype=np.float32,
+            shape=(num_images, top_k, 5 + num_classes)
+        )
+        counts = np.zeros(num_images, dtype=np.int64)
+        print('Caching teacher outputs...')
+        for images, targets in tqdm(data_loader, total=len(data_loader)):
+            images = [image.to(device) for image in images]
+            original_sizes = [tuple(image.shape[-2:]) for image in images]
+            image_list, _ = teacher.transform(images)
+            features = teacher.backbone(image_list.tensors)
+            if isinstance(features, torch.Tensor):
+                features = OrderedDict([('0', features)])
+            _, _, _, boxes, scores = rpn_forward(teacher, image_list, features)
+            # The proposals are sorted by objectness.
+            boxes = [b[:top_k] for b in boxes]
+            class_logits = roi_class_logits(
+                teacher, features, boxes, image_list.image_sizes
+            ).split([len(b) for b in boxes])
+            for i, target in enumerate(targets):
+                idx = target['image_id'].item()
+                count = len(boxes[i])
+                record = torch.cat([
+                    resize_boxes(
+                        boxes[i], image_list.image_sizes[i], original_sizes[i]
+                    ),
+                    scores[i][:top_k, None],
+                    class_logits[i]
+                ], dim=1)
+                outputs[idx, :count] = record.float().cpu().numpy()
+                counts[idx] = count
+        outputs.flush()
+        del outputs
+        os.replace(outputs_tmp, self.outputs_path)
+        self.index = {
+            'meta': meta,
+            'num_classes': num_classes,
+            'counts': counts
+        }
+        index_tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        torch.save(self.index, index_tmp)
+        os.replace(index_tmp, self.index_path)
+        self._outputs = None
+        print(f"Cached teacher outputs of {num_images} images")
+
+    def get(self, image_ids, device):
+        """
+        Teacher boxes, objectness and class logits of the images with
+        `image_ids`, as lists with one tensor per image on `device`.
+        """
+        # Opened lazily so that the file is only mapped once it is needed.
+        if self._outputs is None:
+            self._outputs = np.load(self.outputs_path, mmap_mode='r')
+        boxes, scores, logits = [], [], []
+        for idx in image_ids:
+            count = self.index['counts'][idx]
+            record = torch.from_numpy(np.array(self._outputs[idx, :count]))
+            record = record.to(device, non_blocking=True)
+            boxes.append(record[:, :4])
+            scores.append(record[:, 4])
+            logits.append(record[:, 5:])
+        return boxes, scores, logits
+
+class DistillationLoss:
+    """
+    Student forward pass returning its detection losses plus the weighted
+    distillation losses, pass as `loss_fn` to `train_one_epoch`.
+
+    :param teacher_cache: Built `TeacherCache`.
+    :param alpha: Weight of the distillation losses.
+    :param temperature: Softmax temperature for the class distributions.
+    :param fg_iou_thresh: IoU of an anchor with a teacher proposal to take
+        over its objectness.
+    :param num_anchor_samples: Anchors per image in the objectness loss,
+        up to half of them with a teacher objectness.
+    """
+    def __init__(
+        self,
+        teacher_cache,
+        alpha=1.0,
+        temperature=2.0,
+        fg_iou_thresh=0.5,
+        num_anchor_samples=256
+    ):
+        self.teacher_cache = teacher_cache
+        self.alpha = alpha
+        self.temperature = temperature
+        self.fg_iou_thresh = fg_iou_thresh
+        self.num_anchor_samples = num_anchor_samples
+
+    def __call__(self, model, images, targets):
+        original_sizes = [tuple(image.shape[-2:]) for image in images]
+        image_ids = [target['image_id'].item() for target in targets]
+        images, targets = model.transform(images, targets)
+        features = model.backbone(images.tensors)
+        if isinstance(features, torch.Tensor):
+            features = OrderedDict([('0', features)])
+
+        objectness, pred_bbox_deltas, anchors, proposals, _ = rpn_forward(
+            model, images, features
+        )
+        labels, matched_gt_boxes = model.rpn.assign_targets_to_anchors(
+            anchors, targets
+        )
+        regression_targets = model.rpn.box_coder.encode(matched_gt_boxes, anchors)
+        loss_objectness, loss_rpn_box_reg = model.rpn.compute_loss(
+            objectness, pred_bbox_deltas, labels, regression_targets
+        )
+        _, loss_dict = model.roi_heads(
+            features, proposals, images.image_sizes, targets
+        )
+        loss_dict['loss_objectness'] = loss_objectness
+        loss_dict['loss_rpn_box_reg'] = loss_rpn_box_reg
+
+        teacher_boxes, teacher_scores, teacher_logits = self.teacher_cache.get(
+            image_ids, objectness.device
+        )
+        teacher_boxes = [
+            resize_boxes(boxes, original_size, image_size)
+            for boxes, original_size, image_size in zip(
+                teacher_boxes, original_sizes, images.image_sizes
+            )
+        ]
+        loss_dict['loss_distill_cls'] = self.alpha * self.class_loss(
+            model, features, teacher_boxes, images.image_sizes, teacher_logits
+        )
+        loss_dict['loss_distill_obj'] = self.alpha * self.objectness_loss(
+            objectness.view(len(anchors), -1),
+            anchors,
+            teacher_boxes,
+            teacher_scores
+        )
+        return loss_dict
+
+    def class_loss(self, model, features, boxes, image_sizes, teacher_logits):
+        class_logits = roi_class_logits(model, features, boxes, image_sizes)
+        teacher_logits = torch.cat(teacher_logits)
+        if teacher_logits.shape[0] == 0:
+            return class_logits.sum() * 0
+        t = self.temperature
+        return F.kl_div(
+            F.log_softmax(class_logits / t, dim=-1),
+            F.softmax(teacher_logits / t, dim=-1),
+            reduction='batchmean'
+        ) * (t * t)
+
+    def objectness_loss(self, objectness, anchors, boxes, scores):
+        losses = []
+        for logits, image_anchors, image_boxes, image_scores in zip(
+            objectness, anchors, boxes, scores
+        ):
+            soft_targets = torch.zeros_like(logits)
+            if image_boxes.shape[0] > 0:
+                iou = box_ops.box_iou(image_anchors, image_boxes)
+                overlap = (iou >= self.fg_iou_thresh) * image_scores[None]
+                soft_targets = overlap.max(dim=1).values.to(logits.dtype)
+            positive = torch.where(soft_targets > 0)[0]
+            negative = torch.where(soft_targets == 0)[0]
+            num_positive = min(positive.numel(), self.num_anchor_samples // 2)
+            num_negative = min(
+                negative.numel(), self.num_anchor_samples - num_positive
+            )
+            positive = positive[
+                torch.randperm(positive.numel(), device=positive.device)[:num_positive]
+            ]
+            negative = negative[
+                torch.randperm(negative.numel(), device=negative.device)[:num_negative]
+            ]
+            sampled = torch.cat([positive, negative])
+            losses.append(F.binary_cross_entropy_with_logits(
+                logits[sampled], soft_targets[sampled]
+            ))
+        return torch.stack(losses).mean()
@@ -45,11 +45,11 @@ def eval_forward(model, images, targets):
     features = model.backbone(images.tensors)
     if isinstance(features, torch.Tensor):
         features = OrderedDict([("0", features)])
-    model.rpn.training=True
-    #model.roi_heads.training=True
-
 
     #####proposals, proposal_losses = model.rpn(images, features, targets)
+    # The RPN stays in eval mode so that the proposals are filtered with the
+    # inference `pre_nms_top_n`/`post_nms_top_n`, exactly as `model(images)`
+    # would. The losses only need the raw head outputs and the anchors.
     features_rpn = list(features.values())
     objectness, pred_bbox_deltas = model.rpn.head(features_rpn)
     anchors = model.rpn.anchor_generator(images, features_rpn)
@@ -78,30 +78,19 @@ def eval_forward(model, images, targets):
     }
 
     #####detections, detector_losses = model.roi_heads(features, proposals, images.image_sizes, targets)
+    # Losses use the sampled training proposals (with the ground truth boxes
+    # appended) while the detections use all the proposals like inference.
     image_shapes = images.image_sizes
-    proposals, matched_idxs, labels, regression_targets = model.roi_heads.select_training_samples(proposals, targets)
-    box_features = model.roi_heads.box_roi_pool(features, proposals, image_shapes)
+    sampled_proposals, matched_idxs, labels, regression_targets = model.roi_heads.select_training_samples(proposals, targets)
+    box_features = model.roi_heads.box_roi_pool(features, sampled_proposals, image_shapes)
     box_features = model.roi_heads.box_head(box_features)
     class_logits, box_regression = model.roi_heads.box_predictor(box_features)
 
-    result: List[Dict[str, torch.Tensor]] = []
-    detector_losses = {}
     loss_classifier, loss_box_reg = fastrcnn_loss(class_logits, box_regression, labels, regression_targets)
     detector_losses = {"loss_classifier": loss_classifier, "loss_box_reg": loss_box_reg}
-    boxes, scores, labels = model.roi_heads.postprocess_detections(class_logits, box_regression, proposals, image_shapes)
-    num_images = len(boxes)
-    for i in range(num_images):
-        result.append(
-            {
-                "boxes": boxes[i],
-                "labels": labels[i],
-                "scores": scores[i],
-            }
-        )
-    detections = result
+
+    detections, _ = model.roi_heads(features, proposals, image_shapes)
     detections = model.transform.postprocess(detections, images.image_sizes, original_image_sizes)  # type: ignore[operator]
-    model.rpn.training=False
-    model.roi_heads.training=False
     losses = {}
     losses.update(detector_losses)
     losses.update(proposal_losses)
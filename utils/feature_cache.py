@@ -0,0 +1,181 @@
+"""
+Disk cache of frozen backbone (and FPN) feature maps for head-only
+fine-tuning. The backbone is run once over the non-augmented training
+images and the feature maps are stored as float16 in a single memory-mapped
+file. Later epochs train `model.rpn` and `model.roi_heads` straight from
+the cache without touching the backbone.
+
+USAGE:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --weights weights.pth --cache-features --data data_configs/voc.yaml
+"""
+
+import hashlib
+import os
+import torch
+import numpy as np
+
+from collections import OrderedDict
+from torch.utils.data import Dataset
+from torchvision.models.detection.image_list import ImageList
+from tqdm.auto import tqdm
+
+def file_signature(path):
+    """
+    (size, modification time) of the file at `path`, None if there is
+    none, so that a file rewritten at the same path invalidates the cache.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def names_digest(names):
+    """
+    SHA1 hex digest of the sorted `names`, e.g. the training image names.
+    """
+    return hashlib.sha1('\n'.join(sorted(names)).encode()).hexdigest()
+
+class FeatureCache(Dataset):
+    """
+    Dataset over cached backbone features. Each item is one image and
+    contains the per level feature maps, the image size after
+    `model.transform`, the padded image size and the transformed target.
+
+    :param cache_dir: Directory holding `features.fp16` and `index.pt`.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.features_path = os.path.join(cache_dir, 'features.fp16')
+        self.index_path = os.path.join(cache_dir, 'index.pt')
+        self.index = None
+        self._memmap = None
+        if os.path.exists(self.index_path):
+            self.index = torch.load(self.index_path)
+
+    def is_valid(self, meta):
+        """
+        Returns True if a complete cache built with the same settings
+        (`meta`) already exists on disk.
+        """
+        return self.index is not None and self.index['meta'] == meta
+
+    @torch.inference_mode()
+    def build(self, model, data_loader, device, meta):
+        """
+        Run `model.transform` and `model.backbone` once over every image in
+        `data_loader` and write the feature maps to disk.
+
+        :param model: The Faster RCNN model, backbone weights already loaded.
+        :param data_loader: Loader over the non-augmented training images.
+        :param device: Computation device.
+        :param meta: Dictionary of settings the cache depends on.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        was_training = model.training
+        model.eval()
+        level_names = None
+        items = []
+        offset = 0
+        print('Caching backbone features...')
+        # Written under temporary names and moved in place at the end,
+        # the index last, so that an interrupted or concurrent build never
+        # leaves an index over a partial file.
+        features_tmp = f"{self.features_path}.{os.getpid()}.tmp"
+        with open(features_tmp, 'wb') as f:
+            for images, targets in tqdm(data_loader, total=len(data_loader)):
+                # One image at a time so that no feature map carries the
+                # padding of another image in the batch.
+                for image, target in zip(images, targets):
+                    target = {
+                        'boxes': target['boxes'].to(device, torch.float32),
+                        'labels': target['labels'].to(device, torch.int64)
+                    }
+                    image_list, trans_targets = model.transform(
+                        [image.to(device)], [target]
+                    )
+                    features = model.backbone(image_list.tensors)
+                    if isinstance(features, torch.Tensor):
+                        features = OrderedDict([('0', features)])
+                    if level_names is None:
+                        level_names = list(features.keys())
+                    levels = []
+                    for name in level_names:
+                        feat = features[name][0].to(torch.float16).cpu().numpy()
+                        f.write(feat.tobytes())
+                        levels.append((offset, tuple(feat.shape)))
+                        offset += feat.size
+                    items.append({
+                        'levels': levels,
+                        'image_size': tuple(image_list.image_sizes[0]),
+                        'padded_size': tuple(image_list.tensors.shape[-2:]),
+                        'target': {
+                            k: v.cpu() for k, v in trans_targets[0].items()
+                        }
+                    })
+        os.replace(features_tmp, self.features_path)
+        self.index = {
+            'meta': meta,
+            'level_names': level_names,
+            'items': items
+        }
+        index_tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        torch.save(self.index, index_tmp)
+        os.replace(index_tmp, self.index_path)
+        self._memmap = None
+        model.train(was_training)
+        size_gb = offset * 2 / (1024 ** 3)
+        print(f"Cached features of {len(items)} images ({size_gb:.2f} GB)")
+
+    def __len__(self):
+        return len(self.index['items'])
+
+    def __getitem__(self, idx):
+        # Opened lazily so that every data loader worker gets its own map.
+        if self._memmap is None:
+            self._memmap = np.memmap(
+                self.features_path, dtype=np.float16, mode='r'
+            )
+        item = self.index['items'][idx]
+        features = []
+        for offset, shape in item['levels']:
+            size = int(np.prod(shape))
+            feat = self._memmap[offset:offset+size].reshape(shape)
+            features.append(torch.from_numpy(np.array(feat)))
+        return features, item['image_size'], item['padded_size'], item['target']
+
+    def collate_fn(self, batch):
+        """
+        Zero pad the per level feature maps to the largest map in the batch
+        and stack them, the same way `model.transform` pads the images.
+        """
+        features, image_sizes, padded_sizes, targets = zip(*batch)
+        batched = OrderedDict()
+        for level, name in enumerate(self.index['level_names']):
+            maps = [f[level] for f in features]
+            c = maps[0].shape[0]
+            h = max(m.shape[1] for m in maps)
+            w = max(m.shape[2] for m in maps)
+            out = maps[0].new_zeros((len(maps), c, h, w))
+            for i, m in enumerate(maps):
+                out[i, :, :m.shape[1], :m.shape[2]].copy_(m)
+            batched[name] = out
+        padded_h = max(s[0] for s in padded_sizes)
+        padded_w = max(s[1] for s in padded_sizes)
+        return batched, list(image_sizes), (padded_h, padded_w), list(targets)
+
+def cached_batch_to_device(batch, device, dtype=torch.float32):
+    """
+    Move a collated cached batch to `device` and build the `ImageList` that
+    the RPN anchor generator expects. The image tensor is never needed,
+    only its shape, so an expanded zero sized view is used.
+    """
+    features, image_sizes, padded_size, targets = batch
+    features = OrderedDict(
+        (k, v.to(device, non_blocking=True).to(dtype)) for k, v in features.items()
+    )
+    placeholder = torch.zeros((1, 1, 1, 1), dtype=dtype, device=device).expand(
+        len(image_sizes), 3, padded_size[0], padded_size[1]
+    )
+    image_list = ImageList(placeholder, [tuple(s) for s in image_sizes])
+    targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    return image_list, features, targets
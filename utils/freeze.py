@@ -0,0 +1,140 @@
+"""
+Progressive freezing of the backbone stages.
+
+The backbone is split into stages (the children of `backbone.body` and
+the FPN for the torchvision style backbones, the children of the backbone
+otherwise). The whole backbone is frozen for the first epochs and the
+stages are then unfrozen from the output side, all at once or one every
+few epochs. A frozen stage has no trainable parameters, runs under
+`torch.no_grad()` and keeps its batch norm layers in eval mode, so the
+backward pass stops at the first trainable stage.
+
+The optimizer (and the DDP wrapper) only know about the parameters that
+are trainable when they are built, so they have to be rebuilt whenever
+`FreezeScheduler.step` reports a change.
+
+USAGE:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --freeze-backbone-epochs 3 --unfreeze-every 2
+"""
+
+import torch
+
+from types import MethodType
+
+def _no_grad_forward(self, *args, **kwargs):
+    with torch.no_grad():
+        return type(self).forward(self, *args, **kwargs)
+
+def _frozen_train(self, mode=True):
+    # Batch norm statistics of a frozen stage are not updated.
+    return torch.nn.Module.train(self, False)
+
+def backbone_stages(model):
+    """
+    Names of the backbone stages of `model` that have parameters, ordered
+    from the input to the output.
+    """
+    backbone = model.backbone
+    if hasattr(backbone, 'body'):
+        names = [f"backbone.body.{name}" for name, _ in backbone.body.named_children()]
+        names += [
+            f"backbone.{name}" for name, _ in backbone.named_children() if name != 'body'
+        ]
+    else:
+        names = [f"backbone.{name}" for name, _ in backbone.named_children()]
+    return [
+        name for name in names
+        if next(model.get_submodule(name).parameters(), None) is not None
+    ]
+
+class FreezeScheduler:
+    """
+    :param model: The model, not wrapped in DDP.
+    :param freeze_epochs: Number of epochs the whole backbone is frozen.
+    :param unfreeze_every: After `freeze_epochs`, unfreeze one stage every
+        `unfreeze_every` epochs starting from the output side. 0 unfreezes
+        all stages at once.
+    """
+    def __init__(self, model, freeze_epochs, unfreeze_every=0):
+        self.model = model
+        self.freeze_epochs = freeze_epochs
+        self.unfreeze_every = unfreeze_every
+        self.stages = backbone_stages(model)
+        # Parameters frozen by the model factory stay frozen.
+        self.requires_grad = {
+            id(p): p.requires_grad for p in model.backbone.parameters()
+        }
+        self.num_frozen = 0
+
+    def frozen_stages(self, epoch):
+        """
+        Number of frozen stages (counted from the input) at `epoch`.
+        """
+        if epoch < self.freeze_epochs:
+            return len(self.stages)
+        if self.unfreeze_every <= 0:
+            return 0
+        unfrozen = 1 + (epoch - self.freeze_epochs) // self.unfreeze_every
+        return max(len(self.stages) - unfrozen, 0)
+
+    def step(self, epoch):
+        """
+        Freeze and unfreeze the stages for `epoch`. Returns True if the set
+        of trainable parameters changed.
+        """
+        num_frozen = self.frozen_stages(epoch)
+        if num_frozen == self.num_frozen:
+            return False
+        for i, name in enumerate(self.stages):
+            module = self.model.get_submodule(name)
+            if i < num_frozen:
+                self._freeze(module)
+            else:
+                self._unfreeze(module)
+        self.num_frozen = num_frozen
+        trainable = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
+        print(
+            f"Epoch {epoch}: {num_frozen}/{len(self.stages)} backbone stages frozen, "
+            f"{trainable:,} training parameters"
+        )
+        return True
+
+    def _freeze(self, module):
+        for p in module.parameters():
+            p.requires_grad_(False)
+        module.forward = MethodType(_no_grad_forward, module)
+        module.train = MethodType(_frozen_train, module)
+        module.train()
+
+    def _unfreeze(self, module):
+        for p in module.parameters():
+            p.requires_grad_(self.requires_grad[id(p)])
+        # Drop the instance overrides, back to the class methods.
+        module.__dict__.pop('forward', None)
+        module.__dict__.pop('train', None)
+        module.train(self.model.training)
+
+def transfer_optimizer_state(old_optimizer, new_optimizer):
+    """
+    Carry the per parameter state (momentum buffers, Adam moments) of the
+    parameters that are in both optimizers over to `new_optimizer`. Not
+    possible for `ZeroRedundancyOptimizer`, its state is sharded by
+    parameter and starts over.
+    """
+    if isinstance(new_optimizer, torch.distributed.optim.ZeroRedundancyOptimizer):
+        return
+    for group in new_optimizer.param_groups:
+        for p in group['params']:
+            if p in old_optimizer.state:
+                new_optimizer.state[p] = old_optimizer.state[p]
+
+def transfer_scheduler_state(old_scheduler, new_scheduler):
+    """
+    Continue the schedule of `old_scheduler` with `new_scheduler`, built on
+    the rebuilt optimizer (which may have a different number of groups).
+    """
+    state = {
+        k: v for k, v in old_scheduler.state_dict().items()
+        if k not in ('base_lrs', '_last_lr')
+    }
+    new_scheduler.load_state_dict(state)
@@ -5,8 +5,12 @@ import matplotlib.pyplot as plt
 import os
 import yaml
 import random
+import queue
+import shutil
+import threading
 
 from pathlib import Path
+from datasets import batch_to_device
 
 plt.style.use('ggplot')
 
@@ -46,6 +50,123 @@ class Averager:
         self.current_total = 0.0
         self.iterations = 0.0
 
+def _snapshot(obj):
+    """
+    Copy of `obj` with every tensor copied to CPU, so that training can go on
+    updating the parameters and optimizer state in place while the copy is
+    written to disk.
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cpu':
+            return obj.detach().clone()
+        return obj.detach().cpu()
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    """
+    `torch.save` to a temporary file in the same directory and rename it to
+    `path`. A crash during the write leaves the previous file intact.
+    """
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread so that the training loop
+    does not wait for the disk. `save` only snapshots the state to CPU.
+    Every file is written atomically (see `atomic_save`).
+
+    :param keep: Number of epoch checkpoints to keep, as
+        `<name>_epoch_<N>.pth` next to the file saved with `epoch`.
+        0 keeps only the latest file.
+    :param max_pending: Maximum snapshots waiting to be written, `save`
+        blocks when the writer falls this far behind.
+    """
+    def __init__(self, keep=0, max_pending=4):
+        self.keep = keep
+        self.epoch_files = {}
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, obj, path, epoch=None):
+        """
+        Queue `obj` to be written to `path`.
+
+        :param epoch: If given and `keep` > 0, a copy of the file for this
+            epoch is kept and the older copies beyond `keep` are removed.
+            A string (e.g. `step_<N>`) replaces `epoch_<N>` in the name.
+        """
+        self._raise_error()
+        self.queue.put((_snapshot(obj), path, epoch))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, path, epoch = item
+            try:
+                atomic_save(obj, path)
+                if epoch is not None and self.keep > 0:
+                    self._retain(path, epoch)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _retain(self, path, epoch):
+        root, ext = os.path.splitext(path)
+        # Step based training tags the copies with `step_<N>`.
+        tag = epoch if isinstance(epoch, str) else f"epoch_{epoch}"
+        epoch_path = f"{root}_{tag}{ext}"
+        if os.path.exists(epoch_path):
+            os.remove(epoch_path)
+        try:
+            # `path` is replaced with a new file on the next save, so a
+            # hard link keeps this epoch's data without copying it.
+            os.link(path, epoch_path)
+        except OSError:
+            shutil.copy2(path, epoch_path)
+        files = self.epoch_files.setdefault(path, [])
+        files.append(epoch_path)
+        while len(files) > self.keep:
+            old_path = files.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def wait(self):
+        """
+        Block until all the queued checkpoints are on disk.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write the remaining checkpoints and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+def _write_checkpoint(obj, path, writer=None, epoch=None):
+    if writer is not None:
+        writer.save(obj, path, epoch=epoch)
+    else:
+        atomic_save(obj, path)
+
 class SaveBestModel:
     """
     Class to save the best model while training. If the current epoch's 
@@ -64,18 +185,26 @@ class SaveBestModel:
         epoch, 
         OUT_DIR,
         config,
-        model_name
+        model_name,
+        writer=None,
+        state_dict=None
     ):
+        """
+        :param state_dict: The evaluated weights when they are not the
+            current weights of `model` (asynchronous evaluation).
+        """
         if current_valid_map > self.best_valid_map:
             self.best_valid_map = current_valid_map
             print(f"\nBEST VALIDATION mAP: {self.best_valid_map}")
             print(f"\nSAVING BEST MODEL FOR EPOCH: {epoch+1}\n")
-            torch.save({
+            if state_dict is None:
+                state_dict = model.state_dict()
+            _write_checkpoint({
                 'epoch': epoch+1,
-                'model_state_dict': model.state_dict(),
+                'model_state_dict': state_dict,
                 'data': config,
                 'model_name': model_name
-                }, f"{OUT_DIR}/best_model.pth")
+                }, f"{OUT_DIR}/best_model.pth", writer)
 
 def show_tranformed_image(train_loader, device, classes, colors):
     """
@@ -85,9 +214,7 @@ def show_tranformed_image(train_loader, device, classes, colors):
     """
     if len(train_loader) > 0:
         for i in range(2):
-            images, targets = next(iter(train_loader))
-            images = list(image.to(device) for image in images)
-            targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+            images, targets = batch_to_device(next(iter(train_loader)), device)
             boxes = targets[i]['boxes'].cpu().numpy().astype(np.int32)
             labels = targets[i]['labels'].cpu().numpy().astype(np.int32)
             # Get all the predicited class names.
@@ -204,7 +331,9 @@ def save_model(
     val_map_05,
     OUT_DIR,
     config,
-    model_name
+    model_name,
+    writer=None,
+    step=None
 ):
     """
     Function to save the trained model till current epoch, or whenever called.
@@ -219,9 +348,13 @@ def save_model(
     :param val_map: mAP for IoU 0.5:0.95.
     :param val_map_05: mAP for IoU 0.5.
     :param OUT_DIR: Output directory to save the model.
+    :param writer: Optional `CheckpointWriter` to save in the background.
+    :param step: Number of optimizer steps taken, for resuming step based
+        training (`--max-steps`).
     """
-    torch.save({
+    _write_checkpoint({
                 'epoch': epoch+1,
+                'step': step,
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'train_loss_list': train_loss_list,
@@ -230,9 +363,10 @@ def save_model(
                 'val_map_05': val_map_05,
                 'data': config,
                 'model_name': model_name
-                }, f"{OUT_DIR}/last_model.pth")
+                }, f"{OUT_DIR}/last_model.pth", writer,
+                epoch=epoch+1 if step is None else f"step_{step}")
 
-def save_model_state(model, OUT_DIR, config, model_name):
+def save_model_state(model, OUT_DIR, config, model_name, writer=None):
     """
     Saves the model state dictionary only. Has a smaller size compared 
     to the the saved model with all other parameters and dictionaries.
@@ -240,12 +374,13 @@ def save_model_state(model, OUT_DIR, config, model_name):
 
     :param model: The neural network model.
     :param OUT_DIR: Output directory to save the model.
+    :param writer: Optional `CheckpointWriter` to save in the background.
     """
-    torch.save({
+    _write_checkpoint({
                 'model_state_dict': model.state_dict(),
                 'data': config,
                 'model_name': model_name
-                }, f"{OUT_DIR}/last_model_state.pth")
+                }, f"{OUT_DIR}/last_model_state.pth", writer)
 
 def denormalize(x, mean=None, std=None):
     # Shape of x here should be [B, 3, H, W].
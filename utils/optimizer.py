@@ -0,0 +1,172 @@
+"""
+Optimizer construction for `train.py`. SGD (Nesterov momentum) or AdamW
+with the multi tensor (`foreach`) or `fused` implementations, optional
+parameter groups and optional `ZeroRedundancyOptimizer` sharding of the
+optimizer state across the DDP processes. Also the warmup + cosine
+learning rate schedule of the step based training (`--max-steps`).
+
+USAGE:
+python train.py --model fasterrcnn_resnet50_fpn_v2 --data data_configs/voc.yaml --optimizer adamw --lr 0.0001 --weight-decay 0.05 --backbone-lr-mult 0.1
+"""
+
+import math
+import torch
+import torch.nn as nn
+
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from models.layers import FrozenBatchNorm2d
+
+OPTIMIZERS = ('sgd', 'adamw')
+IMPLEMENTATIONS = ('foreach', 'fused', 'for-loop')
+# Copies of the trainable parameters kept as optimizer state: the SGD
+# momentum buffer, the AdamW first and second moments.
+STATE_COPIES = {'sgd': 1, 'adamw': 2}
+NORM_LAYERS = (
+    nn.modules.batchnorm._NormBase,
+    nn.GroupNorm,
+    nn.LayerNorm,
+    FrozenBatchNorm2d
+)
+
+def param_groups(model, lr, weight_decay=0.0, backbone_lr_mult=1.0):
+    """
+    Split the trainable parameters of `model` into groups. Norm layer
+    parameters and biases get no weight decay when `weight_decay > 0`, the
+    backbone parameters get `lr * backbone_lr_mult` when the multiplier is
+    not 1. With the defaults everything is in one group, the same as
+    passing `model.parameters()`.
+
+    :param model: The model, not wrapped in DDP (parameter names are used).
+    :param lr: Base learning rate.
+    :param weight_decay: Weight decay of the decayed groups.
+    :param backbone_lr_mult: Learning rate multiplier of `model.backbone`.
+
+    Returns a list of parameter group dictionaries with a `name` key.
+    """
+    groups = {}
+    seen = set()
+    for module_name, module in model.named_modules():
+        for name, p in module.named_parameters(recurse=False):
+            if not p.requires_grad or id(p) in seen:
+                continue
+            seen.add(id(p))
+            full_name = f"{module_name}.{name}" if module_name else name
+            backbone = backbone_lr_mult != 1.0 \
+                and full_name.startswith('backbone.')
+            no_decay = weight_decay > 0 \
+                and (isinstance(module, NORM_LAYERS) or name == 'bias')
+            group_name = ('backbone' if backbone else 'heads') \
+                + ('_no_decay' if no_decay else '')
+            if group_name not in groups:
+                groups[group_name] = {
+                    'name': group_name,
+                    'params': [],
+                    'lr': lr * backbone_lr_mult if backbone else lr,
+                    'weight_decay': 0.0 if no_decay else weight_decay
+                }
+            groups[group_name]['params'].append(p)
+    # Fixed order so that a resumed optimizer state lines up.
+    order = ['backbone', 'backbone_no_decay', 'heads', 'heads_no_decay']
+    return [groups[name] for name in order if name in groups]
+
+def build_optimizer(
+    model,
+    name='sgd',
+    lr=0.001,
+    momentum=0.9,
+    weight_decay=0.0,
+    backbone_lr_mult=1.0,
+    impl='foreach',
+    zero=False
+):
+    """
+    :param model: The model, not wrapped in DDP.
+    :param name: 'sgd' (Nesterov momentum) or 'adamw'.
+    :param lr: Base learning rate.
+    :param momentum: SGD momentum.
+    :param weight_decay: Weight decay, not applied to norm layers and biases.
+    :param backbone_lr_mult: Learning rate multiplier of the backbone.
+    :param impl: 'foreach' (multi tensor), 'fused' (single kernel) or
+        'for-loop' (one parameter at a time).
+    :param zero: Shard the optimizer state across the distributed processes
+        with `ZeroRedundancyOptimizer`. Call `consolidate_state_dict` on
+        every process before saving the optimizer state.
+    """
+    assert name in OPTIMIZERS, f"Unknown optimizer {name}, choose from {OPTIMIZERS}"
+    assert impl in IMPLEMENTATIONS, \
+        f"Unknown implementation {impl}, choose from {IMPLEMENTATIONS}"
+    groups = param_groups(model, lr, weight_decay, backbone_lr_mult)
+    if name == 'sgd':
+        optimizer_class = torch.optim.SGD
+        defaults = dict(
+            lr=lr, momentum=momentum, nesterov=True, weight_decay=weight_decay
+        )
+    else:
+        optimizer_class = torch.optim.AdamW
+        defaults = dict(lr=lr, weight_decay=weight_decay)
+    if impl == 'fused':
+        defaults['fused'] = True
+    else:
+        defaults['foreach'] = impl == 'foreach'
+
+    if zero:
+        optimizer = ZeroRedundancyOptimizer(
+            groups, optimizer_class=optimizer_class, **defaults
+        )
+    else:
+        optimizer = optimizer_class(groups, **defaults)
+
+    print(
+        f"Optimizer: {optimizer_class.__name__} ({impl})"
+        f"{', ZeRO sharded' if zero else ''}"
+    )
+    for group in groups:
+        num_params = sum(p.numel() for p in group['params'])
+        print(
+            f"    {group['name']:<18} {num_params:>12,} parameters, "
+            f"lr {group['lr']:g}, weight decay {group['weight_decay']:g}"
+        )
+    return optimizer
+
+def consolidate_state_dict(optimizer):
+    """
+    Gather a `ZeroRedundancyOptimizer` state on the main process so that
+    `optimizer.state_dict()` works there. Has to be called on every
+    process. Does nothing for other optimizers.
+    """
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=0)
+
+def warmup_cosine_scheduler(
+    optimizer,
+    max_steps,
+    warmup_steps=1000,
+    warmup_factor=0.001,
+    min_lr_ratio=0.0,
+    start_step=0
+):
+    """
+    Per iteration schedule for step based training, call `step()` after
+    every optimizer step. The learning rate ramps up linearly from
+    `warmup_factor * lr` over `warmup_steps` and then follows a cosine
+    down to `min_lr_ratio * lr` at `max_steps`.
+
+    :param start_step: Number of steps already taken, to continue a
+        resumed or rebuilt schedule.
+    """
+    warmup_steps = min(warmup_steps, max_steps)
+
+    def lr_lambda(step):
+        if step < warmup_steps:
+            alpha = step / warmup_steps
+            return warmup_factor * (1 - alpha) + alpha
+        progress = (step - warmup_steps) / max(max_steps - warmup_steps, 1)
+        cosine = 0.5 * (1 + math.cos(math.pi * min(progress, 1.0)))
+        return min_lr_ratio + (1 - min_lr_ratio) * cosine
+
+    # A resumed optimizer state already has the `initial_lr` of the groups.
+    for group in optimizer.param_groups:
+        group.setdefault('initial_lr', group['lr'])
+    return torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lr_lambda, last_epoch=start_step - 1
+    )
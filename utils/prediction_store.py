@@ -0,0 +1,99 @@
+"""
+Prediction store of `eval.py`. The raw per image detections (boxes,
+scores, labels) and the ground truth of an evaluation run are written to
+one `.npz` file, one flat array per field plus per image offsets. The
+metrics can then be computed again with another score threshold, class
+subset or IoU thresholds without loading the images or the model.
+
+USAGE:
+python eval.py --data data_configs/voc.yaml --weights outputs/training/res_1/best_model.pth --model fasterrcnn_resnet50_fpn_v2 --save-preds outputs/preds/voc_val.npz
+python eval.py --data data_configs/voc.yaml --from-preds outputs/preds/voc_val.npz --score-thres 0.05 --eval-classes cat dog
+"""
+
+import numpy as np
+import torch
+
+PRED_FIELDS = {'boxes': np.float32, 'scores': np.float32, 'labels': np.int32}
+TARGET_FIELDS = {'boxes': np.float32, 'labels': np.int32}
+
+def _pack(prefix, dicts, fields):
+    counts = [len(d['labels']) for d in dicts]
+    arrays = {
+        f"{prefix}_offsets": np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    }
+    for key, dtype in fields.items():
+        values = [np.asarray(d[key], dtype=dtype) for d in dicts]
+        if key == 'boxes':
+            values = [v.reshape(-1, 4) for v in values]
+        empty = np.zeros((0, 4) if key == 'boxes' else (0, ), dtype=dtype)
+        arrays[f"{prefix}_{key}"] = np.concatenate(values) if values else empty
+    return arrays
+
+def _unpack(prefix, arrays, fields):
+    offsets = arrays[f"{prefix}_offsets"]
+    columns = {
+        # Labels back to int64 like the model outputs and dataset targets.
+        key: torch.from_numpy(arrays[f"{prefix}_{key}"].astype(
+            np.int64 if key == 'labels' else dtype
+        ))
+        for key, dtype in fields.items()
+    }
+    return [
+        {key: column[start:end] for key, column in columns.items()}
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+def save_predictions(path, preds, targets, classes=None):
+    """
+    :param path: Output `.npz` file.
+    :param preds: List of per image dictionaries with the `boxes` (xyxy),
+        `scores` and `labels` tensors of the detections.
+    :param targets: List of per image dictionaries with the ground truth
+        `boxes` and `labels`, in the same image order.
+    :param classes: Optional class names stored with the predictions.
+    """
+    assert len(preds) == len(targets), \
+        f"{len(preds)} predictions for {len(targets)} images"
+    arrays = {}
+    arrays.update(_pack('pred', preds, PRED_FIELDS))
+    arrays.update(_pack('target', targets, TARGET_FIELDS))
+    if classes is not None:
+        arrays['classes'] = np.asarray(classes, dtype=str)
+    np.savez(path, **arrays)
+    print(
+        f"Saved {len(arrays['pred_scores'])} detections of "
+        f"{len(preds)} images to {path}"
+    )
+
+def load_predictions(path):
+    """
+    Returns the `preds` and `targets` lists of `save_predictions` and the
+    class names (None if not stored).
+    """
+    with np.load(path) as arrays:
+        arrays = dict(arrays)
+    preds = _unpack('pred', arrays, PRED_FIELDS)
+    targets = _unpack('target', arrays, TARGET_FIELDS)
+    classes = arrays['classes'].tolist() if 'classes' in arrays else None
+    return preds, targets, classes
+
+def filter_predictions(preds, targets, score_thres=0.0, labels=None):
+    """
+    :param score_thres: Detections scoring below this are dropped.
+    :param labels: Optional class indices to keep, detections and ground
+        truth of the other classes are dropped.
+
+    Returns the filtered `preds` and `targets` lists.
+    """
+    if labels is not None:
+        labels = torch.as_tensor(list(labels), dtype=torch.int64)
+    filtered_preds, filtered_targets = [], []
+    for pred, target in zip(preds, targets):
+        keep = pred['scores'] >= score_thres
+        if labels is not None:
+            keep &= torch.isin(pred['labels'], labels)
+            keep_target = torch.isin(target['labels'], labels)
+            target = {k: v[keep_target] for k, v in target.items()}
+        filtered_preds.append({k: v[keep] for k, v in pred.items()})
+        filtered_targets.append(target)
+    return filtered_preds, filtered_targets
@@ -0,0 +1,136 @@
+"""
+Quantization aware training (QAT) for CPU int8 inference of the
+lightweight models (MobileNetV3, SqueezeNet, DarkNet and nano families).
+
+The backbone and the RoI box head are traced with torch.fx and fake
+quantization observers are inserted (conv + batch norm + activation are
+fused first). The model then fine-tunes as usual with `train_one_epoch`.
+At the end `convert_qat` turns a copy into an int8 model for the CPU. The
+RPN, RoI pooling, box predictor and post processing stay in float.
+
+USAGE:
+python train.py --model fasterrcnn_mini_darknet --weights outputs/training/res_1/best_model.pth --data data_configs/voc.yaml --qat --epochs 5 --lr 0.0001
+"""
+
+import copy
+import time
+import torch
+import torch.nn as nn
+
+from torch.ao.quantization import get_default_qat_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_qat_fx, convert_fx
+from torchvision.ops.misc import FrozenBatchNorm2d as TorchvisionFrozenBatchNorm2d
+from models.layers import FrozenBatchNorm2d
+
+FROZEN_BATCH_NORMS = (TorchvisionFrozenBatchNorm2d, FrozenBatchNorm2d)
+
+def _unfreeze_batch_norms(module):
+    """
+    Replace the frozen batch norm layers (pretrained torchvision backbones)
+    with `nn.BatchNorm2d` so that they fuse into the preceding convolution.
+    The affine parameters stay frozen.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, FROZEN_BATCH_NORMS):
+            bn = nn.BatchNorm2d(child.num_features, eps=child.eps)
+            with torch.no_grad():
+                bn.weight.copy_(child.weight)
+                bn.bias.copy_(child.bias)
+                bn.running_mean.copy_(child.running_mean)
+                bn.running_var.copy_(child.running_var)
+            bn.weight.requires_grad_(False)
+            bn.bias.requires_grad_(False)
+            setattr(module, name, bn.to(child.weight.device))
+        else:
+            _unfreeze_batch_norms(child)
+
+def prepare_qat(model, image_size, backend='x86'):
+    """
+    Insert fake quantization into `model.backbone` and
+    `model.roi_heads.box_head` in place.
+
+    :param model: Float Faster RCNN model, weights already loaded.
+    :param image_size: Training image size for the example input.
+    :param backend: Quantized engine the model is going to run on, 'x86'
+        or 'fbgemm' for Intel/AMD CPUs, 'qnnpack' for ARM.
+    """
+    qconfig_mapping = get_default_qat_qconfig_mapping(backend)
+    device = next(model.parameters()).device
+    out_channels = model.backbone.out_channels
+    output_size = model.roi_heads.box_roi_pool.output_size
+    if isinstance(output_size, int):
+        output_size = (output_size, output_size)
+    model.train()
+
+    _unfreeze_batch_norms(model.backbone)
+    backbone = prepare_qat_fx(
+        model.backbone,
+        qconfig_mapping,
+        (torch.rand(1, 3, image_size, image_size, device=device), )
+    )
+    backbone.out_channels = out_channels
+    model.backbone = backbone
+    model.roi_heads.box_head = prepare_qat_fx(
+        model.roi_heads.box_head,
+        qconfig_mapping,
+        (torch.rand(2, out_channels, *output_size, device=device), )
+    )
+    return model
+
+def is_qat_state_dict(state_dict):
+    """
+    Whether `state_dict` was saved from a model prepared by `prepare_qat`
+    (fake quantization modules in the traced backbone and box head).
+    """
+    return any('fake_quant' in key for key in state_dict)
+
+def assert_float_checkpoint(checkpoint):
+    """
+    Stop with a clear message instead of a key mismatch when loading a
+    training checkpoint of a `--qat` run into a float model.
+    """
+    assert not is_qat_state_dict(checkpoint['model_state_dict']), (
+        'The checkpoint was saved during --qat training and holds the fake '
+        'quantized backbone, it can not be loaded into a float model or '
+        'resumed. Use the converted int8 model quantized_model.pt of the '
+        'run, `torch.load(path, weights_only=False)`.'
+    )
+
+def update_qat_state(model, epoch, num_epochs):
+    """
+    Freeze the batch norm statistics and the quantization ranges for the
+    last epoch of a multi epoch run, so that the final weights are tuned
+    against the scales the int8 model is going to use.
+    """
+    if num_epochs > 1 and epoch == num_epochs - 1:
+        print('Freezing the batch norm statistics and quantization observers')
+        model.apply(torch.ao.nn.intrinsic.qat.freeze_bn_stats)
+        model.apply(torch.ao.quantization.disable_observer)
+
+def convert_qat(model, backend='x86'):
+    """
+    int8 CPU copy of a model prepared by `prepare_qat`.
+    """
+    torch.backends.quantized.engine = backend
+    quantized = copy.deepcopy(model).cpu().eval()
+    # Copies of a `GraphModule` do not keep the extra attributes.
+    out_channels = model.backbone.out_channels
+    quantized.backbone = convert_fx(quantized.backbone)
+    quantized.backbone.out_channels = out_channels
+    quantized.roi_heads.box_head = convert_fx(quantized.roi_heads.box_head)
+    return quantized
+
+@torch.inference_mode()
+def measure_latency(model, image_size, runs=20, warmup=3):
+    """
+    Average CPU latency of `model` in milliseconds for one
+    `image_size` x `image_size` image.
+    """
+    model.eval()
+    images = [torch.rand(3, image_size, image_size)]
+    for _ in range(warmup):
+        model(images)
+    start = time.time()
+    for _ in range(runs):
+        model(images)
+    return (time.time() - start) / runs * 1000
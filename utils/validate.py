@@ -7,6 +7,7 @@ from datasets import (
     create_valid_dataset, create_valid_loader
 )
 from models.create_fasterrcnn_model import create_model
+from utils.quantization import assert_float_checkpoint
 
 import torch
 import argparse
@@ -72,6 +73,7 @@ if __name__ == '__main__':
     if args['weights'] is not None:
         model = create_model(num_classes=NUM_CLASSES, coco_model=False)
         checkpoint = torch.load(args['weights'], map_location=DEVICE)
+        assert_float_checkpoint(checkpoint)
         model.load_state_dict(checkpoint['model_state_dict'])
     model.to(DEVICE).eval()
 